@@ -1,9 +1,9 @@
 #!/bin/bash
 
-source auth.key
 # Pulls GRD data from ASF. First arg is location, second optional arg is maxResults, If it's not included, defaults to 1
 
-# requires aria2 for the downloading
+# downloads with download.py, using the credentials in auth.key
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 
 # read from pipe or input
 if (( ${#} == 0 )) ; then 
@@ -25,6 +25,4 @@ fi
 
 query="https://api.daac.asf.alaska.edu/services/search/param?platform=S1&processingLevel=GRD_MS,GRD_MD&maxResults="${results}"&intersectsWith=point%28"${location}"%29&output=metalink"
 
-aria2c --http-auth-challenge=true --http-user="$EARTHDATA_USER" --http-passwd="$EARTHDATA_PASSWORD" "$query"
-
-rm -f asf-datapool-results*
\ No newline at end of file
+python3 ${script_dir}/download.py --authkey auth.key --query "$query"
\ No newline at end of file
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# Benchmarks each stage of the pipeline on synthetic Sentinel-1 GRD products, generated by synthetic.py at a
+# configurable scene count & raster size. Each stage runs in its own process so its wall time, cpu time, peak RSS &
+# bytes read/written are measured in isolation. Results are written to JSON, and can be compared against a previous
+# run with a regression threshold. The synthetic
+# products only hold what the numpy engine reads, SNAP's S1 reader also needs the orbit, product & swath metadata of
+# real products, so the SNAP stage runs over a folder of real products if one is given and is skipped otherwise.
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import datetime
+import platform
+import tempfile
+import argparse
+import resource
+import traceback
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+import synthetic
+import tracing
+
+gdal.UseExceptions()
+
+STAGES = ['generate', 'calibrate_numpy', 'calibrate_full', 'multilook_accuracy', 'calibrate_snap', 'group', 'merge', 'render']
+METRICS = ['wall_s', 'cpu_s', 'max_rss_mb', 'read_mb', 'write_mb'] # metrics compared between runs
+
+def main(workdir=False, scenes=8, per_date=2, width=2000, height=2000, pixel_spacing=100, workers=2, stages=False,
+         output=False, compare_path=False, threshold=0.2, seed=0, keep=False, snap_products=False):
+    '''runs the stages over freshly generated products, writes the results to output and compares them against
+       compare_path if given. returns the list of regressions'''
+    config = {'scenes': scenes, 'per_date': per_date, 'width': width, 'height': height,
+              'pixel_spacing': pixel_spacing, 'workers': workers, 'seed': seed,
+              'snap_products': os.path.abspath(snap_products) if snap_products else False}
+    stages = stages or STAGES
+    cleanup = workdir is False and not keep
+    if workdir is False:
+        workdir = tempfile.mkdtemp(prefix='s1grd_bench_')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    results = {'created': datetime.datetime.utcnow().isoformat(), 'config': config, 'host': get_host(), 'stages': {}}
+    try:
+        for stage in STAGES:
+            if not stage in stages:
+                continue
+            print('--------------------------\nbenchmarking {}...'.format(stage))
+            metrics = run_stage(stage, workdir, config)
+            results['stages'][stage] = metrics
+            print_metrics(stage, metrics)
+        results['multilook'] = multilook_summary(results['stages'])
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir)
+        else:
+            print('benchmark products & outputs are in {}'.format(workdir))
+    if output:
+        with open(output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+        print('results written to {}'.format(output))
+    regressions = []
+    if compare_path:
+        with open(compare_path, 'r') as fin:
+            regressions = compare(results, json.load(fin), threshold)
+    return regressions
+
+def get_host():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': multiprocessing.cpu_count(),
+            'gdal': gdal.__version__}
+
+def run_stage(stage, workdir, config):
+    '''runs the stage in a spawned process, returns its metrics'''
+    ctx = multiprocessing.get_context('spawn')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_stage_child, args=(send, stage, workdir, config))
+    proc.start()
+    send.close()
+    try:
+        metrics = recv.recv()
+    except EOFError:
+        metrics = {'error': 'stage process exited with code {}'.format(proc.exitcode)}
+    proc.join()
+    return metrics
+
+def _stage_child(conn, stage, workdir, config):
+    '''stage process: runs the stage and sends back its metrics. rusage & /proc io include reaped child processes'''
+    start_io = tracing.read_proc_io()
+    start_cpu = cpu_time()
+    start = time.time()
+    error = skipped = None
+    extra = {}
+    try:
+        result = globals()['stage_' + stage](workdir, config)
+        if isinstance(result, dict):
+            extra = result
+        else:
+            skipped = result
+    except Exception:
+        error = traceback.format_exc()
+    metrics = {'wall_s': time.time() - start, 'cpu_s': cpu_time() - start_cpu, 'max_rss_mb': max_rss_mb()}
+    metrics.update(extra)
+    end_io = tracing.read_proc_io()
+    if start_io and end_io:
+        metrics['read_mb'] = (end_io['rchar'] - start_io['rchar']) / 1e6
+        metrics['write_mb'] = (end_io['wchar'] - start_io['wchar']) / 1e6
+        metrics['disk_read_mb'] = (end_io['read_bytes'] - start_io['read_bytes']) / 1e6
+        metrics['disk_write_mb'] = (end_io['write_bytes'] - start_io['write_bytes']) / 1e6
+    if skipped:
+        metrics = {'skipped': skipped}
+    if error:
+        metrics['error'] = error
+    conn.send(metrics)
+    conn.close()
+
+def cpu_time():
+    '''returns the user + system cpu seconds of this process and its reaped children'''
+    total = 0.
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def max_rss_mb():
+    '''returns the peak RSS of this process or its largest child in MB'''
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 1024. if sys.platform != 'darwin' else rss / 1024. / 1024.
+
+def print_metrics(stage, metrics):
+    if 'skipped' in metrics:
+        print('{}: skipped, {}'.format(stage, metrics['skipped']))
+        return
+    if not 'wall_s' in metrics:
+        print('{} failed:\n{}'.format(stage, metrics['error']))
+        return
+    print('{}: {:.2f}s wall, {:.2f}s cpu, {:.1f} MB peak RSS, {:.1f} MB read, {:.1f} MB written'.format(stage,
+          metrics['wall_s'], metrics['cpu_s'], metrics['max_rss_mb'], metrics.get('read_mb', 0.), metrics.get('write_mb', 0.)))
+    if 'error' in metrics:
+        print('{} failed:\n{}'.format(stage, metrics['error']))
+
+def multilook_summary(stages):
+    '''returns & prints the speedup & memory reduction of the multilooked calibration over the full resolution one'''
+    multilooked, full = stages.get('calibrate_numpy'), stages.get('calibrate_full')
+    if not multilooked or not full or not 'wall_s' in multilooked or not 'wall_s' in full:
+        return None
+    summary = {'speedup': full['wall_s'] / max(multilooked['wall_s'], 1e-6),
+               'rss_reduction': 1. - multilooked['max_rss_mb'] / max(full['max_rss_mb'], 1e-6)}
+    print('multilooking: {:.2f}x faster, {:.1%} less peak memory than full resolution'.format(
+          summary['speedup'], summary['rss_reduction']))
+    accuracy = stages.get('multilook_accuracy', {})
+    if 'median_db' in accuracy:
+        summary.update({'median_db': accuracy['median_db'], 'p95_db': accuracy['p95_db']})
+        print('multilooked vs full resolution: median abs difference {:.3f} dB, 95th percentile {:.3f} dB'.format(
+              accuracy['median_db'], accuracy['p95_db']))
+    return summary
+
+def compare(results, baseline, threshold=0.2):
+    '''prints the change of each metric against the baseline results, returns a list of (stage, metric, baseline,
+       value) for the metrics that grew by more than the threshold fraction'''
+    if results['config'] != baseline.get('config'):
+        print('warning: benchmark configs differ, comparisons may not be meaningful')
+    regressions = []
+    for stage, metrics in sorted(results['stages'].items()):
+        base = baseline.get('stages', {}).get(stage)
+        if base is None or 'error' in metrics or 'error' in base or 'skipped' in metrics or 'skipped' in base:
+            continue
+        for metric in METRICS:
+            if not metric in metrics or not metric in base:
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric] if base[metric] else 0.
+            flag = ''
+            # ignore tiny absolute values, eg a few ms of wall time, which are mostly noise
+            if change > threshold and metrics[metric] - base[metric] > 0.1:
+                regressions.append((stage, metric, base[metric], metrics[metric]))
+                flag = ' REGRESSION'
+            print('{:>16} {:>11}: {:10.2f} -> {:10.2f} ({:+.1%}){}'.format(stage, metric, base[metric], metrics[metric], change, flag))
+    if regressions:
+        print('{} metrics regressed by more than {:.0%}'.format(len(regressions), threshold))
+    return regressions
+
+### stages, each returns a reason if it was skipped
+
+def stage_generate(workdir, config):
+    products = os.path.join(workdir, 'products')
+    synthetic.generate(products, config['scenes'], config['per_date'], config['width'], config['height'], config['seed'])
+    synthetic.write_aoi(os.path.join(workdir, 'aoi.shp'), synthetic.get_aoi_wkt(config['per_date'], config['width'], config['height']))
+
+def stage_calibrate_numpy(workdir, config):
+    return run_calibrate(workdir, config, 'numpy')
+
+def stage_calibrate_full(workdir, config):
+    # geocoded at the native spacing, so the reference keeps every look rather than point sampling one per pixel
+    return run_calibrate(workdir, config, 'numpy', multilook=False, pixel_spacing=synthetic.SPACING)
+
+def stage_multilook_accuracy(workdir, config):
+    '''compares the multilooked outputs against the full resolution ones, geocoded at the native spacing and
+       averaged in linear power onto the multilooked grid. returns the median & worst 95th percentile abs difference
+       in dB'''
+    import calibrate_numpy
+    medians = []
+    p95s = []
+    suffix = '.{}.corrected.tif'.format(config['pixel_spacing'])
+    for path in sorted(glob.glob(os.path.join(workdir, 'calibrated_numpy', '*' + suffix))):
+        name = os.path.basename(path)[:-len(suffix)] + '.{}.corrected.tif'.format(synthetic.SPACING)
+        full = os.path.join(workdir, 'calibrated_numpy_full', name)
+        if os.path.exists(full):
+            stats = calibrate_numpy.compare(path, full, resampling='average')
+            medians.append(stats['median'])
+            p95s.append(stats['p95'])
+    if not medians:
+        return 'no full resolution outputs to compare against'
+    return {'median_db': float(np.median(medians)), 'p95_db': float(np.max(p95s)), 'compared': len(medians)}
+
+def stage_calibrate_snap(workdir, config):
+    '''calibrates the real products in config['snap_products'] with SNAP, over the middle half of the first one'''
+    import calibrate
+    if calibrate.snappy is None:
+        return 'snappy is not installed'
+    if not config['snap_products']:
+        return 'SNAP cannot read the synthetic products, pass real ones with --snap_products'
+    import footprint
+    import shapely.affinity
+    products = config['snap_products']
+    paths = [os.path.join(products, item) for item in sorted(os.listdir(products))]
+    footprints = [fp for fp in [footprint.read_local_footprint(path) for path in paths] if fp]
+    if not footprints:
+        return 'no products found in {}'.format(products)
+    wkt = shapely.affinity.scale(footprints[0].geometry, 0.5, 0.5).wkt
+    return run_calibrate(workdir, config, 'snap', infolder=products, wkt=wkt)
+
+def run_calibrate(workdir, config, engine, multilook=True, infolder=False, wkt=False, pixel_spacing=False):
+    import calibrate
+    if pixel_spacing is False:
+        pixel_spacing = config['pixel_spacing']
+    if infolder is False:
+        infolder = os.path.join(workdir, 'products')
+    if wkt is False:
+        wkt = synthetic.get_aoi_wkt(config['per_date'], config['width'], config['height'])
+    outfolder = os.path.join(workdir, 'calibrated_{}{}'.format(engine, '' if multilook else '_full'))
+    failed = calibrate.main(infolder=infolder, outfolder=outfolder, polarization='HH',
+                            wktstring=wkt, pixel_spacing=pixel_spacing, workers=config['workers'],
+                            engine=engine, multilook=multilook)
+    if failed:
+        raise Exception('{} products failed to calibrate'.format(len(failed)))
+
+def stage_group(workdir, config):
+    import group
+    # linked, so the stage can be rerun over the same calibrated files
+    group.main(os.path.join(workdir, 'calibrated_numpy'), 0, '*.corrected.tif', link='hard', workers=config['workers'])
+
+def stage_merge(workdir, config):
+    import merge
+    if not merge.main(os.path.join(workdir, 'calibrated_numpy'), workers=config['workers']):
+        raise Exception('nothing was merged')
+
+def stage_render(workdir, config):
+    import timelapse
+    if shutil.which('ffmpeg') is None:
+        return 'ffmpeg is not installed'
+    timelapse.main(os.path.join(workdir, 'calibrated_numpy'), os.path.join(workdir, 'aoi.shp'), 1024, 1024,
+                   num_procs=config['workers'], output=os.path.join(workdir, 'timelapse.265'))
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Benchmarks the pipeline stages on synthetic S1 GRD products")
+    parse.add_argument("--workdir", required=False, default=False, help="working folder, a temporary folder is used by default")
+    parse.add_argument("--scenes", required=False, type=int, default=8, help="number of synthetic products")
+    parse.add_argument("--per_date", required=False, type=int, default=2, help="number of along track slices per date")
+    parse.add_argument("--width", required=False, type=int, default=2000, help="product width in pixels")
+    parse.add_argument("--height", required=False, type=int, default=2000, help="product height in pixels")
+    parse.add_argument("--pixel_spacing", required=False, type=float, default=100, help="output pixel spacing in meters")
+    parse.add_argument("--workers", required=False, type=int, default=2, help="worker processes used by each stage")
+    parse.add_argument("--stages", required=False, nargs='+', default=False, choices=STAGES, help="stages to run, defaults to all")
+    parse.add_argument("--output", required=False, default=False, help="json file to write the results to")
+    parse.add_argument("--compare", required=False, default=False, help="json results of a previous run to compare against")
+    parse.add_argument("--threshold", required=False, type=float, default=0.2, help="fractional increase of a metric reported as a regression")
+    parse.add_argument("--seed", required=False, type=int, default=0, help="random seed for the synthetic data")
+    parse.add_argument("--keep", action="store_true", help="keep the temporary working folder")
+    parse.add_argument("--snap_products", required=False, default=False, help="folder of real products to benchmark the SNAP engine on")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    regressions = main(workdir=args.workdir, scenes=args.scenes, per_date=args.per_date, width=args.width,
+                       height=args.height, pixel_spacing=args.pixel_spacing, workers=args.workers, stages=args.stages,
+                       output=args.output, compare_path=args.compare, threshold=args.threshold, seed=args.seed,
+                       keep=args.keep, snap_products=args.snap_products)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Manifest of pipeline outputs keyed on the inputs & parameters of each stage, so unchanged work can be skipped.
+# Backed by a small sqlite database in the workdir, usable from python or from the shell scripts via the cli.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+
+CACHE_FILENAME = 's1grd_cache.sqlite'
+
+class Cache():
+    '''sqlite manifest of stage outputs. each entry is keyed on a hash of the stage inputs & parameters and holds the
+       output paths along with their size & mtime, so outputs that were modified or removed are treated as misses.'''
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, CACHE_FILENAME)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS outputs (stage TEXT, key TEXT, outputs TEXT, nbytes INTEGER, '
+                              'created REAL, accessed REAL, PRIMARY KEY (stage, key))')
+
+    def key(self, stage, inputs, params):
+        '''returns the key for the stage, given a list of inputs and a dict of parameters. existing files are
+           identified by name, size & mtime, anything else (eg granule ids) by its value'''
+        ident = {'stage': stage, 'inputs': [input_signature(item) for item in inputs], 'params': params}
+        return hashlib.sha256(json.dumps(ident, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def lookup(self, stage, key):
+        '''returns the list of outputs for the key, or None if missing or any output has changed since it was stored'''
+        row = self.conn.execute('SELECT outputs FROM outputs WHERE stage=? AND key=?', (stage, key)).fetchone()
+        if row is None:
+            return None
+        outputs = json.loads(row[0])
+        for path, size, mtime in outputs:
+            if not os.path.exists(path) or file_signature(path) != [path, size, mtime]:
+                with self.conn:
+                    self.conn.execute('DELETE FROM outputs WHERE stage=? AND key=?', (stage, key))
+                return None
+        with self.conn:
+            self.conn.execute('UPDATE outputs SET accessed=? WHERE stage=? AND key=?', (time.time(), stage, key))
+        return [item[0] for item in outputs]
+
+    def store(self, stage, key, outputs):
+        '''records the outputs for the key'''
+        signatures = [file_signature(path) for path in outputs]
+        nbytes = sum([item[1] for item in signatures])
+        now = time.time()
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?)',
+                              (stage, key, json.dumps(signatures), nbytes, now, now))
+
+    def evict(self, max_age=False, max_bytes=False, stages=False, remove_files=True):
+        '''evicts entries last used more than max_age days ago, then the least recently used entries until the total
+           size is under max_bytes. stages limits eviction to the given stages. returns the number of evicted entries'''
+        query = 'SELECT stage, key, outputs, nbytes, accessed FROM outputs'
+        args = ()
+        if stages:
+            query += ' WHERE stage IN ({})'.format(','.join(['?'] * len(stages)))
+            args = tuple(stages)
+        rows = self.conn.execute(query + ' ORDER BY accessed ASC', args).fetchall()
+        total = sum([row[3] for row in rows])
+        evict = []
+        for row in rows:
+            too_old = max_age is not False and row[4] < time.time() - max_age * 86400.
+            too_big = max_bytes is not False and total > max_bytes
+            if too_old or too_big:
+                evict.append(row)
+                total -= row[3]
+        with self.conn:
+            for stage, key, outputs, _, _ in evict:
+                self.conn.execute('DELETE FROM outputs WHERE stage=? AND key=?', (stage, key))
+        if remove_files:
+            for row in evict:
+                for path, _, _ in json.loads(row[2]):
+                    if os.path.exists(path):
+                        print('evicting {}'.format(path))
+                        os.remove(path)
+        return len(evict)
+
+    def close(self):
+        self.conn.close()
+
+def file_signature(path):
+    '''returns the [path, size, mtime] signature of a file'''
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def input_signature(item):
+    '''returns the [basename, size, mtime] of an input file, or the item itself if it isn't a file'''
+    if isinstance(item, str) and os.path.isfile(item):
+        stat = os.stat(item)
+        return [os.path.basename(item), stat.st_size, stat.st_mtime_ns]
+    return item
+
+def text_hash(text):
+    '''returns a short hash of a string, eg a wkt polygon'''
+    return hashlib.sha1(str(text).encode('utf-8')).hexdigest()
+
+def parse_params(param_list):
+    '''parses a list of key=value strings into a dict'''
+    params = {}
+    for item in param_list:
+        key, _, value = item.partition('=')
+        params[key] = value
+    return params
+
+def main(db, action, stage=False, inputs=[], params=[], outputs=[], max_age=False, max_size=False):
+    '''cli entry point. lookup exits with 0 & prints the outputs on a hit, 1 on a miss'''
+    cache = Cache(db)
+    if action == 'evict':
+        max_bytes = False if max_size is False else max_size * 1024 ** 3
+        count = cache.evict(max_age, max_bytes, [stage] if stage else False)
+        print('evicted {} entries'.format(count))
+        return 0
+    key = cache.key(stage, inputs, parse_params(params))
+    if action == 'lookup':
+        found = cache.lookup(stage, key)
+        if found is None:
+            return 1
+        print('\n'.join(found))
+        return 0
+    cache.store(stage, key, outputs)
+    return 0
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Query & maintain the pipeline output cache")
+    parse.add_argument("--db", required=True, help="cache database, or the workdir holding it")
+    parse.add_argument("--action", required=True, choices=['lookup', 'store', 'evict'], help="cache action")
+    parse.add_argument("--stage", required=False, default=False, help="pipeline stage name")
+    parse.add_argument("--inputs", required=False, nargs='*', default=[], help="stage input files or ids")
+    parse.add_argument("--params", required=False, nargs='*', default=[], help="stage parameters as key=value")
+    parse.add_argument("--outputs", required=False, nargs='*', default=[], help="stage output files to store")
+    parse.add_argument("--max_age", required=False, default=False, type=float, help="evict entries unused for this many days")
+    parse.add_argument("--max_size", required=False, default=False, type=float, help="evict least recently used entries until under this many GB")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    sys.exit(main(args.db, args.action, stage=args.stage, inputs=args.inputs, params=args.params,
+                  outputs=args.outputs, max_age=args.max_age, max_size=args.max_size))
@@ -4,77 +4,272 @@
 
 import os
 import re
+import sys
 import gc
 import shutil
 import argparse
 import zipfile
+import traceback
+import cache
+import safe
+import tracing
+import workers as worker_pool
 import fiona
 import shapely.geometry
-import snappy
-from snappy import ProductIO
-from snappy import HashMap
-from snappy import GPF
+try:
+    import snappy
+    from snappy import ProductIO
+    from snappy import HashMap
+    from snappy import GPF
+except ImportError:
+    snappy = None # only the numpy engine is available
+try:
+    import cog
+except ImportError:
+    cog = None # SNAP outputs are left as written
+try:
+    import calibrate_numpy
+except ImportError:
+    calibrate_numpy = None # only the snap engine is available
 
 allowed_polarizations = ['HH', 'HV', 'VH', 'VV']
+allowed_engines = ['snap', 'numpy']
+_operators_loaded = False # the GPF operator registry only needs loading once per JVM
 
 def main(infolder=False, outfolder=False, polarization=False, basename=False,
-         wktstring=False, shapefile=False, pixel_spacing=100, db=False, cleanup=False, unzip=False):
-    '''main loop for generating calibration products. infolder can be a folder of .SAF/zip files or a .SAFE/zip file'''
+         wktstring=False, shapefile=False, pixel_spacing=100, db=False, cleanup=False, unzip=False,
+         workers=1, worker_mem=False, debug=False, engine='snap', cache_db=False, daemon=False, multilook=True,
+         dem=False):
+    '''main loop for generating calibration products. infolder can be a folder of .SAF/zip files or a .SAFE/zip file.
+       returns a list of (product, polarization, error) tuples for any products that failed to calibrate.
+       debug writes the intermediate calibrated & subset products to the outfolder. engine is either snap, or numpy
+       to calibrate without SNAP. cache_db skips products already calibrated with the same parameters. daemon is the
+       address of a running snap_daemon.py to submit the products to instead of starting SNAP here. multilook averages
+       the calibrated power over the whole native pixels within the pixel_spacing, before terrain correction. dem is a
+       GDAL readable DEM (eg a VRT of tiles) used for terrain correction, with a cache_db the numpy engine caches its
+       crop over the AOI'''
     print('--------------------------------\nRunning Extraction and Calibration over:{}'.format(infolder))
     if shapefile:
         wktstring = get_wkt_from_shapefile(shapefile)
     if db:
         print('output products will be generated in decibels.')
-    infolder = unzip_check(infolder, cleanup) # unzip if required
+    if daemon:
+        return calibrate_daemon(get_product_paths(infolder, polarization), outfolder, polarization, basename,
+                                wktstring, pixel_spacing, db, cleanup, debug, unzip, cache_db, daemon, multilook, dem)
+    check_engine(engine)
+    if workers > 1:
+        return calibrate_parallel(get_product_paths(infolder, polarization), outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup,
+                                  workers, worker_mem, debug, unzip, engine, cache_db, multilook, dem)
+    infolder = unzip_check(infolder, cleanup, polarization, unzip) # selectively extract if required
     # determine if we need to walk the dir
     if infolder is False or not os.path.exists(infolder):
         raise Exception('must provide valid input path.')
     if contains_valid_product(infolder, polarization):
         # process the file
-        calibrate_file(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup)
+        calibrate_file(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup, debug=debug, engine=engine, cache_db=cache_db, multilook=multilook, dem=dem)
     elif os.path.isdir(infolder):
         #see if we can process any subfolders
         for item in os.listdir(infolder):
             folder_path = os.path.join(infolder, item)
-            subfolder = unzip_check(folder_path, cleanup)
+            subfolder = unzip_check(folder_path, cleanup, polarization, unzip)
             if contains_valid_product(subfolder, polarization):
-                calibrate_file(subfolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup)
+                calibrate_file(subfolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup, debug=debug, engine=engine, cache_db=cache_db, multilook=multilook, dem=dem)
+    return []
 
-def unzip_check(path, cleanup):
-    '''checks the path to see if it's a valid zip file. If true, will unzip and return path to new folder.
-       if False, will return the path.'''
-    if path.lower().endswith('zip') and zipfile.is_zipfile(path):
-        # extract the file
+def calibrate_parallel(paths, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup, workers, worker_mem, debug=False, unzip=False, engine='snap', cache_db=False, multilook=True, dem=False):
+    '''spreads the products (and their polarizations) in paths over a pool of worker processes. Each worker
+       is spawned fresh so it starts its own SNAP JVM, capped at worker_mem (eg '8G') if given. Failed
+       products, including those whose worker died, are reported and skipped, returns a list of
+       (product, polarization, error) tuples.'''
+    if worker_mem:
+        # picked up by each worker's JVM at startup, overriding the java_max_mem from snappy.ini
+        os.environ['_JAVA_OPTIONS'] = '-Xmx{}'.format(worker_mem)
+    print('Calibrating {} candidate products over {} workers...'.format(len(paths), workers))
+    failed = []
+    with worker_pool.Pool(workers) as pool:
+        # extract archives first (if requested), so polarizations of the same product never race on the same zip
+        jobs = []
+        products = []
+        for job, result, error in pool.imap_unordered(_unzip_job, [(path, cleanup, polarization, unzip) for path in paths]):
+            path, product, error = result if error is None else (job[0], None, str(error))
+            if error is not None:
+                failed.append((path, None, error))
+                continue
+            pols = [pol for pol in get_polarizations(polarization) if contains_valid_product(product, pol)]
+            if not pols:
+                continue
+            products.append(product)
+            for pol in pols:
+                jobs.append((product, outfolder, pol, basename, wktstring, pixel_spacing, db, cleanup, debug, engine, cache_db, multilook, dem))
+        done = 0
+        for job, result, error in pool.imap_unordered(_calibrate_job, jobs):
+            # a worker that died (eg a JVM crash or OOM kill) fails its job only, the pool replaces it
+            product, pol, error = result if error is None else (job[0], job[2], str(error))
+            done += 1
+            if error is None:
+                print('[{}/{}] finished {} {}'.format(done, len(jobs), os.path.basename(product), pol))
+            else:
+                print('[{}/{}] FAILED {} {}:\n{}'.format(done, len(jobs), os.path.basename(product), pol, error))
+                failed.append((product, pol, error))
+    if cleanup:
+        # only remove inputs once every polarization of the product has been written
+        failed_products = set([item[0] for item in failed])
+        for product in products:
+            if not product in failed_products:
+                remove_product(product)
+    if failed:
+        print('--------------------------\n{} of {} jobs failed:'.format(len(failed), len(jobs)))
+        for product, pol, _ in failed:
+            print('    {} {}'.format(product, pol if pol else '(extraction)'))
+    return failed
+
+def get_product_paths(infolder, polarization):
+    '''returns the input product, or the candidate products in the input folder'''
+    if infolder is False or not os.path.exists(infolder):
+        raise Exception('must provide valid input path.')
+    if os.path.isdir(infolder) and not contains_valid_product(infolder, polarization):
+        return [os.path.join(infolder, item) for item in sorted(os.listdir(infolder))]
+    return [infolder]
+
+def calibrate_daemon(paths, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup, debug, unzip, cache_db, daemon, multilook=True, dem=False):
+    '''submits the products in paths to the SNAP daemon at the given address one by one, returns a list of
+       (product, polarization, error) tuples for the products that failed'''
+    import snap_daemon
+    if daemon is True:
+        daemon = snap_daemon.DEFAULT_ADDRESS
+    if outfolder is False:
+        outfolder = os.path.join(os.getcwd(), 's1_preprocessed')
+    failed = []
+    for path in paths:
+        if not (safe.is_zip_product(path) or contains_valid_product(path, polarization)):
+            continue
+        print('submitting {} to the SNAP daemon at {}'.format(os.path.basename(path), daemon))
+        job = {'path': os.path.abspath(path), 'outfolder': os.path.abspath(outfolder), 'polarization': polarization,
+               'basename': basename, 'wktstring': wktstring, 'pixel_spacing': pixel_spacing, 'db': db,
+               'cleanup': cleanup, 'debug': debug, 'unzip': unzip,
+               'cache_db': os.path.abspath(cache_db) if cache_db else cache_db, 'multilook': multilook,
+               'dem': os.path.abspath(dem) if dem and os.path.exists(dem) else dem}
+        error = snap_daemon.submit(daemon, {'action': 'calibrate', 'job': job}).get('error')
+        if error is not None:
+            print('FAILED {}:\n{}'.format(path, error))
+            failed.append((path, polarization, error))
+    return failed
+
+def _unzip_job(args):
+    '''pool worker: extracts a single product, returns (path, product path, error string)'''
+    path, cleanup, polarization, unzip = args
+    try:
+        return path, unzip_check(path, cleanup, polarization, unzip), None
+    except Exception:
+        return path, None, traceback.format_exc()
+
+def _calibrate_job(args):
+    '''pool worker: calibrates a single product/polarization, returns (product, polarization, error string)'''
+    product, outfolder, pol, basename, wktstring, pixel_spacing, db, cleanup, debug, engine, cache_db, multilook, dem = args
+    try:
+        with tracing.profile('calibrate.{}.{}'.format(safe.get_product_basename(product), pol)):
+            calibrate_file(product, outfolder, pol, basename, wktstring, pixel_spacing, db, cleanup, keep_input=True, debug=debug, engine=engine, cache_db=cache_db, multilook=multilook, dem=dem)
+    except Exception:
+        return product, pol, traceback.format_exc()
+    return product, pol, None
+
+def check_engine(engine):
+    '''raises an exception if the calibration engine is unknown or its modules are not installed'''
+    if not engine in allowed_engines:
+        raise Exception('unknown engine: {}, must be one of {}'.format(engine, allowed_engines))
+    if engine == 'snap' and snappy is None:
+        raise Exception('snappy is not installed, use the numpy engine.')
+    if engine == 'numpy' and calibrate_numpy is None:
+        raise Exception('numpy & gdal are required for the numpy engine.')
+
+def get_polarizations(polarization):
+    '''returns the list of polarizations to process'''
+    if polarization is False:
+        return list(allowed_polarizations)
+    return [polarization]
+
+def unzip_check(path, cleanup, polarization=False, unzip=False):
+    '''checks the path to see if it's a valid zip file. SNAP reads the zip in place, so it is returned as is
+       unless unzip is set, in which case only the files needed to calibrate the given polarization are
+       extracted and the path to the new .SAFE folder is returned. with cleanup the zip is removed once nothing
+       needed by another polarization is left in it. if not a zip file, will return the path.'''
+    if safe.is_zip_product(path):
+        if not unzip:
+            return path
         filename = os.path.basename(path)
         base = os.path.splitext(filename)[0] + '.SAFE'
         folder = os.path.dirname(path)
         output_path = os.path.join(folder, base)
-        if os.path.exists(output_path):
-            return output_path # don't extract if the folder already exists
-        print('extracting {}...'.format(filename))
         with zipfile.ZipFile(path,"r") as zip_ref:
-            zip_ref.extractall(folder)
-        if cleanup:
+            namelist = zip_ref.namelist()
+            required = get_required_members(namelist, polarization)
+            # the other polarizations of a dual pol product are still read from the zip
+            complete = set(required) == set(get_required_members(namelist))
+            members = [name for name in required if not os.path.exists(os.path.join(folder, name))]
+            if members:
+                print('extracting {} files from {}...'.format(len(members), filename))
+                with tracing.span('extract', granule=filename, files=len(members)):
+                    for member in members:
+                        zip_ref.extract(member, folder)
+        if cleanup and complete:
             os.remove(path)
         return output_path
     return path
 
+def get_required_members(namelist, polarization=False):
+    '''filters a .SAFE zip listing to the manifest, support schemas, and the annotation, calibration & measurement
+       files for the given polarization, skipping the previews, quick-looks & other polarizations'''
+    members = []
+    for name in namelist:
+        parts = name.split('/')
+        if name.endswith('/') or len(parts) < 2:
+            continue
+        subdir = parts[1]
+        fil = parts[-1].lower()
+        if subdir == 'manifest.safe' or subdir == 'support':
+            members.append(name)
+        elif subdir in ('annotation', 'measurement'):
+            if fil.endswith('.xml') or fil.endswith('.tiff'):
+                if not polarization or '-{}-'.format(polarization.lower()) in fil:
+                    members.append(name)
+    return members
+
 def contains_valid_product(path, polarization):
-    '''checks to see if the given directory contains a valid .tiff GRD file with the optional polarization'''
-    if not os.path.isdir(path):
-        return False
-    meas_dir = os.path.join(path, 'measurement')
-    if not 'measurement' in os.listdir(path) or not os.path.isdir(meas_dir):
-        return False
+    '''checks to see if the given directory or zip file contains a valid .tiff GRD file with the optional polarization'''
     regex = 's1.*-grd-.*.tiff'
     if polarization:
         regex = 's1.*-grd-{}-.*.tiff'.format(polarization.lower())
-    for fil in os.listdir(meas_dir):
+    if safe.is_zip_product(path):
+        # check the archive listing without extracting anything
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            names = [name.split('/') for name in zip_ref.namelist()]
+        listing = [parts[-1] for parts in names if len(parts) > 2 and parts[-2] == 'measurement']
+    else:
+        if not os.path.isdir(path):
+            return False
+        meas_dir = os.path.join(path, 'measurement')
+        if not 'measurement' in os.listdir(path) or not os.path.isdir(meas_dir):
+            return False
+        listing = os.listdir(meas_dir)
+    for fil in listing:
         print('checking {}'.format(fil))
         if bool(re.search(regex, fil.lower())):
             return True
     return False
 
+def get_product_path(path):
+    '''returns the path SNAP should read for the product, either the zip file or the manifest in the .SAFE folder'''
+    if safe.is_zip_product(path):
+        return path
+    return os.path.join(path, "manifest.safe")
+
+def remove_product(path):
+    '''removes the input product, either a .SAFE folder or a zip file'''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
 def get_wkt_from_shapefile(shapefile_path):
     '''returns the wkt string from the input shapefile'''
     if not os.path.exists(shapefile_path):
@@ -83,24 +278,32 @@ def get_wkt_from_shapefile(shapefile_path):
     collection = [ shapely.geometry.shape(item['geometry']) for item in c ]
     return [j.wkt for j in collection][0]
 
-def calibrate_file(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup):
-    '''calibrate input product'''
+def calibrate_file(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, cleanup, keep_input=False, debug=False, engine='snap', cache_db=False, multilook=True, dem=False):
+    '''calibrate input product as a single in-memory Subset -> Calibration -> Terrain-Correction graph, only the
+       final GeoTIFF is written. debug writes the intermediate products as well. if keep_input is set, cleanup
+       only removes the intermediate products. the numpy engine calibrates without SNAP. if cache_db is given,
+       polarizations already calibrated with the same parameters are skipped. SNAP reads the product once for all
+       polarizations, and polarization False calibrates every polarization in the product. dem replaces SNAP's
+       GETASSE30 (or the ellipsoid, for the numpy engine) in the terrain correction.'''
     print('--------------------------\nCalibrating product: {}'.format(infolder))
     if outfolder is False:
         outfolder = os.path.join(os.getcwd(), 's1_preprocessed')
     if not os.path.exists(outfolder):
         os.makedirs(outfolder)
-    assert polarization in allowed_polarizations
+    assert polarization is False or polarization in allowed_polarizations
     if polarization is False:
-        polarization = ['HH', 'HV', 'VH', 'VV']
+        polarization = [pol for pol in allowed_polarizations if contains_valid_product(infolder, pol)]
     else:
         polarization = [polarization]
     if wktstring is False:
         wktstring = 'POLYGON ((-94.3242680177268 -68.1554115901846,-94.4799907148995 -78.0386897518533,-133.488922458484 -75.1093782424761,-116.988045118527 -66.0302485803105,-94.3242680177268 -68.1554115901846))'
 
-    GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
-    HashMap = snappy.jpy.get_type('java.util.HashMap')
-    gc.enable()
+    if engine == 'snap':
+        load_operators()
+    sentinel_1 = None # read on first use, then shared by every polarization
+    store = None
+    if cache_db:
+        store = cache.Cache(cache_db)
 
     # build folder paths
     folder = os.path.basename(infolder)
@@ -108,56 +311,166 @@ def calibrate_file(infolder, outfolder, polarization, basename, wktstring, pixel
 
         if basename is False:
             print("folder: {}".format(folder))
-            basename = os.path.basename(folder).rstrip('.SAFE')
+            basename = safe.get_product_basename(infolder)
         calib = os.path.join(outfolder, '{}.{}.{}.calibrated'.format(basename, pol, pixel_spacing)) 
         subset = os.path.join(outfolder, '{}.{}.{}.subset'.format(basename, pol, pixel_spacing))
         terrain = os.path.join(outfolder, '{}.{}.{}.corrected'.format(basename, pol, pixel_spacing))
- 
-        # read product
-        sentinel_1 = ProductIO.readProduct(os.path.join(infolder, "manifest.safe"))   
-
-        ### CALIBRATION
-        parameters = HashMap() 
-        parameters.put('outputSigmaBand', True) 
-        parameters.put('sourceBands', 'Intensity_' + pol) 
-        parameters.put('selectedPolarisations', pol) 
-        parameters.put('outputImageScaleInDb', db)  
-        print('Applying radiometric correction: {}'.format(calib))
-        target_0 = GPF.createProduct("Calibration", parameters, sentinel_1) 
-        ProductIO.writeProduct(target_0, calib, 'BEAM-DIMAP')
-        
-        ### SUBSET
-        calibration = ProductIO.readProduct(calib + ".dim")    
-        WKTReader = snappy.jpy.get_type('com.vividsolutions.jts.io.WKTReader')        
-        geom = WKTReader().read(wktstring)
+
+        if store is not None:
+            # keyed on the granule rather than the input path, so a zip and its .SAFE folder are the same product
+            params = {'polarization': pol, 'pixel_spacing': pixel_spacing, 'wkt': cache.text_hash(wktstring),
+                      'db': db, 'engine': engine, 'output': terrain, 'multilook': multilook,
+                      'dem': dem}
+            key = store.key('calibrate', [safe.get_product_basename(infolder)], params)
+            if store.lookup('calibrate', key) is not None:
+                print('{} is unchanged, skipping.'.format(terrain))
+                continue
+
+        if engine == 'numpy':
+            # the cache also holds the per track geocoding of the numpy engine
+            calibrate_numpy.calibrate_product(infolder, outfolder, pol, basename, wktstring, pixel_spacing, db, debug,
+                                              geocode_cache=cache_db, dem=dem, multilook=multilook)
+        else:
+            if sentinel_1 is None:
+                with tracing.span('read', granule=safe.get_product_basename(infolder)):
+                    sentinel_1 = ProductIO.readProduct(get_product_path(infolder))
+                looks = get_looks(sentinel_1, pixel_spacing) if multilook else (1, 1)
+            calibrate_snap(sentinel_1, infolder, pol, wktstring, pixel_spacing, db, debug, cleanup, calib, subset, terrain, looks, dem)
+        if store is not None:
+            store.store('calibrate', key, [terrain + '.tif'])
+    if sentinel_1 is not None:
+        sentinel_1.dispose()
+    if store is not None:
+        store.close()
+    if cleanup and not keep_input:
+        remove_product(infolder)
+
+def load_operators():
+    '''loads the GPF operators into the registry, once per process'''
+    global _operators_loaded
+    if not _operators_loaded:
+        GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+        gc.enable()
+        _operators_loaded = True
+
+def get_looks(sentinel_1, pixel_spacing):
+    '''returns the multilook factors of the opened product, from the native spacing in its abstracted metadata'''
+    meta = sentinel_1.getMetadataRoot().getElement('Abstracted_Metadata')
+    return safe.get_looks(meta.getAttributeDouble('azimuth_spacing'), meta.getAttributeDouble('range_spacing'), pixel_spacing)
+
+def calibrate_snap(sentinel_1, infolder, pol, wktstring, pixel_spacing, db, debug, cleanup, calib, subset, terrain, looks=(1, 1), dem=False):
+    '''runs the SNAP graph over the opened product for a single polarization, writing the terrain corrected GeoTIFF.
+       with more than one (azimuth, range) look, sigma0 is multilooked in linear power and only then scaled to dB.
+       dem is an external DEM file used in place of GETASSE30'''
+    HashMap = snappy.jpy.get_type('java.util.HashMap')
+    granule = safe.get_product_basename(infolder)
+    WKTReader = snappy.jpy.get_type('com.vividsolutions.jts.io.WKTReader')        
+    geom = WKTReader().read(wktstring)
+
+    if debug:
+        # write every intermediate product to disk
+        target_1 = calibrate_subset_debug(sentinel_1, pol, geom, db and looks == (1, 1), calib, subset)
+    else:
+        target_1 = calibrate_subset(sentinel_1, pol, geom, db and looks == (1, 1))
+    if looks != (1, 1):
+        target_1 = multilook(target_1, pol, looks, db)
+
+    ### TERRAIN CORRECTION
+    parameters = HashMap()     
+    parameters.put('demResamplingMethod', 'NEAREST_NEIGHBOUR') 
+    parameters.put('imgResamplingMethod', 'NEAREST_NEIGHBOUR') 
+    if dem:
+        parameters.put('demName', 'External DEM')
+        parameters.put('externalDEMFile', snappy.jpy.get_type('java.io.File')(os.path.abspath(dem)))
+        parameters.put('externalDEMNoDataValue', 0.0)
+    else:
+        parameters.put('demName', 'GETASSE30')
+    parameters.put('pixelSpacingInMeter', pixel_spacing) 
+    parameters.put('sourceBands', get_sigma_band(target_1, pol))
+    print('Applying terrain correction: {}'.format(terrain)) 
+    target_2 = GPF.createProduct("Terrain-Correction", parameters, target_1) 
+    # the operators are lazy, Subset & Calibration (unless debugging) are computed as Terrain-Correction is written
+    with tracing.span('Terrain-Correction', granule=granule, pol=pol, engine='snap'):
+        ProductIO.writeProduct(target_2, terrain, 'GeoTIFF')
+    if cog is not None:
+        # SNAP writes striped, uncompressed GeoTIFFs
+        cog.to_cog(terrain + '.tif')
+    
+    del target_1
+    del target_2
+    if debug and cleanup is True:
+        os.remove(calib + '.dim')
+        os.remove(subset + '.dim')
+        shutil.rmtree(subset + '.data')
+        shutil.rmtree(calib + '.data')
+
+def multilook(product, pol, looks, db):
+    '''averages the linear sigma0 band over the (azimuth, range) looks, then converts it to dB if db is set'''
+    parameters = HashMap()
+    parameters.put('sourceBands', 'Sigma0_' + pol)
+    parameters.put('nAzLooks', looks[0])
+    parameters.put('nRgLooks', looks[1])
+    parameters.put('outputIntensity', True)
+    parameters.put('grSquarePixel', False)
+    print('Multilooking {} by {}x{} looks'.format(pol, looks[0], looks[1]))
+    target = GPF.createProduct("Multilook", parameters, product)
+    if db:
         parameters = HashMap()
-        parameters.put('geoRegion', geom)
-        parameters.put('outputImageScaleInDb', db)
-        print('Generating subset file: {}'.format(subset))
-        target_1 = GPF.createProduct("Subset", parameters, calibration)
-        ProductIO.writeProduct(target_1, subset, 'BEAM-DIMAP')
-        
-        ### TERRAIN CORRECTION
-        parameters = HashMap()     
-        parameters.put('demResamplingMethod', 'NEAREST_NEIGHBOUR') 
-        parameters.put('imgResamplingMethod', 'NEAREST_NEIGHBOUR') 
-        parameters.put('demName', 'GETASSE30') 
-        parameters.put('pixelSpacingInMeter', pixel_spacing) 
         parameters.put('sourceBands', 'Sigma0_' + pol)
-        print('Applying terrain correction: {}'.format(terrain)) 
-        target_2 = GPF.createProduct("Terrain-Correction", parameters, target_1) 
-        ProductIO.writeProduct(target_2, terrain, 'GeoTIFF')
-        
-        del target_0
-        del target_1
-        del target_2
-        if cleanup is True:
-            os.remove(calib + '.dim')
-            os.remove(subset + '.dim')
-            shutil.rmtree(subset + '.data')
-            shutil.rmtree(calib + '.data')
-    if cleanup:
-        shutil.rmtree(infolder)
+        target = GPF.createProduct("LinearToFromdB", parameters, target)
+    return target
+
+def get_sigma_band(product, pol):
+    '''returns the name of the sigma0 band of the polarization, eg Sigma0_HH or Sigma0_HH_db'''
+    for name in product.getBandNames():
+        if name.startswith('Sigma0_' + pol):
+            return name
+    return 'Sigma0_' + pol
+
+def calibrate_subset(sentinel_1, pol, geom, db):
+    '''chains Subset -> Calibration as in-memory operators, nothing is computed until the graph is written.
+       subsetting first means calibration only touches the AOI pixels.'''
+    ### SUBSET
+    parameters = HashMap()
+    parameters.put('geoRegion', geom)
+    parameters.put('sourceBands', 'Amplitude_{0},Intensity_{0}'.format(pol))
+    parameters.put('copyMetadata', True) # calibration needs the original metadata
+    print('Subsetting {} to the region of interest'.format(pol))
+    target_0 = GPF.createProduct("Subset", parameters, sentinel_1)
+
+    ### CALIBRATION
+    parameters = HashMap() 
+    parameters.put('outputSigmaBand', True) 
+    parameters.put('sourceBands', 'Intensity_' + pol) 
+    parameters.put('selectedPolarisations', pol) 
+    parameters.put('outputImageScaleInDb', db)  
+    print('Applying radiometric correction to {} subset'.format(pol))
+    return GPF.createProduct("Calibration", parameters, target_0) 
+
+def calibrate_subset_debug(sentinel_1, pol, geom, db, calib, subset):
+    '''runs Calibration -> Subset, writing each intermediate product to BEAM-DIMAP for inspection'''
+    ### CALIBRATION
+    parameters = HashMap() 
+    parameters.put('outputSigmaBand', True) 
+    parameters.put('sourceBands', 'Intensity_' + pol) 
+    parameters.put('selectedPolarisations', pol) 
+    parameters.put('outputImageScaleInDb', db)  
+    print('Applying radiometric correction: {}'.format(calib))
+    target_0 = GPF.createProduct("Calibration", parameters, sentinel_1) 
+    with tracing.span('Calibration', output=calib, engine='snap'):
+        ProductIO.writeProduct(target_0, calib, 'BEAM-DIMAP')
+    del target_0
+    
+    ### SUBSET
+    calibration = ProductIO.readProduct(calib + ".dim")    
+    parameters = HashMap()
+    parameters.put('geoRegion', geom)
+    parameters.put('outputImageScaleInDb', db)
+    print('Generating subset file: {}'.format(subset))
+    target_1 = GPF.createProduct("Subset", parameters, calibration)
+    with tracing.span('Subset', output=subset, engine='snap'):
+        ProductIO.writeProduct(target_1, subset, 'BEAM-DIMAP')
+    return target_1
 
 def parser():
     '''
@@ -172,12 +485,28 @@ def parser():
     parse.add_argument("--shapefile", required=False, default=False, help="shapefile for bounds")
     parse.add_argument("--pixel_spacing", required=False, default=100, type=float, help="Pixel spacing in meters")
     parse.add_argument("--in_decibels", action="store_true", help="output is scaled in decibels")
-    parse.add_argument("--unzip", action="store_true", help="will extract zipped files")
+    parse.add_argument("--unzip", action="store_true", help="will extract the files needed for the polarization from zipped products, otherwise they are read in place")
     parse.add_argument("--cleanup", action="store_true", help="cleanup intermediate files")
+    parse.add_argument("--workers", required=False, default=1, type=int, help="number of products to calibrate in parallel, each with its own SNAP JVM")
+    parse.add_argument("--engine", required=False, default='snap', choices=allowed_engines, help="calibrate with SNAP, or natively with numpy")
+    parse.add_argument("--cache", required=False, default=False, help="cache database (or workdir) used to skip products that are already calibrated")
+    parse.add_argument("--debug", action="store_true", help="write the intermediate calibrated & subset products")
+    tracing.add_arguments(parse)
+    parse.add_argument("--dem", required=False, default=False, help="DEM (eg a VRT of local tiles) to terrain correct with")
+    parse.add_argument("--full_resolution", action="store_true", help="calibrate at the native resolution instead of multilooking to the pixel spacing")
+    parse.add_argument("--daemon", nargs='?', const=True, default=False, help="calibrate with a running snap_daemon.py, at its default socket or the given address (socket path or host:port)")
+    parse.add_argument("--worker_mem", required=False, default=False, help="max JVM heap per worker, eg 8G. Defaults to the snappy.ini setting")
     return parse
 
 if __name__ == '__main__':
     args = parser().parse_args()
-    main(infolder=args.infolder, outfolder=args.outfolder, polarization=args.polarization,
-          basename=args.basename, wktstring=args.wkt, shapefile=args.shapefile,
-          pixel_spacing=args.pixel_spacing, db=args.in_decibels, cleanup=args.cleanup, unzip=args.unzip)
+    tracing.configure(args.trace, args.profile)
+    with tracing.profile('calibrate'):
+        failed = main(infolder=args.infolder, outfolder=args.outfolder, polarization=args.polarization,
+              basename=args.basename, wktstring=args.wkt, shapefile=args.shapefile,
+              pixel_spacing=args.pixel_spacing, db=args.in_decibels, cleanup=args.cleanup, unzip=args.unzip,
+              workers=args.workers, worker_mem=args.worker_mem, debug=args.debug, engine=args.engine, cache_db=args.cache,
+              daemon=args.daemon, multilook=not args.full_resolution,
+              dem=args.dem)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Applies Radiometric Calibration to a single GRD product using NumPy, without SNAP or a JVM. Outputs are geocoded
+# to EPSG:4326 from the product GCPs so they can be used in place of the SNAP corrected products.
+
+import os
+import re
+import argparse
+import zipfile
+import xml.etree.ElementTree as ET
+import numpy as np
+from osgeo import gdal
+from osgeo import ogr
+import geocode as geocoding
+import cog
+import radiometric
+import safe
+import tracing
+
+gdal.UseExceptions()
+
+DEG_PER_METER = 1. / 111319.49079327357 # degrees of latitude per meter at the equator, as used by SNAP
+TILE_SIZE = 512 # block size of the tiled outputs
+MAX_MEM = 256 * 1024 * 1024 # max bytes of working arrays per block
+TOLERANCE = 0.5 # max median abs difference in dB from a reference (SNAP) product
+CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE={}'.format(TILE_SIZE), 'BLOCKYSIZE={}'.format(TILE_SIZE), 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+def main(infolder, outfolder=False, polarization='HH', basename=False, wktstring=False, pixel_spacing=100, db=False,
+         debug=False, reference=False, tolerance=TOLERANCE, geocode_cache=False, dem=False, validate=False, multilook=True):
+    '''calibrates the product, optionally comparing the result to a reference (SNAP) product'''
+    output = calibrate_product(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, debug,
+                               geocode_cache, dem, validate, multilook)
+    if reference:
+        stats = compare(output, reference, db)
+        print('median abs difference: {:.4f} dB, 95th percentile: {:.4f} dB over {} pixels'.format(
+            stats['median'], stats['p95'], stats['count']))
+        if stats['median'] > tolerance:
+            raise Exception('median difference {:.4f} dB exceeds tolerance of {} dB'.format(stats['median'], tolerance))
+    return output
+
+def calibrate_product(infolder, outfolder, polarization, basename, wktstring, pixel_spacing, db, debug=False,
+                      geocode_cache=False, dem=False, validate=False, multilook=True):
+    '''calibrates the polarization of the input .SAFE folder or zip to sigma0, subset to the wkt region and geocoded.
+       with a dem or a geocode_cache (and a wkt) the raster is terrain corrected through a lookup, see geocode.py,
+       which the cache keeps & reuses for the track. otherwise it is warped from the GCPs.
+       multilook averages the sigma0 power over the whole native pixels that fit in the pixel spacing before
+       geocoding. returns the path to the output GeoTIFF'''
+    print('--------------------------\nCalibrating product (numpy): {} {}'.format(infolder, polarization))
+    if dem and wktstring is False:
+        raise Exception('terrain correcting with a dem needs a wkt region for the output grid.')
+    if outfolder is False:
+        outfolder = os.path.join(os.getcwd(), 's1_preprocessed')
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    if basename is False:
+        basename = safe.get_product_basename(infolder)
+    calib = os.path.join(outfolder, '{}.{}.{}.calibrated.tif'.format(basename, polarization, pixel_spacing))
+    terrain = os.path.join(outfolder, '{}.{}.{}.corrected.tif'.format(basename, polarization, pixel_spacing))
+
+    with tracing.span('read', granule=basename, pol=polarization, engine='numpy'):
+        measurement, calibration_xml, annotation_xml = find_product_files(infolder, polarization)
+        lines, pixels, lut = radiometric.parse_calibration_lut(calibration_xml)
+        src = gdal.Open(measurement)
+    looks = get_looks(annotation_xml, pixel_spacing) if multilook else (1, 1)
+    with tracing.span('Subset', granule=basename, pol=polarization, engine='numpy'):
+        window = get_subset_window(src, wktstring)
+    print('Applying radiometric correction: {} ({}x{} looks)'.format(calib, looks[0], looks[1]))
+    with tracing.span('Calibration', granule=basename, pol=polarization, engine='numpy', window=window, looks=looks):
+        calibrate_window(src, window, lines, pixels, lut, db, calib, looks)
+    src = None
+    print('Geocoding: {}'.format(terrain))
+    with tracing.span('Terrain-Correction', granule=basename, pol=polarization, engine='numpy',
+                      cached=bool(geocode_cache)):
+        if (geocode_cache or dem) and wktstring is not False:
+            geocoding.terrain_correct(calib, terrain, annotation_xml, window[0], infolder, wktstring, pixel_spacing,
+                                      pixel_spacing * DEG_PER_METER, geocode_cache, dem, validate=validate, looks=looks)
+        else:
+            geocode(calib, terrain, wktstring, pixel_spacing)
+    cog.to_cog(terrain)
+    if not debug:
+        os.remove(calib)
+    return terrain
+
+def find_product_files(path, polarization):
+    '''returns a GDAL readable path to the measurement tiff, and the parsed calibration & annotation xml for the
+       polarization. zip files are read in place.'''
+    pol = polarization.lower()
+    names = list_product(path)
+    meas = match_one(names, 'measurement/s1.*-grd-{}-.*.tiff$'.format(pol), path)
+    calib = match_one(names, 'annotation/calibration/calibration-s1.*-grd-{}-.*.xml$'.format(pol), path)
+    annot = match_one(names, 'annotation/s1.*-grd-{}-.*.xml$'.format(pol), path)
+    if safe.is_zip_product(path):
+        meas_path = '/vsizip/{}/{}'.format(os.path.abspath(path), meas)
+    else:
+        meas_path = os.path.join(path, meas)
+    return meas_path, ET.fromstring(read_member(path, calib)), ET.fromstring(read_member(path, annot))
+
+def list_product(path):
+    '''returns the relative paths of every file in the .SAFE folder or zip'''
+    if safe.is_zip_product(path):
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            return zip_ref.namelist()
+    names = []
+    for dirpath, _, files in os.walk(path):
+        names.extend([os.path.relpath(os.path.join(dirpath, fil), path).replace(os.sep, '/') for fil in files])
+    return names
+
+def read_member(path, name):
+    '''returns the contents of a file in the .SAFE folder or zip'''
+    if safe.is_zip_product(path):
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            return zip_ref.read(name)
+    with open(os.path.join(path, name), 'rb') as fin:
+        return fin.read()
+
+def match_one(names, regex, path):
+    '''returns the first name matching the regex'''
+    for name in sorted(names):
+        if re.search(regex, name.lower()):
+            return name
+    raise Exception('unable to find a file matching {} in {}'.format(regex, path))
+
+def get_looks(annotation, pixel_spacing):
+    '''returns the multilook factors of the product, from the native spacing in its annotation'''
+    info = annotation.find('.//imageAnnotation/imageInformation')
+    return safe.get_looks(float(info.find('azimuthPixelSpacing').text), float(info.find('rangePixelSpacing').text), pixel_spacing)
+
+def get_subset_window(src, wktstring):
+    '''returns the (xoff, yoff, xsize, ysize) window of the raster that covers the bounding box of the wkt region,
+       located through the GCPs of the product'''
+    xsize, ysize = src.RasterXSize, src.RasterYSize
+    if wktstring is False:
+        return 0, 0, xsize, ysize
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(wktstring).GetEnvelope()
+    # densify the envelope edges, the image -> map mapping is not linear
+    steps = np.linspace(0., 1., 32)
+    lons = np.concatenate([minx + (maxx - minx) * steps, np.full(32, maxx), maxx - (maxx - minx) * steps, np.full(32, minx)])
+    lats = np.concatenate([np.full(32, miny), miny + (maxy - miny) * steps, np.full(32, maxy), maxy - (maxy - miny) * steps])
+    transformer = gdal.Transformer(src, None, ['METHOD=GCP_TPS'])
+    points, success = transformer.TransformPoints(1, list(zip(lons.tolist(), lats.tolist())))
+    points = np.array([pt for pt, ok in zip(points, success) if ok])
+    if points.size == 0:
+        raise Exception('unable to locate the region of interest in the product')
+    x0 = int(max(0, np.floor(points[:, 0].min())))
+    y0 = int(max(0, np.floor(points[:, 1].min())))
+    x1 = int(min(xsize, np.ceil(points[:, 0].max()) + 1))
+    y1 = int(min(ysize, np.ceil(points[:, 1].max()) + 1))
+    if x1 <= x0 or y1 <= y0:
+        raise Exception('product does not intersect the region of interest')
+    return x0, y0, x1 - x0, y1 - y0
+
+def calibrate_window(src, window, lines, pixels, lut, db, outpath, looks=(1, 1)):
+    '''calibrates the window of the measurement raster block by block into a tiled GeoTIFF carrying the shifted GCPs.
+       multilooking by (azimuth, range) looks drops the partial looks at the far edges of the window'''
+    xoff, yoff, xsize, ysize = window
+    az, rg = looks
+    out_xsize, out_ysize = xsize // rg, ysize // az
+    if out_xsize == 0 or out_ysize == 0:
+        raise Exception('window {} is smaller than a single {}x{} look'.format(window, az, rg))
+    xsize, ysize = out_xsize * rg, out_ysize * az
+    interp = radiometric.LutInterpolator(lines, pixels, lut, xoff, xsize)
+    band = src.GetRasterBand(1)
+    # whole looks per block
+    block_rows = max(az, min(TILE_SIZE * az, int(MAX_MEM / (xsize * 4 * 6))) // az * az)
+    dst = gdal.GetDriverByName('GTiff').Create(outpath, out_xsize, out_ysize, 1, gdal.GDT_Float32, CREATION_OPTIONS)
+    gcps = []
+    for gcp in src.GetGCPs():
+        gcps.append(gdal.GCP(gcp.GCPX, gcp.GCPY, gcp.GCPZ, (gcp.GCPPixel - xoff) / rg, (gcp.GCPLine - yoff) / az))
+    dst.SetGCPs(gcps, src.GetGCPProjection())
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(0)
+    for row in range(0, ysize, block_rows):
+        nrows = min(block_rows, ysize - row)
+        dn = band.ReadAsArray(xoff, yoff + row, xsize, nrows)
+        dst_band.WriteArray(radiometric.calibrate_block(dn, interp.block(yoff + row, nrows), db, looks), 0, row // az)
+    dst_band.FlushCache()
+    dst = None
+
+def geocode(inpath, outpath, wktstring, pixel_spacing):
+    '''warps the calibrated raster from its GCPs onto an EPSG:4326 grid at the pixel spacing (in meters), cropped to the
+       bounding box of the wkt region'''
+    res = pixel_spacing * DEG_PER_METER
+    bounds = None
+    if wktstring is not False:
+        minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(wktstring).GetEnvelope()
+        bounds = (minx, miny, maxx, maxy)
+    options = gdal.WarpOptions(format='GTiff', dstSRS='EPSG:4326', outputBounds=bounds, xRes=res, yRes=res,
+                               resampleAlg='near', srcNodata=0, dstNodata=0, tps=True,
+                               multithread=True, warpMemoryLimit=MAX_MEM, creationOptions=CREATION_OPTIONS)
+    gdal.Warp(outpath, inpath, options=options)
+
+def compare(test_path, reference_path, db=False, resampling='near'):
+    '''compares a calibrated product against a reference product (eg from SNAP), resampling the reference onto the
+       test grid (average a finer reference rather than point sample its speckle). returns the count, median & 95th
+       percentile of the absolute difference in dB over pixels valid in both'''
+    test = gdal.Open(test_path)
+    gt = test.GetGeoTransform()
+    bounds = (gt[0], gt[3] + gt[5] * test.RasterYSize, gt[0] + gt[1] * test.RasterXSize, gt[3])
+    options = gdal.WarpOptions(format='VRT', dstSRS=test.GetProjection(), outputBounds=bounds,
+                               width=test.RasterXSize, height=test.RasterYSize, resampleAlg=resampling, dstNodata=0)
+    ref = gdal.Warp('', reference_path, options=options)
+    a = test.GetRasterBand(1).ReadAsArray().astype(np.float64)
+    b = ref.GetRasterBand(1).ReadAsArray().astype(np.float64)
+    valid = (a != 0) & (b != 0) & np.isfinite(a) & np.isfinite(b)
+    if not valid.any():
+        raise Exception('no overlapping valid pixels between {} and {}'.format(test_path, reference_path))
+    a, b = a[valid], b[valid]
+    if not db:
+        valid = (a > 0) & (b > 0)
+        a, b = 10. * np.log10(a[valid]), 10. * np.log10(b[valid])
+    diff = np.abs(a - b)
+    return {'count': int(diff.size), 'median': float(np.median(diff)), 'p95': float(np.percentile(diff, 95))}
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Apply radiometric calibration with NumPy")
+    parse.add_argument("--infolder", required=True, default=False, help="input S1 GRD .SAFE folder or zip")
+    parse.add_argument("--outfolder", required=False, default=False, help="output folder for calibrated products")
+    parse.add_argument("--polarization", required=False, default='HH', choices=['HH','VV','VH','HV'], help="polarization to process.")
+    parse.add_argument("--basename", required=False, default=False, help="base filename to use for output products")
+    parse.add_argument("--wkt", required=False, default=False, help="wkt polygon bounds")
+    parse.add_argument("--pixel_spacing", required=False, default=100, type=float, help="Pixel spacing in meters")
+    parse.add_argument("--in_decibels", action="store_true", help="output is scaled in decibels")
+    parse.add_argument("--debug", action="store_true", help="keep the intermediate calibrated product")
+    parse.add_argument("--reference", required=False, default=False, help="reference (SNAP) product to compare the output against")
+    parse.add_argument("--tolerance", required=False, default=TOLERANCE, type=float, help="max median abs difference in dB from the reference")
+    parse.add_argument("--geocode_cache", required=False, default=False, help="cache database (or workdir) holding the per track geocoding lookups")
+    parse.add_argument("--dem", required=False, default=False, help="DEM used for terrain correction, its crop over the AOI is cached with --geocode_cache")
+    parse.add_argument("--validate", action="store_true", help="compare cached geocoding against a full recompute")
+    parse.add_argument("--full_resolution", action="store_true", help="calibrate at the native resolution instead of multilooking to the pixel spacing")
+    tracing.add_arguments(parse)
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    tracing.configure(args.trace, args.profile)
+    with tracing.profile('calibrate_numpy'):
+        main(args.infolder, outfolder=args.outfolder, polarization=args.polarization, basename=args.basename,
+             wktstring=args.wkt, pixel_spacing=args.pixel_spacing, db=args.in_decibels, debug=args.debug,
+             reference=args.reference, tolerance=args.tolerance, geocode_cache=args.geocode_cache, dem=args.dem,
+             validate=args.validate, multilook=not args.full_resolution)
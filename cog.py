@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Cloud optimized GeoTIFF helpers. Stage outputs are rewritten as tiled, compressed GeoTIFFs with internal overviews,
+# so downstream reads of a small window or at a coarse output size only touch the tiles & overview they need.
+
+import os
+import argparse
+from osgeo import gdal
+import tracing
+
+gdal.UseExceptions()
+
+BLOCK_SIZE = 512
+COG_OPTIONS = ['COMPRESS=LZW', 'BLOCKSIZE={}'.format(BLOCK_SIZE), 'BIGTIFF=IF_SAFER', 'OVERVIEWS=AUTO', 'NUM_THREADS=ALL_CPUS']
+
+def to_cog(src, output=False, resampling='average'):
+    '''rewrites the raster (a path or dataset) as a COG with overviews built using the resampling. with no output the
+       src path is replaced in place. returns the output path'''
+    if output is False:
+        output = src
+    tmp = output + '.cog.tmp'
+    options = gdal.TranslateOptions(format='COG', creationOptions=COG_OPTIONS + ['OVERVIEW_RESAMPLING={}'.format(resampling.upper())])
+    with tracing.span('cog', output=os.path.basename(output)):
+        gdal.Translate(tmp, src, options=options)
+    os.rename(tmp, output)
+    return output
+
+def is_cog(path):
+    '''returns True if the raster is tiled with internal overviews'''
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    return band.GetBlockSize()[0] < ds.RasterXSize and band.GetOverviewCount() > 0
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Rewrites rasters as cloud optimized GeoTIFFs with overviews")
+    parse.add_argument("files", nargs='+', help="rasters to convert in place")
+    parse.add_argument("--resampling", required=False, default='average', help="overview resampling method")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    for path in args.files:
+        if is_cog(path):
+            print('{} is already tiled with overviews, skipping.'.format(path))
+            continue
+        print('converting {}'.format(path))
+        to_cog(path, resampling=args.resampling)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Stacks the merged date mosaics into a single chunked, compressed time x y x x Zarr cube on a fixed grid, with a
+# date coordinate and a validity mask. New dates are appended without rewriting the existing ones, dates whose
+# mosaic was re-merged replace their frame, and pixel or window time series are read from the few chunks that hold
+# them.
+
+import os
+import re
+import glob
+import argparse
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from osgeo import gdal
+from osgeo import osr
+
+gdal.UseExceptions()
+
+CHUNKS = (8, 256, 256) # (time, y, x) chunk shape, balancing frame reads against pixel time series reads
+COMPRESSOR = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+class Cube():
+    '''a time x y x x cube of byte frames on a fixed grid. frames are stored in the order they were appended, the
+       date accessors return them in date order.'''
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.group = zarr.open_group(path, mode=mode)
+        self.data = self.group['data']
+        self.mask = self.group['mask']
+
+    @classmethod
+    def create(cls, path, geotransform, width, height, epsg):
+        '''creates an empty cube over the grid'''
+        group = zarr.open_group(path, mode='w')
+        group.attrs.update({'geotransform': list(geotransform), 'epsg': epsg, 'dates': [], 'sources': [], 'signatures': []})
+        for name, dtype in [('data', 'u1'), ('mask', 'bool')]:
+            group.create_dataset(name, shape=(0, height, width), chunks=CHUNKS, dtype=dtype, fill_value=0,
+                                 compressor=COMPRESSOR)
+        return cls(path, mode='a')
+
+    @property
+    def geotransform(self):
+        return tuple(self.group.attrs['geotransform'])
+
+    @property
+    def epsg(self):
+        return self.group.attrs['epsg']
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dates(self):
+        '''returns the dates in date order'''
+        return sorted(self.group.attrs['dates'])
+
+    def order(self, start=None, end=None):
+        '''returns the time indices of the frames from start to end (inclusive YYYY-MM-DD strings) in date order'''
+        dates = self.group.attrs['dates']
+        indices = sorted(range(len(dates)), key=lambda i: dates[i])
+        return [i for i in indices if (start is None or dates[i] >= start) and (end is None or dates[i] <= end)]
+
+    def append(self, path, date, clip=False):
+        '''warps the raster onto the cube grid and appends it as a new frame, replacing the frame if the date exists.
+           the grid is fixed when the cube is created, so a raster extending past it raises unless clip is set'''
+        if not clip and not self.contains(path):
+            raise Exception('{} extends outside the {}x{} grid of {}, rebuild the cube to grow its grid or clip the '
+                            'date to it'.format(path, self.shape[2], self.shape[1], self.path))
+        data, mask = self.read_onto_grid(path)
+        dates = list(self.group.attrs['dates'])
+        sources = list(self.group.attrs['sources'])
+        signatures = self.signatures
+        if date in dates:
+            index = dates.index(date)
+            sources[index] = os.path.basename(path)
+            signatures[index] = get_signature(path)
+        else:
+            index = len(dates)
+            dates.append(date)
+            sources.append(os.path.basename(path))
+            signatures.append(get_signature(path))
+            self.data.resize((index + 1,) + self.data.shape[1:])
+            self.mask.resize((index + 1,) + self.mask.shape[1:])
+        self.data[index] = data
+        self.mask[index] = mask
+        # attrs last, so an interrupted append leaves the frame unlisted
+        self.group.attrs.update({'dates': dates, 'sources': sources, 'signatures': signatures})
+        return index
+
+    @property
+    def signatures(self):
+        '''returns the [size, mtime] of the source of each frame when it was appended, None if unknown'''
+        dates = self.group.attrs['dates']
+        signatures = list(self.group.attrs.get('signatures', []))
+        return signatures + [None] * (len(dates) - len(signatures))
+
+    def is_current(self, path, date):
+        '''returns True if the date's frame was appended from the raster as it is now'''
+        dates = self.group.attrs['dates']
+        if not date in dates:
+            return False
+        index = dates.index(date)
+        return (self.group.attrs['sources'][index] == os.path.basename(path) and
+                self.signatures[index] == get_signature(path))
+
+    def contains(self, path):
+        '''returns True if the raster lies within the cube grid, to within a cube pixel'''
+        gt = self.geotransform
+        height, width = self.shape[1:]
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(self.epsg)
+        minx, miny, maxx, maxy = get_bounds(path, srs)
+        tolerance = abs(gt[1])
+        return (minx >= gt[0] - tolerance and maxx <= gt[0] + gt[1] * width + tolerance and
+                miny >= gt[3] + gt[5] * height - tolerance and maxy <= gt[3] + tolerance)
+
+    def read_onto_grid(self, path):
+        '''returns the (data, mask) of the raster warped onto the cube grid'''
+        gt = self.geotransform
+        height, width = self.shape[1:]
+        bounds = (gt[0], gt[3] + gt[5] * height, gt[0] + gt[1] * width, gt[3])
+        options = gdal.WarpOptions(format='MEM', dstSRS='EPSG:{}'.format(self.epsg), outputBounds=bounds, width=width,
+                                   height=height, resampleAlg='near', dstAlpha=True)
+        ds = gdal.Warp('', path, options=options)
+        data = ds.GetRasterBand(1).ReadAsArray()
+        mask = ds.GetRasterBand(ds.RasterCount).ReadAsArray() > 0
+        data[~mask] = 0
+        return data, mask
+
+    def to_pixel(self, x, y):
+        '''returns the (row, col) of the map coordinates in the cube projection'''
+        gt = self.geotransform
+        return int(np.floor((y - gt[3]) / gt[5])), int(np.floor((x - gt[0]) / gt[1]))
+
+    def pixel_series(self, x, y, start=None, end=None):
+        '''returns the dates, values & validity of the pixel at map coordinates x, y'''
+        row, col = self.to_pixel(x, y)
+        if not (0 <= row < self.shape[1] and 0 <= col < self.shape[2]):
+            raise Exception('{}, {} is outside the cube'.format(x, y))
+        indices = self.order(start, end)
+        data = self.data.get_orthogonal_selection((indices, row, col))
+        mask = self.mask.get_orthogonal_selection((indices, row, col))
+        return [self.group.attrs['dates'][i] for i in indices], data, mask
+
+    def window_series(self, xmin, ymin, xmax, ymax, start=None, end=None):
+        '''returns the dates, data & validity (time x rows x cols) of the map window, clipped to the cube'''
+        row0, col0 = self.to_pixel(xmin, ymax)
+        row1, col1 = self.to_pixel(xmax, ymin)
+        row0, col0 = max(row0, 0), max(col0, 0)
+        row1, col1 = min(row1 + 1, self.shape[1]), min(col1 + 1, self.shape[2])
+        if row1 <= row0 or col1 <= col0:
+            raise Exception('window is outside the cube')
+        indices = self.order(start, end)
+        rows, cols = slice(row0, row1), slice(col0, col1)
+        data = self.data.get_orthogonal_selection((indices, rows, cols))
+        mask = self.mask.get_orthogonal_selection((indices, rows, cols))
+        return [self.group.attrs['dates'][i] for i in indices], data, mask
+
+    def frame_dataset(self, index):
+        '''returns an in memory dataset of the frame, with the validity as an alpha band, for warping'''
+        height, width = self.shape[1:]
+        ds = gdal.GetDriverByName('MEM').Create('', width, height, 2, gdal.GDT_Byte)
+        ds.SetGeoTransform(self.geotransform)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(self.epsg)
+        ds.SetProjection(srs.ExportToWkt())
+        ds.GetRasterBand(1).WriteArray(self.data[index])
+        ds.GetRasterBand(2).WriteArray(self.mask[index].astype(np.uint8) * 255)
+        ds.GetRasterBand(2).SetColorInterpretation(gdal.GCI_AlphaBand)
+        return ds
+
+def main(folder, cube_path=False, epsg=3031, clip=False):
+    '''appends the *.merged.masked.tiff files in folder that aren't yet in the cube, or were re-merged since they
+       were appended, creating the cube over the union of the files if it doesn't exist. dates merged later must lie
+       within that grid, or with clip are cropped to it. returns the cube path'''
+    files = sorted(glob.glob(os.path.join(folder, '*.merged.masked.tiff')))
+    if cube_path is False:
+        cube_path = os.path.join(folder, 'timeseries.zarr')
+    if os.path.exists(cube_path):
+        cube = Cube(cube_path, mode='a')
+    else:
+        if not files:
+            raise Exception('no merged files found in {}'.format(folder))
+        geotransform, width, height = get_grid(files)
+        print('creating {}x{} cube {}'.format(width, height, cube_path))
+        cube = Cube.create(cube_path, geotransform, width, height, epsg)
+    for path in files:
+        date = get_date(path)
+        if cube.is_current(path, date):
+            continue
+        print('{} {} in {}'.format('replacing' if date in cube.dates else 'appending', date, cube_path))
+        cube.append(path, date, clip)
+    print('cube holds {} dates'.format(len(cube.dates)))
+    return cube_path
+
+def get_signature(path):
+    '''returns the [size, mtime] of the file, as stored in the cube attrs'''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def get_bounds(path, srs):
+    '''returns the (minx, miny, maxx, maxy) of the raster in the spatial reference'''
+    ds = gdal.Open(path)
+    gt = ds.GetGeoTransform()
+    corners = [(gt[0] + gt[1] * col, gt[3] + gt[5] * row) for col in (0, ds.RasterXSize) for row in (0, ds.RasterYSize)]
+    src = osr.SpatialReference(wkt=ds.GetProjection())
+    if not src.IsSame(srs):
+        for ref in (src, srs):
+            if hasattr(ref, 'SetAxisMappingStrategy'): # gdal 3 defaults to lat, lon order
+                ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, srs)
+        corners = [transform.TransformPoint(x, y)[:2] for x, y in corners]
+    xs, ys = [x for x, _ in corners], [y for _, y in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def get_date(path):
+    '''returns the YYYY-MM-DD date of a merged file from its date subfolder name'''
+    res = re.match('([0-9]{4})([0-9]{2})([0-9]{2})', os.path.basename(path))
+    if res is None:
+        raise Exception('unable to parse the date of {}'.format(path))
+    return '{}-{}-{}'.format(res.group(1), res.group(2), res.group(3))
+
+def get_grid(files):
+    '''returns the geotransform, width & height covering the union of the (same projection) files at the finest
+       resolution among them'''
+    minx = miny = np.inf
+    maxx = maxy = -np.inf
+    res = np.inf
+    for path in files:
+        ds = gdal.Open(path)
+        gt = ds.GetGeoTransform()
+        minx, maxx = min(minx, gt[0]), max(maxx, gt[0] + gt[1] * ds.RasterXSize)
+        miny, maxy = min(miny, gt[3] + gt[5] * ds.RasterYSize), max(maxy, gt[3])
+        res = min(res, gt[1], -gt[5])
+    width = int(np.ceil((maxx - minx) / res))
+    height = int(np.ceil((maxy - miny) / res))
+    return (minx, res, 0., maxy, 0., -res), width, height
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Appends the merged date mosaics to a time series cube")
+    parse.add_argument("--folder", required=True, help="folder containing the *.merged.masked.tiff files")
+    parse.add_argument("--cube", required=False, default=False, help="cube path. Defaults to timeseries.zarr in the folder")
+    parse.add_argument("--epsg", required=False, type=int, default=3031, help="projection EPSG code of the merged files")
+    parse.add_argument("--clip", action="store_true", help="crop dates extending past the grid of an existing cube instead of failing")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    main(args.folder, cube_path=args.cube, epsg=args.epsg, clip=args.clip)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Downloads the granules listed in an ASF metalink concurrently over authenticated, pooled HTTP sessions.
+# Partial files are resumed with range requests, and completed files are verified against the metalink size & md5.
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+import collections
+import concurrent.futures
+import xml.etree.ElementTree as ET
+import requests
+import tracing
+
+AUTH_HOST = 'urs.earthdata.nasa.gov'
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+PROGRESS_INTERVAL = 10. # seconds between aggregate progress reports
+
+Entry = collections.namedtuple('Entry', ['name', 'url', 'size', 'md5'])
+
+class EarthdataSession(requests.Session):
+    '''session that keeps the auth headers when redirected to the Earthdata login host, and drops them elsewhere'''
+    def rebuild_auth(self, prepared_request, response):
+        headers = prepared_request.headers
+        url = prepared_request.url
+        if 'Authorization' in headers:
+            original = requests.utils.urlparse(response.request.url).hostname
+            redirect = requests.utils.urlparse(url).hostname
+            if original != redirect and redirect != AUTH_HOST and original != AUTH_HOST:
+                del headers['Authorization']
+
+class Progress():
+    '''thread safe byte counter, reporting the aggregate throughput. bytes are counted per granule, so those of a
+       failed or restarted download can be discarded'''
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.counted = {}
+        self.start = time.time()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def update(self, nbytes, name=None):
+        with self.lock:
+            self.done += nbytes
+            if name is not None:
+                self.counted[name] = self.counted.get(name, 0) + nbytes
+            now = time.time()
+            if now - self.last_report < PROGRESS_INTERVAL:
+                return
+            self.last_report = now
+        self.report()
+
+    def discard(self, name):
+        '''uncounts the bytes counted for the granule, before its download is retried or restarted'''
+        with self.lock:
+            self.done -= self.counted.pop(name, 0)
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        pct = 100. * self.done / self.total if self.total else 0.
+        print('downloaded {:.1f} of {:.1f} MB ({:.1f}%) at {:.2f} MB/s'.format(
+            self.done / 1e6, self.total / 1e6, pct, self.done / 1e6 / elapsed))
+
+def main(query=False, metalink=False, workdir=False, authkey_file=False, workers=4, dry_run=False):
+    '''downloads the granules of the metalink (a path or the text) or of the metalink returned by the ASF query url.
+       returns a list of (entry, error) tuples for the granules that failed'''
+    if workdir is False:
+        workdir = os.getcwd()
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    if query:
+        metalink = fetch_metalink(query)
+    elif metalink and os.path.exists(metalink):
+        with open(metalink, 'r') as fin:
+            metalink = fin.read()
+    entries = parse_metalink(metalink)
+    total = sum([entry.size for entry in entries if entry.size])
+    print('metalink lists {} granules, {:.1f} MB total'.format(len(entries), total / 1e6))
+    if dry_run:
+        print_entries(entries)
+        return []
+    user, password = read_authkey(authkey_file) if authkey_file else (None, None)
+    return download_all(entries, workdir, user, password, workers)
+
+def print_entries(entries):
+    '''prints the granules & their sizes'''
+    for entry in entries:
+        print('    {} ({:.1f} MB)'.format(entry.name, (entry.size or 0) / 1e6))
+
+def fetch_metalink(query):
+    '''returns the metalink text for the ASF query url'''
+    response = requests.get(query)
+    response.raise_for_status()
+    return response.text
+
+def parse_metalink(text):
+    '''returns the list of Entry(name, url, size, md5) in the metalink, ignoring the xml namespace'''
+    entries = []
+    root = ET.fromstring(text)
+    for elem in root.iter():
+        if local_name(elem.tag) != 'file':
+            continue
+        url = size = md5 = None
+        for child in elem.iter():
+            tag = local_name(child.tag)
+            if tag == 'url' and url is None:
+                url = child.text.strip()
+            elif tag == 'size':
+                size = int(child.text.strip())
+            elif tag == 'hash' and child.get('type', '').lower() == 'md5':
+                md5 = child.text.strip().lower()
+        entries.append(Entry(elem.get('name'), url, size, md5))
+    return entries
+
+def local_name(tag):
+    '''strips the namespace from an element tag'''
+    return tag.split('}')[-1]
+
+def read_authkey(authkey_file):
+    '''returns the earthdata user & password from the auth.key file'''
+    values = {}
+    with open(authkey_file, 'r') as fin:
+        for line in fin:
+            key, _, value = line.strip().partition('=')
+            values[key] = value.strip('"\'')
+    return values.get('EARTHDATA_USER'), values.get('EARTHDATA_PASSWORD')
+
+def download_all(entries, workdir, user, password, workers=4):
+    '''downloads the entries over a pool of threads, each with its own keep-alive session.
+       returns a list of (entry, error) for failed downloads'''
+    local = threading.local()
+    progress = Progress(sum([entry.size for entry in entries if entry.size]))
+
+    def job(entry):
+        if not hasattr(local, 'session'):
+            local.session = new_session(user, password)
+        path, error = download_with_retries(entry, workdir, local.session, progress)
+        return entry, error
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, error in executor.map(job, entries):
+            if error is not None:
+                failed.append((entry, error))
+    progress.report()
+    if failed:
+        print('{} of {} downloads failed:'.format(len(failed), len(entries)))
+        for entry, error in failed:
+            print('    {}: {}'.format(entry.name, error))
+    return failed
+
+def new_session(user, password):
+    '''returns a keep-alive session authenticated for earthdata'''
+    session = EarthdataSession()
+    if user is not None:
+        session.auth = (user, password)
+    return session
+
+def download_with_retries(entry, workdir, session, progress):
+    '''downloads the entry, resuming on failure. returns (path, None) on success or (None, error string)'''
+    error = None
+    for attempt in range(RETRIES):
+        try:
+            return download_file(entry, workdir, session, progress), None
+        except Exception as err:
+            error = '{}: {}'.format(type(err).__name__, err)
+            print('attempt {} of {} failed for {}: {}'.format(attempt + 1, RETRIES, entry.name, error))
+    progress.discard(entry.name)
+    return None, error
+
+def download_file(entry, workdir, session, progress):
+    '''downloads the entry to the workdir, resuming any partial download, and verifies the size & md5'''
+    path = os.path.join(workdir, entry.name)
+    part = path + '.part'
+    progress.discard(entry.name) # counted again below, from what is on disk
+    if os.path.exists(path) and (entry.size is None or os.path.getsize(path) == entry.size):
+        print('{} already downloaded.'.format(entry.name))
+        progress.update(entry.size or 0, entry.name)
+        return path
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(part):
+        # seed the checksum with the bytes we already have
+        with open(part, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+                offset += len(chunk)
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    start = time.time()
+    with tracing.span('download', granule=entry.name, offset=offset), \
+            session.get(entry.url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416 and offset == entry.size:
+            progress.update(offset, entry.name) # the partial file is already complete
+        else:
+            response.raise_for_status()
+            mode = 'ab'
+            if offset and response.status_code != 206:
+                # the server ignored the range, start over
+                md5 = hashlib.md5()
+                offset = 0
+                mode = 'wb'
+            progress.update(offset, entry.name)
+            with open(part, mode) as fout:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    fout.write(chunk)
+                    md5.update(chunk)
+                    progress.update(len(chunk), entry.name)
+    size = os.path.getsize(part)
+    if entry.size is not None and size != entry.size:
+        if size > entry.size:
+            os.remove(part)
+        raise Exception('size mismatch for {}: expected {} got {}'.format(entry.name, entry.size, size))
+    if entry.md5 is not None and md5.hexdigest() != entry.md5:
+        os.remove(part)
+        raise Exception('md5 mismatch for {}'.format(entry.name))
+    os.rename(part, path)
+    elapsed = max(time.time() - start, 1e-6)
+    print('finished {} ({:.1f} MB at {:.2f} MB/s)'.format(entry.name, (size - offset) / 1e6, (size - offset) / 1e6 / elapsed))
+    return path
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Download the granules of an ASF metalink")
+    parse.add_argument("--query", required=False, default=False, help="ASF search url returning a metalink")
+    parse.add_argument("--metalink", required=False, default=False, help="metalink file")
+    parse.add_argument("--path", required=False, default=False, help="output folder for the granules. Defaults to current directory.")
+    parse.add_argument("--authkey", required=False, default=False, help="auth.key file holding EARTHDATA_USER & EARTHDATA_PASSWORD")
+    parse.add_argument("--workers", required=False, default=4, type=int, help="number of concurrent downloads")
+    parse.add_argument("--dry_run", action="store_true", help="lists the granules but does not download them")
+    tracing.add_arguments(parse)
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    tracing.configure(args.trace, args.profile)
+    failed = main(query=args.query, metalink=args.metalink, workdir=args.path, authkey_file=args.authkey,
+                  workers=args.workers, dry_run=args.dry_run)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Selects the granules worth processing from their footprints. Granules covering too little of the AOI are dropped,
+# and within each date group only the fewest granules that cover the AOI are kept. Footprints come from the ASF
+# geojson search results, or from the manifest.safe of local products.
+
+import os
+import json
+import zipfile
+import argparse
+import collections
+import xml.etree.ElementTree as ET
+import numpy as np
+import requests
+import shapely
+import shapely.geometry
+import shapely.ops
+from shapely.strtree import STRtree
+import group
+
+Footprint = collections.namedtuple('Footprint', ['name', 'geometry', 'datetime', 'nbytes'])
+
+COVERED = 0.999 # fraction of the AOI considered fully covered
+
+class FootprintIndex():
+    '''R-tree (STR packed) over granule footprints'''
+    def __init__(self, footprints):
+        self.footprints = list(footprints)
+        self.tree = STRtree([fp.geometry for fp in self.footprints])
+        self.lookup = dict([(id(fp.geometry), fp) for fp in self.footprints])
+
+    def query(self, geometry):
+        '''returns the footprints that intersect the geometry'''
+        hits = self.tree.query(geometry)
+        if len(hits) and not hasattr(hits[0], 'geom_type'):
+            found = [self.footprints[int(i)] for i in hits] # shapely 2 returns indices
+        else:
+            found = [self.lookup[id(geom)] for geom in hits]
+        return [fp for fp in found if fp.geometry.intersects(geometry)]
+
+def main(folder=False, shapefile=False, min_overlap=0.01, interval=0):
+    '''reports the granule selection for the local products in folder'''
+    aoi = get_aoi(shapefile)
+    footprints = [fp for fp in [read_local_footprint(os.path.join(folder, item)) for item in sorted(os.listdir(folder))] if fp]
+    selected, dropped, _ = select(footprints, aoi, min_overlap, interval)
+    report(selected, dropped)
+    return selected, dropped
+
+def get_aoi(shapefile):
+    '''returns the first geometry of the shapefile'''
+    import fiona # only needed to read the aoi, not to select from footprints
+    with fiona.open(shapefile) as collection:
+        return [shapely.geometry.shape(item['geometry']) for item in collection][0]
+
+def parse_asf_geojson(text):
+    '''returns the footprints from an ASF search geojson response'''
+    footprints = []
+    for feature in json.loads(text).get('features', []):
+        props = feature.get('properties', {})
+        name = props.get('fileName') or '{}.zip'.format(props.get('sceneName'))
+        geometry = shapely.geometry.shape(feature['geometry'])
+        nbytes = int(props.get('bytes') or 0)
+        footprints.append(Footprint(name, geometry, group.get_filename_datetime(name), nbytes))
+    return footprints
+
+def fetch_asf_footprints(query):
+    '''returns the footprints for an ASF search url with geojson output'''
+    response = requests.get(query)
+    response.raise_for_status()
+    return parse_asf_geojson(response.text)
+
+def read_local_footprint(path):
+    '''returns the footprint of a local .SAFE folder or zip from its manifest.safe, or None if it isn't a product'''
+    manifest = None
+    if path.lower().endswith('.zip') and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            names = [name for name in zip_ref.namelist() if name.endswith('/manifest.safe')]
+            if names:
+                manifest = zip_ref.read(names[0])
+        nbytes = os.path.getsize(path)
+    elif os.path.exists(os.path.join(path, 'manifest.safe')):
+        with open(os.path.join(path, 'manifest.safe'), 'rb') as fin:
+            manifest = fin.read()
+        nbytes = sum([os.path.getsize(os.path.join(dirpath, fil)) for dirpath, _, files in os.walk(path) for fil in files])
+    if manifest is None:
+        return None
+    return Footprint(os.path.basename(path), parse_manifest_footprint(manifest), group.get_filename_datetime(path), nbytes)
+
+def parse_manifest_footprint(manifest):
+    '''returns the footprint polygon from the gml:coordinates (lat,lon pairs) of a manifest.safe'''
+    root = ET.fromstring(manifest)
+    for elem in root.iter():
+        if elem.tag.split('}')[-1] == 'coordinates':
+            coords = [pair.split(',') for pair in elem.text.split()]
+            return shapely.geometry.Polygon([(float(lon), float(lat)) for lat, lon in coords])
+    raise Exception('no footprint found in manifest')
+
+def select(footprints, aoi, min_overlap=0.01, interval=0):
+    '''drops footprints covering less than min_overlap of the aoi, then greedily picks the fewest footprints covering
+       the aoi in each date group (grouped as in group.py). returns the (selected, dropped, subdirs), where dropped
+       holds (footprint, reason) tuples and subdirs maps the name of each selected footprint to the date group it was
+       selected in. regrouping only the selected footprints can shift the groups, so they should be processed in
+       these subdirs. overlaps & coverage are measured by area on the ground, see to_equal_area'''
+    index = FootprintIndex(footprints)
+    candidates = dict([(fp.name, fp) for fp in index.query(aoi)])
+    dropped = [(fp, 'outside aoi') for fp in footprints if not fp.name in candidates]
+    projected_aoi = to_equal_area(aoi)
+    projected = dict([(name, fp._replace(geometry=to_equal_area(fp.geometry))) for name, fp in candidates.items()])
+    kept = []
+    for fp in footprints:
+        if not fp.name in candidates:
+            continue
+        overlap = projected[fp.name].geometry.intersection(projected_aoi).area / projected_aoi.area
+        if overlap < min_overlap:
+            dropped.append((fp, 'covers {:.2%} of aoi'.format(overlap)))
+        else:
+            kept.append(fp)
+    # granules without a parseable acquisition time can't be grouped, so are always kept
+    selected = [fp for fp in kept if fp.datetime is None]
+    kept = [fp for fp in kept if fp.datetime is not None]
+    subdirs = {}
+    for subdir, bucket in sorted(get_buckets(kept, interval).items()):
+        chosen, redundant = cover([projected[fp.name] for fp in bucket], projected_aoi)
+        chosen = [candidates[fp.name] for fp in chosen]
+        redundant = [candidates[fp.name] for fp in redundant]
+        selected.extend(chosen)
+        subdirs.update([(fp.name, subdir) for fp in chosen])
+        dropped.extend([(fp, 'redundant in {}'.format(subdir)) for fp in redundant])
+    return selected, dropped, subdirs
+
+def to_equal_area(geometry):
+    '''projects a lon/lat geometry onto the Lambert cylindrical equal-area projection (of the unit sphere), so area
+       ratios hold at any latitude, unlike areas in square degrees which overweight the poles'''
+    if hasattr(shapely, 'transform'): # shapely 2
+        return shapely.transform(geometry, lambda coords: np.column_stack([np.radians(coords[:, 0]), np.sin(np.radians(coords[:, 1]))]))
+    return shapely.ops.transform(lambda lon, lat: (np.radians(lon), np.sin(np.radians(lat))), geometry)
+
+def get_buckets(footprints, interval):
+    '''returns a dict of date subfolder -> footprints, using the group.py bucketing'''
+    gran_list = []
+    for fp in footprints:
+        gran = group.granule()
+        gran.path = fp
+        gran.datetime = fp.datetime
+        gran_list.append(gran)
+    group.group_granules(gran_list, interval)
+    buckets = collections.defaultdict(list)
+    for gran in gran_list:
+        buckets[gran.subdir].append(gran.path)
+    return buckets
+
+def cover(footprints, aoi):
+    '''greedy set cover: repeatedly picks the footprint adding the most aoi coverage until the aoi covered by the
+       group is covered. the geometries should be in an equal-area projection. returns the (chosen, redundant)
+       footprints'''
+    target = aoi.intersection(shapely.ops.unary_union([fp.geometry for fp in footprints]))
+    uncovered = target
+    remaining = sorted(footprints, key=lambda fp: fp.name)
+    chosen = []
+    while remaining and uncovered.area > (1. - COVERED) * target.area:
+        gains = [fp.geometry.intersection(uncovered).area for fp in remaining]
+        best = max(range(len(remaining)), key=lambda i: gains[i])
+        if gains[best] <= 0:
+            break
+        chosen.append(remaining.pop(best))
+        uncovered = uncovered.difference(chosen[-1].geometry)
+    return chosen, remaining
+
+def report(selected, dropped):
+    '''prints the scenes & bytes kept and saved by the selection'''
+    kept_bytes = sum([fp.nbytes for fp in selected])
+    saved_bytes = sum([fp.nbytes for fp, _ in dropped])
+    for fp, reason in sorted(dropped, key=lambda item: item[0].name):
+        print('dropping {}: {}'.format(fp.name, reason))
+    print('keeping {} scenes ({:.1f} MB), dropping {} scenes ({:.1f} MB saved)'.format(
+        len(selected), kept_bytes / 1e6, len(dropped), saved_bytes / 1e6))
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Reports which local granules are needed to cover the AOI")
+    parse.add_argument("--folder", required=True, help="folder of .SAFE folders or zip files")
+    parse.add_argument("--shapefile", required=True, help="AOI shapefile")
+    parse.add_argument("--min_overlap", required=False, type=float, default=0.01, help="min fraction of the AOI a granule must cover")
+    parse.add_argument("--interval", required=False, type=float, default=0, help="n day time interval to group granules. 0 will be same day.")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    main(folder=args.folder, shapefile=args.shapefile, min_overlap=args.min_overlap, interval=args.interval)
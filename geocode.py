@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Terrain corrects calibrated GRD rasters through a map grid -> radar coordinate lookup. With a cache, lookups are
+# keyed on the relative orbit, AOI & pixel spacing, so later acquisitions on the same track only need a small affine
+# fit against the cached lookup instead of recomputing the geometry. Lookups & their DEM heights are kept in a size
+# bounded LRU on disk, along with the crop of the DEM over each AOI, so a remote or tiled DEM is only read once.
+# Without a cache the lookup is computed for each raster, reading the DEM in place.
+
+import os
+import re
+import numpy as np
+from osgeo import gdal
+from osgeo import ogr
+import cache
+
+gdal.UseExceptions()
+
+STEP = 8 # map grid pixels between lookup nodes, the lookup is bilinearly interpolated in between
+ANCHOR_STEP = 16 # lookup nodes between the anchors used to fit a cached lookup to a new acquisition
+MAX_FIT_ERROR = 0.5 # max anchor residual in radar pixels to reuse a cached lookup
+MAX_BYTES = 2 * 1024 ** 3 # default size of the lookup cache on disk
+BLOCK_SIZE = 256 # output pixels along each side of the tiles resampled at a time
+MAX_WINDOW = 4096 * 4096 # max radar pixels read for a tile, tiles mapping to a larger window are split
+DEM_MARGIN = 0.1 # degrees kept around the AOI bounding box in the DEM crop
+CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+def terrain_correct(inpath, outpath, annotation, xoff, granule, wktstring, pixel_spacing, res, cache_db,
+                    dem=False, max_bytes=MAX_BYTES, validate=False, looks=(1, 1)):
+    '''resamples the calibrated raster (with GCPs, covering columns xoff.. of the product, multilooked by the
+       (azimuth, range) looks) onto an EPSG:4326 grid at res degrees over the bounding box of the wkt, by nearest
+       neighbour through the lookup, cached in cache_db if given. dem is any GDAL readable DEM (eg a VRT of tiles or
+       a /vsicurl/ url), its crop over the AOI is cached too. validate also recomputes the lookup and reports the
+       difference. returns the validation stats if validating.'''
+    src = gdal.Open(inpath)
+    gt, width, height = get_grid(wktstring, res)
+    if cache_db:
+        lookup, dem = get_cached_lookup(src, annotation, xoff, granule, wktstring, pixel_spacing, gt, width, height,
+                                        cache_db, dem, max_bytes, looks)
+    else:
+        lookup = compute_lookup(src, annotation, xoff, gt, width, height, dem, looks[1])
+    resample(src, lookup, outpath, gt, width, height)
+    if validate:
+        return validate_lookup(src, lookup, annotation, xoff, gt, width, height, dem, looks[1])
+
+def get_cached_lookup(src, annotation, xoff, granule, wktstring, pixel_spacing, gt, width, height, cache_db, dem,
+                      max_bytes=MAX_BYTES, looks=(1, 1)):
+    '''returns the lookup of the track fitted to the raster, computing & caching it on a miss, along with the path
+       of the cached dem crop (False without a dem)'''
+    store = cache.Cache(cache_db)
+    params = {'track': get_relative_orbit(granule), 'wkt': cache.text_hash(wktstring), 'pixel_spacing': pixel_spacing,
+              'dem': dem, 'step': STEP, 'looks': list(looks)}
+    key = store.key('geocode', [], params)
+    if dem is not False:
+        dem = get_dem(dem, wktstring, store)
+    found = store.lookup('geocode', key)
+    lookup = None
+    if found is not None:
+        print('reusing cached geocoding for track {}'.format(params['track']))
+        lookup = fit_lookup(load_lookup(found[0]), src, gt)
+        if lookup is None:
+            print('cached geocoding does not fit this acquisition, recomputing.')
+    if lookup is None:
+        lookup = compute_lookup(src, annotation, xoff, gt, width, height, dem, looks[1])
+        lookup_path = os.path.join(os.path.dirname(os.path.abspath(store.path)), 'geocode', '{}.npz'.format(key))
+        save_lookup(lookup_path, lookup)
+        store.store('geocode', key, [lookup_path])
+        store.evict(max_bytes=max_bytes, stages=['geocode', 'dem'])
+    store.close()
+    return lookup, dem
+
+def get_dem(dem, wktstring, store):
+    '''returns a local EPSG:4326 GeoTIFF of the dem over the bounding box of the wkt (plus a margin), kept under the
+       cache folder and keyed on the dem & wkt'''
+    key = store.key('dem', [dem], {'wkt': cache.text_hash(wktstring), 'margin': DEM_MARGIN})
+    found = store.lookup('dem', key)
+    if found is not None:
+        return found[0]
+    path = os.path.join(os.path.dirname(os.path.abspath(store.path)), 'dem', '{}.tif'.format(key))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(wktstring).GetEnvelope()
+    bounds = (minx - DEM_MARGIN, miny - DEM_MARGIN, maxx + DEM_MARGIN, maxy + DEM_MARGIN)
+    print('cropping {} to the AOI: {}'.format(dem, path))
+    options = gdal.WarpOptions(format='GTiff', dstSRS='EPSG:4326', outputBounds=bounds, resampleAlg='bilinear',
+                               outputType=gdal.GDT_Float32, creationOptions=CREATION_OPTIONS)
+    gdal.Warp(path + '.tmp', dem, options=options)
+    os.rename(path + '.tmp', path)
+    store.store('dem', key, [path])
+    return path
+
+def get_relative_orbit(granule):
+    '''returns the relative orbit of an S1 granule from the absolute orbit in its name'''
+    res = re.search('(S1[AB])_.*?_[0-9]{8}T[0-9]{6}_[0-9]{8}T[0-9]{6}_([0-9]{6})_', os.path.basename(granule))
+    if res is None:
+        raise Exception('unable to parse the orbit of {}'.format(granule))
+    offset = 73 if res.group(1) == 'S1A' else 27
+    return (int(res.group(2)) - offset) % 175 + 1
+
+def get_grid(wktstring, res):
+    '''returns the geotransform, width & height of the EPSG:4326 output grid over the bounding box of the wkt'''
+    minx, maxx, miny, maxy = ogr.CreateGeometryFromWkt(wktstring).GetEnvelope()
+    width = int(np.ceil((maxx - minx) / res))
+    height = int(np.ceil((maxy - miny) / res))
+    return (minx, res, 0., maxy, 0., -res), width, height
+
+def get_nodes(size, step):
+    '''returns the output pixel indices of the lookup nodes along an axis, the last node at or beyond the edge'''
+    return np.arange(0, size - 1 + step, step)
+
+def inverse_transform(src, lons, lats):
+    '''returns the (line, pixel) of the lon/lat points through the GCPs of the raster, nan where they fail'''
+    transformer = gdal.Transformer(src, None, ['METHOD=GCP_TPS'])
+    points, success = transformer.TransformPoints(1, list(zip(lons.ravel().tolist(), lats.ravel().tolist())))
+    points = np.array(points, dtype=np.float64)
+    ok = np.array(success, dtype=bool)
+    points[~ok] = np.nan
+    return points[:, 1].reshape(lons.shape), points[:, 0].reshape(lons.shape)
+
+def node_coords(gt, rows, cols):
+    '''returns the lon & lat of the output pixel centres at the given rows & columns'''
+    lons = gt[0] + (cols + 0.5) * gt[1]
+    lats = gt[3] + (rows + 0.5) * gt[5]
+    return np.meshgrid(lons, lats)
+
+def compute_lookup(src, annotation, xoff, gt, width, height, dem=False, range_looks=1):
+    '''computes the lookup from the output grid nodes to radar (line, pixel), shifting the ellipsoid position in range
+       by the terrain height above the GCP heights. also returns the ellipsoid positions at the anchor nodes.'''
+    rows, cols = get_nodes(height, STEP), get_nodes(width, STEP)
+    lons, lats = node_coords(gt, rows, cols)
+    line, pixel = inverse_transform(src, lons, lats)
+    heights = get_heights(dem, gt, rows, cols)
+    ref_height = np.mean([gcp.GCPZ for gcp in src.GetGCPs()])
+    spacing, grid_pixels, grid_incidence = parse_geometry(annotation)
+    spacing *= range_looks
+    incidence = np.radians(np.interp(pixel * range_looks + xoff, grid_pixels, grid_incidence))
+    # elevated targets are imaged closer to the sensor, ie at a nearer range pixel
+    shifted = pixel - (heights - ref_height) / np.tan(incidence) / spacing
+    return {'line': line.astype(np.float32), 'pixel': shifted.astype(np.float32), 'heights': heights.astype(np.float32),
+            'anchor_line': line[::ANCHOR_STEP, ::ANCHOR_STEP], 'anchor_pixel': pixel[::ANCHOR_STEP, ::ANCHOR_STEP],
+            'rows': rows, 'cols': cols}
+
+def get_heights(dem, gt, rows, cols):
+    '''returns the dem heights at the lookup nodes, or zeros without a dem'''
+    if dem is False:
+        return np.zeros((len(rows), len(cols)), dtype=np.float32)
+    dx, dy = gt[1] * STEP, gt[5] * STEP
+    lon0 = gt[0] + 0.5 * gt[1] - dx / 2.
+    lat0 = gt[3] + 0.5 * gt[5] - dy / 2.
+    bounds = (lon0, lat0 + dy * len(rows), lon0 + dx * len(cols), lat0)
+    options = gdal.WarpOptions(format='MEM', dstSRS='EPSG:4326', outputBounds=bounds, width=len(cols),
+                               height=len(rows), resampleAlg='bilinear', outputType=gdal.GDT_Float32)
+    return gdal.Warp('', dem, options=options).GetRasterBand(1).ReadAsArray()
+
+def parse_geometry(annotation):
+    '''returns the range pixel spacing, and the pixels & incidence angles of the first line of the geolocation grid'''
+    spacing = float(annotation.find('.//imageAnnotation/imageInformation/rangePixelSpacing').text)
+    points = []
+    for point in annotation.iter('geolocationGridPoint'):
+        points.append((float(point.find('line').text), float(point.find('pixel').text), float(point.find('incidenceAngle').text)))
+    points = np.array(points)
+    first = points[points[:, 0] == points[:, 0].min()]
+    first = first[np.argsort(first[:, 1])]
+    return spacing, first[:, 1], first[:, 2]
+
+def fit_lookup(cached, src, gt):
+    '''fits an affine transform from the cached anchor positions to this acquisition's, and applies it to the cached
+       lookup. returns None if the fit is poor, eg a different pass.'''
+    rows = cached['rows'][::ANCHOR_STEP]
+    cols = cached['cols'][::ANCHOR_STEP]
+    lons, lats = node_coords(gt, rows, cols)
+    line, pixel = inverse_transform(src, lons, lats)
+    ref = np.stack([cached['anchor_line'].ravel(), cached['anchor_pixel'].ravel()], axis=1)
+    new = np.stack([line.ravel(), pixel.ravel()], axis=1)
+    ok = np.isfinite(ref).all(axis=1) & np.isfinite(new).all(axis=1)
+    if ok.sum() < 3:
+        return None
+    design = np.column_stack([ref[ok], np.ones(ok.sum())])
+    coeffs = np.linalg.lstsq(design, new[ok], rcond=None)[0]
+    if np.abs(design.dot(coeffs) - new[ok]).max() > MAX_FIT_ERROR:
+        return None
+    fitted = dict(cached)
+    fitted['line'] = (cached['line'] * coeffs[0, 0] + cached['pixel'] * coeffs[1, 0] + coeffs[2, 0]).astype(np.float32)
+    fitted['pixel'] = (cached['line'] * coeffs[0, 1] + cached['pixel'] * coeffs[1, 1] + coeffs[2, 1]).astype(np.float32)
+    return fitted
+
+def expand(coarse, row0, nrows, col0, ncols):
+    '''bilinearly interpolates the lookup nodes over output rows row0:row0+nrows & columns col0:col0+ncols'''
+    rows = np.arange(row0, row0 + nrows, dtype=np.float64) / STEP
+    cols = np.arange(col0, col0 + ncols, dtype=np.float64) / STEP
+    i0 = np.clip(np.floor(rows).astype(int), 0, coarse.shape[0] - 2)
+    j0 = np.clip(np.floor(cols).astype(int), 0, coarse.shape[1] - 2)
+    fy = (rows - i0)[:, np.newaxis]
+    fx = (cols - j0)[np.newaxis, :]
+    top = coarse[i0][:, j0] * (1. - fx) + coarse[i0][:, j0 + 1] * fx
+    bottom = coarse[i0 + 1][:, j0] * (1. - fx) + coarse[i0 + 1][:, j0 + 1] * fx
+    return top * (1. - fy) + bottom * fy
+
+def resample(src, lookup, outpath, gt, width, height):
+    '''nearest neighbour resampling of the radar raster onto the output grid, tile by tile'''
+    band = src.GetRasterBand(1)
+    dst = gdal.GetDriverByName('GTiff').Create(outpath, width, height, 1, gdal.GDT_Float32, CREATION_OPTIONS)
+    dst.SetGeoTransform(gt)
+    dst.SetProjection('EPSG:4326')
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(0)
+    for row in range(0, height, BLOCK_SIZE):
+        for col in range(0, width, BLOCK_SIZE):
+            nrows, ncols = min(BLOCK_SIZE, height - row), min(BLOCK_SIZE, width - col)
+            dst_band.WriteArray(resample_tile(band, lookup, row, col, nrows, ncols), col, row)
+    dst_band.FlushCache()
+    dst = None
+
+def resample_tile(band, lookup, row, col, nrows, ncols):
+    '''returns the output tile, reading only the radar window it maps to. tiles mapping to a window of more than
+       MAX_WINDOW pixels (eg near the pole on a lat/lon grid) are split in four'''
+    out = np.zeros((nrows, ncols), dtype=np.float32)
+    with np.errstate(invalid='ignore'):
+        line = np.rint(expand(lookup['line'], row, nrows, col, ncols))
+        pixel = np.rint(expand(lookup['pixel'], row, nrows, col, ncols))
+        valid = (line >= 0) & (line < band.YSize) & (pixel >= 0) & (pixel < band.XSize)
+    if not valid.any():
+        return out
+    line = line[valid].astype(np.int64)
+    pixel = pixel[valid].astype(np.int64)
+    lmin, lmax, pmin, pmax = line.min(), line.max(), pixel.min(), pixel.max()
+    if (lmax - lmin + 1) * (pmax - pmin + 1) > MAX_WINDOW and nrows * ncols > 1:
+        half_rows, half_cols = (nrows + 1) // 2, (ncols + 1) // 2
+        for r0, r1 in [(0, half_rows), (half_rows, nrows)]:
+            for c0, c1 in [(0, half_cols), (half_cols, ncols)]:
+                if r1 > r0 and c1 > c0:
+                    out[r0:r1, c0:c1] = resample_tile(band, lookup, row + r0, col + c0, r1 - r0, c1 - c0)
+        return out
+    window = band.ReadAsArray(int(pmin), int(lmin), int(pmax - pmin + 1), int(lmax - lmin + 1))
+    out[valid] = window[line - lmin, pixel - pmin]
+    return out
+
+def validate_lookup(src, lookup, annotation, xoff, gt, width, height, dem, range_looks=1):
+    '''compares the (possibly reused) lookup against a full recompute, returns the max & mean node offset in pixels
+       and the fraction of output pixels sampled from a different radar pixel'''
+    full = compute_lookup(src, annotation, xoff, gt, width, height, dem, range_looks)
+    offset = np.hypot(lookup['line'] - full['line'], lookup['pixel'] - full['pixel'])
+    differ = 0
+    total = 0
+    for row in range(0, height, BLOCK_SIZE):
+        nrows = min(BLOCK_SIZE, height - row)
+        with np.errstate(invalid='ignore'):
+            a = [np.rint(expand(lookup[name], row, nrows, 0, width)) for name in ('line', 'pixel')]
+            b = [np.rint(expand(full[name], row, nrows, 0, width)) for name in ('line', 'pixel')]
+        valid = np.isfinite(b[0]) & np.isfinite(b[1])
+        differ += int(((a[0] != b[0]) | (a[1] != b[1]))[valid].sum())
+        total += int(valid.sum())
+    stats = {'max_offset': float(np.nanmax(offset)), 'mean_offset': float(np.nanmean(offset)),
+             'changed_fraction': differ / float(max(total, 1))}
+    print('geocoding validation: max offset {:.3f} px, mean offset {:.3f} px, {:.4%} of pixels differ'.format(
+        stats['max_offset'], stats['mean_offset'], stats['changed_fraction']))
+    return stats
+
+def save_lookup(path, lookup):
+    '''writes the lookup arrays to an uncompressed .npz, creating its folder'''
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    np.savez(path, **lookup)
+
+def load_lookup(path):
+    '''returns the lookup saved by save_lookup, as a dict of arrays'''
+    with np.load(path) as data:
+        return dict([(name, data[name]) for name in data.files])
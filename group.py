@@ -9,9 +9,13 @@ import shutil
 import fnmatch
 import argparse
 import datetime
-from osgeo import gdal
+import collections
+import concurrent.futures
+import tracing
 
 DT_FIELD='TIFFTAG_DATETIME' # datetime metadata field
+DT_REGEX=r'S1.*?([1-2][\d]{3})([0-1][\d])([0-3][\d])T([0-2][\d])([0-5][\d])([0-5][\d])?' # S1 filename start time
+LINK_MODES=['hard', 'sym']
 
 class granule():
     '''simple class to hold granule objects with associated info'''
@@ -20,38 +24,74 @@ class granule():
         self.datetime = None
         self.subdir = None
 
-def main(folder, interval, regex):
-    '''main loop. moves files into proper subdirectories'''
+def main(folder, interval, regex, link=False, workers=8):
+    '''main loop. moves (or links) files into proper subdirectories'''
     # get a list of files that match the regex in the input folder
-    matching_files = get_matching_files(folder, regex)
-    # get the datetime info for each granule
-    gran_list = get_info(folder, matching_files)
-    # determine which subdirectory each granule belongs in
-    gran_list = group_granules(gran_list, interval)
-    # move the granules into their proper subdirectory
-    move_files(gran_list, folder)
+    with tracing.span('group', folder=folder):
+        matching_files = get_matching_files(folder, regex)
+        # get the datetime info for each granule
+        gran_list = get_info(folder, matching_files, workers)
+        # determine which subdirectory each granule belongs in
+        gran_list = group_granules(gran_list, interval)
+        # move the granules into their proper subdirectory
+        move_files(gran_list, folder, link)
     #print_subdir_count(gran_list)
 
-def move_files(gran_list, folder):
-    '''moves the files into their given subdir'''
+def move_files(gran_list, folder, link=False):
+    '''moves the files into their given subdir. if link is 'hard' or 'sym' the files are linked into the
+       subdir instead, leaving the originals in place so they can be regrouped.'''
+    if link:
+        remove_stale_links(gran_list, folder)
     for gran in gran_list:
         filename = os.path.basename(gran.path)
         to_folder = os.path.join(folder, gran.subdir)
         to = os.path.join(to_folder, filename)
         if not os.path.exists(to_folder):
             os.makedirs(to_folder)
-        print('moving {} to {}/'.format(filename, to_folder))
-        shutil.move(gran.path, to)
+        if link:
+            print('linking {} to {}/'.format(filename, to_folder))
+            link_file(gran.path, to, link)
+        else:
+            print('moving {} to {}/'.format(filename, to_folder))
+            shutil.move(gran.path, to)
+
+def remove_stale_links(gran_list, folder):
+    '''removes the links to the granules left in other date subdirs by an earlier grouping (eg at another interval),
+       so no granule ends up in two groups. date subdirs left empty are removed'''
+    grans = dict([(os.path.basename(gran.path), gran) for gran in gran_list])
+    for subdir in os.listdir(folder):
+        sub_path = os.path.join(folder, subdir)
+        if not re.match('[0-9]{8}$', subdir) or not os.path.isdir(sub_path):
+            continue
+        for filename in os.listdir(sub_path):
+            gran = grans.get(filename)
+            if gran is None or gran.subdir == subdir:
+                continue
+            path = os.path.join(sub_path, filename)
+            if os.path.islink(path) or os.path.samefile(path, gran.path):
+                print('removing stale link {}/{}'.format(subdir, filename))
+                os.remove(path)
+        if not os.listdir(sub_path):
+            os.rmdir(sub_path)
+
+def link_file(path, to, link):
+    '''hard or symbolic links path to the given destination, replacing any existing link'''
+    if os.path.lexists(to):
+        if os.path.exists(to) and os.path.samefile(path, to):
+            return
+        os.remove(to)
+    if link == 'hard':
+        os.link(path, to)
+    elif link == 'sym':
+        os.symlink(os.path.relpath(path, os.path.dirname(to)), to)
+    else:
+        raise Exception('unknown link mode: {}, must be one of {}'.format(link, LINK_MODES))
 
 def print_subdir_count(gran_list):
     '''simple print to see how many files each subdir contains'''
-    subdirs = sorted(list(set([g.subdir for g in gran_list])))
-    for subdir in subdirs:
-        count = 0
-        for g in gran_list:
-            if g.subdir == subdir:
-                count=count+1
-        print('{} : {}'.format(subdir, count))
+    counts = collections.Counter([g.subdir for g in gran_list])
+    for subdir in sorted(counts.keys()):
+        print('{} : {}'.format(subdir, counts[subdir]))
 
 def group_granules(gran_list, interval):
     '''determines which granules go into which subdirs, placing the info in the gran_list objects'''
@@ -62,49 +102,60 @@ def group_granules(gran_list, interval):
         for gran in gran_list:
             gran.subdir = gran.datetime.strftime('%Y%m%d')
         return gran_list
-    # group by time interval
-    while not get_min_unfilled_granule(gran_list) is None:
-        min_g = get_min_unfilled_granule(gran_list)
-        start_time = min_g.datetime
-        i_time = start_time + dt_interval
-        for gran in gran_list:
-            if gran.subdir == None and gran.datetime < i_time:
-                gran.subdir = start_time.strftime('%Y%m%d')
+    # group by time interval, in a single sweep over the granules sorted by time. each group starts at the
+    # earliest ungrouped granule and holds every granule before start + interval
+    start_time = None
+    for gran in sorted(gran_list, key=lambda g: g.datetime):
+        if start_time is None or gran.datetime >= start_time + dt_interval:
+            start_time = gran.datetime
+        gran.subdir = start_time.strftime('%Y%m%d')
     return gran_list
 
-
-def get_min_unfilled_granule(gran_list):
-    '''returns the granule from gran_list with the minimum time that hasn't been assigned a subdir'''
-    min_g = None # granule w /min time
-    for gran in gran_list:
-        if min_g == None and gran.subdir == None:
-            min_g = gran
-        elif gran.subdir == None and gran.datetime < min_g.datetime:
-            min_g = gran
-    return min_g
-
-
-def get_info(folder, matching_file_list):
-    '''gets the granule path & datetime information'''
+def get_info(folder, matching_file_list, workers=8):
+    '''gets the granule path & datetime information. datetimes are parsed from the filenames, only
+       falling back on reading the file metadata (in parallel) for files that don't follow the S1 naming'''
     gran_list = []
+    unparsed = []
     # determine datetimes for each file
     for fil in matching_file_list:
         gran = granule()
         gran.path = os.path.join(folder, fil)
-        gran.datetime = get_datetime(gran.path)
+        gran.datetime = get_filename_datetime(gran.path)
+        if gran.datetime is None:
+            unparsed.append(gran)
         gran_list.append(gran)
+    if unparsed:
+        print('reading metadata datetimes for {} files...'.format(len(unparsed)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            datetimes = executor.map(get_metadata_datetime, [gran.path for gran in unparsed])
+            for gran, dt in zip(unparsed, datetimes):
+                gran.datetime = dt
     return gran_list
 
 def get_datetime(file_path):
-    '''returns the datetime object for the given file'''
+    '''returns the datetime object for the given file, from the filename if possible'''
+    dt = get_filename_datetime(file_path)
+    if dt is None:
+        dt = get_metadata_datetime(file_path)
+    return dt
+
+def get_filename_datetime(file_path):
+    '''returns the start datetime encoded in an S1 filename, or None if it can't be parsed'''
+    res = re.search(DT_REGEX, os.path.basename(file_path))
+    if res is None:
+        return None
+    second = int(res.group(6)) if res.group(6) else 0
+    return datetime.datetime(int(res.group(1)),int(res.group(2)),int(res.group(3)),int(res.group(4)),int(res.group(5)),second)
+
+def get_metadata_datetime(file_path):
+    '''returns the datetime object from the file metadata'''
+    from osgeo import gdal # only needed for files that don't follow the S1 naming
     rds = gdal.Open(file_path)
+    if rds is None:
+        raise Exception("unable to open: {}".format(file_path))
     dt_string = rds.GetMetadata().get(DT_FIELD, None)
     if dt_string is None:
-        # attempt to get datetime from filename
-        reg = 'S1.*?([1-2][\d]{3})([0-1][\d])([0-3][\d])T([0-2][\d])([0-6][0-9]).*?.tif[f]?'
-        res = re.search(reg, os.path.basename(file_path))
-        return datetime.datetime(int(res.group(1)),int(res.group(2)),int(res.group(3)),int(res.group(4)),int(res.group(5)))
-        raise Exception("could not parse metadata field: {} , for datetime.".format(DT_FIELD))
+        raise Exception("could not parse metadata field: {} , for datetime in {}".format(DT_FIELD, file_path))
     return datetime.datetime.strptime(dt_string, '%Y:%m:%d %H:%M:%S')
 
 def get_matching_files(folder, regex):
@@ -123,9 +174,14 @@ def parser():
     parse.add_argument("--folder", required=True, default=None, help="folder to search & group files")
     parse.add_argument("--interval", required=False, type=float, default=0, help="n day time interval to group files. 0 will be same day.")
     parse.add_argument("--regex", required=False, default="*.tiff", help="regex to use for matching files") 
+    parse.add_argument("--link", required=False, default=False, choices=LINK_MODES, help="hard or sym link files into the subfolders instead of moving them")
+    parse.add_argument("--workers", required=False, type=int, default=8, help="number of threads for reading datetimes from file metadata")
+    tracing.add_arguments(parse)
     return parse
 
 if __name__ == '__main__':
     args = parser().parse_args()
-    main(args.folder, args.interval, args.regex)
+    tracing.configure(args.trace, args.profile)
+    with tracing.profile('group'):
+        main(args.folder, args.interval, args.regex, link=args.link, workers=args.workers)
 
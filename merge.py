@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Merges the corrected files in each date subfolder into a single reprojected, byte scaled & masked mosaic.
+# Each date is read through a VRT mosaic, warped once and scaled/masked block by block into one tiled output.
+
+import os
+import re
+import glob
+import argparse
+import concurrent.futures
+import numpy as np
+from osgeo import gdal
+import cache
+import cog
+import tracing
+
+gdal.UseExceptions()
+
+BLOCK_SIZE = 512 # block size of the windowed pass
+
+def main(folder, workers=4, epsg=3031, scale_min=0., scale_max=0.85, cache_db=False):
+    '''merges every date subfolder of folder in parallel, returns the list of merged files'''
+    subdirs = get_date_subdirs(folder)
+    print('merging {} date folders over {} workers...'.format(len(subdirs), workers))
+    outputs = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(merge_folder, folder, subdir, epsg, scale_min, scale_max, cache_db) for subdir in subdirs]
+        for future in futures:
+            output = future.result()
+            if output:
+                outputs.append(output)
+    return outputs
+
+def get_date_subdirs(folder):
+    '''returns the date subfolders, as generated by group.py'''
+    return sorted([item for item in os.listdir(folder) if re.match('[0-9]', item) and os.path.isdir(os.path.join(folder, item))])
+
+def get_merge_params(epsg, scale_min, scale_max):
+    '''returns the parameters the merged output depends on'''
+    return {'t_srs': 'EPSG:{}'.format(epsg), 'scale': '{},{},0,255'.format(scale_min, scale_max)}
+
+def merge_folder(folder, subdir, epsg=3031, scale_min=0., scale_max=0.85, cache_db=False):
+    '''merges the corrected files in folder/subdir into folder/subdir.merged.masked.tiff, returns the output path
+       or None if there is nothing to merge'''
+    files = sorted(glob.glob(os.path.join(folder, subdir, 'S1*.corrected.tif')))
+    output = os.path.join(folder, '{}.merged.masked.tiff'.format(subdir))
+    if not files:
+        return None
+    store = None
+    if cache_db:
+        store = cache.Cache(cache_db)
+        key = store.key('merge', files, get_merge_params(epsg, scale_min, scale_max))
+        if store.lookup('merge', key) is not None:
+            print('{} is unchanged, skipping.'.format(subdir))
+            store.close()
+            return output
+    print('merging {} files in {}...'.format(len(files), subdir))
+    with tracing.profile('merge.{}'.format(subdir)), tracing.span('merge', subdir=subdir, files=len(files)):
+        warped, mosaic = build_mosaic(files, epsg)
+        # the mosaic & warp are virtual, they are computed as the scaled output is written
+        with tracing.span('warp', subdir=subdir):
+            write_scaled(warped, output, scale_min, scale_max)
+        del warped, mosaic
+    if store is not None:
+        store.store('merge', key, [output])
+        store.close()
+    return output
+
+def build_mosaic(files, epsg):
+    '''returns a virtual warped dataset of the files mosaicked & reprojected to the epsg, with an alpha band, along
+       with the source mosaic which must be kept open while it is read. later files are drawn over earlier ones,
+       nodata (0) pixels are transparent.'''
+    vrt = gdal.BuildVRT('', files, options=gdal.BuildVRTOptions(srcNodata=0, VRTNodata=0, resolution='highest'))
+    options = gdal.WarpOptions(format='VRT', srcSRS='EPSG:4326', dstSRS='EPSG:{}'.format(epsg), resampleAlg='near',
+                               srcNodata=0, dstAlpha=True, multithread=True)
+    return gdal.Warp('', vrt, options=options), vrt
+
+def scale_block(data, alpha, scale_min, scale_max):
+    '''scales the block from scale_min..scale_max to 0..255. returns the byte values and the mask of valid pixels,
+       those covered by the warped alpha (source nodata is already transparent), however dark'''
+    scaled = np.round((data.astype(np.float32) - scale_min) * (255. / (scale_max - scale_min)))
+    scaled = np.clip(scaled, 0, 255).astype(np.uint8)
+    mask = alpha > 0
+    scaled[~mask] = 0
+    return scaled, mask
+
+def write_scaled(src, output, scale_min, scale_max):
+    '''scales & masks the warped dataset in a single windowed pass into an in memory byte raster, which is written
+       as a COG with an internal mask and overviews'''
+    xsize, ysize = src.RasterXSize, src.RasterYSize
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    dst = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+    dst.CreateMaskBand(gdal.GMF_PER_DATASET)
+    band = dst.GetRasterBand(1)
+    mask_band = band.GetMaskBand()
+    data_band = src.GetRasterBand(1)
+    alpha_band = src.GetRasterBand(src.RasterCount)
+    for yoff in range(0, ysize, BLOCK_SIZE):
+        rows = min(BLOCK_SIZE, ysize - yoff)
+        for xoff in range(0, xsize, BLOCK_SIZE):
+            cols = min(BLOCK_SIZE, xsize - xoff)
+            alpha = alpha_band.ReadAsArray(xoff, yoff, cols, rows)
+            if not alpha.any():
+                continue # tiles outside the footprint stay empty
+            scaled, mask = scale_block(data_band.ReadAsArray(xoff, yoff, cols, rows), alpha, scale_min, scale_max)
+            band.WriteArray(scaled, xoff, yoff)
+            mask_band.WriteArray(mask.astype(np.uint8) * 255, xoff, yoff)
+    cog.to_cog(dst, output)
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Merges the corrected files in each date subfolder into a single masked mosaic")
+    parse.add_argument("--folder", required=True, default=None, help="folder containing the date subfolders")
+    parse.add_argument("--workers", required=False, type=int, default=4, help="number of date folders to merge in parallel")
+    parse.add_argument("--epsg", required=False, type=int, default=3031, help="output projection EPSG code")
+    parse.add_argument("--scale_min", required=False, type=float, default=0., help="input value scaled to 0")
+    parse.add_argument("--scale_max", required=False, type=float, default=0.85, help="input value scaled to 255")
+    parse.add_argument("--cache", required=False, default=False, help="cache database (or workdir) used to skip unchanged date folders")
+    tracing.add_arguments(parse)
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    tracing.configure(args.trace, args.profile)
+    main(args.folder, workers=args.workers, epsg=args.epsg, scale_min=args.scale_min, scale_max=args.scale_max, cache_db=args.cache)
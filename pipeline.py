@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Runs the download -> calibrate -> merge -> render stages of the time series as overlapping stages. Each granule
+# moves on as soon as its download completes, with bounded queues between stages and a worker count per stage.
+# A date group is merged as soon as all of its granules have been calibrated.
+
+import os
+import re
+import queue
+import threading
+import workers
+import download
+import calibrate
+import group
+import merge
+import timelapse
+import cube
+
+QUEUE_SIZE = 4 # max granules waiting on a stage, per worker of that stage
+
+class Pipeline():
+    '''drives the granules of a metalink through the processing stages. subdirs maps granule names to their date
+       subfolder (eg from footprint.select), the other granules are grouped by interval as in group.py'''
+    def __init__(self, entries, workdir, polarization, wktstring, pixel_spacing=100, db=False, interval=0,
+                 engine='snap', cleanup=False, cache_db=False, authkey_file=False, shapefile=False, width=False,
+                 height=False, epsg=3031, download_workers=4, calibrate_workers=2, merge_workers=2, cube_path=False,
+                 subdirs=False, dem=False):
+        calibrate.check_engine(engine)
+        self.entries = entries
+        self.workdir = workdir
+        self.polarization = polarization
+        self.wktstring = wktstring
+        self.pixel_spacing = pixel_spacing
+        self.db = db
+        self.engine = engine
+        self.cleanup = cleanup
+        self.cache_db = cache_db
+        self.authkey_file = authkey_file
+        self.shapefile = shapefile
+        self.width = width
+        self.height = height
+        self.epsg = epsg
+        self.download_workers = download_workers
+        self.calibrate_workers = calibrate_workers
+        self.merge_workers = merge_workers
+        self.cube_path = cube_path
+        self.dem = dem
+        self.subdirs = dict(subdirs or {})
+        ungrouped = [entry for entry in entries if not entry.name in self.subdirs]
+        if ungrouped:
+            self.subdirs.update(get_subdirs(ungrouped, interval))
+        self.remaining = {}
+        for subdir in self.subdirs.values():
+            self.remaining[subdir] = self.remaining.get(subdir, 0) + 1
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        '''runs every stage to completion, returns a list of (granule, stage, error) for failed granules'''
+        print('processing {} granules in {} date groups...'.format(len(self.entries), len(self.remaining)))
+        self.download_queue = queue.Queue()
+        for entry in self.entries:
+            self.download_queue.put(entry)
+        self.calibrate_queue = queue.Queue(maxsize=QUEUE_SIZE * self.calibrate_workers)
+        self.merge_queue = queue.Queue()
+        self.progress = download.Progress(sum([entry.size for entry in self.entries if entry.size]))
+        # calibration & merging run in spawned processes, each with their own JVM / GDAL state. a worker that dies
+        # fails its granule or date group only, so no stage waits on it forever
+        with workers.Pool(self.calibrate_workers) as self.calibrate_pool, workers.Pool(self.merge_workers) as self.merge_pool:
+            downloaders = start_threads(self.download_worker, self.download_workers)
+            calibrators = start_threads(self.calibrate_worker, self.calibrate_workers)
+            mergers = start_threads(self.merge_worker, self.merge_workers)
+            # shut each stage down once the stage feeding it has finished
+            join_threads(downloaders)
+            for _ in calibrators:
+                self.calibrate_queue.put(None)
+            join_threads(calibrators)
+            for _ in mergers:
+                self.merge_queue.put(None)
+            join_threads(mergers)
+        self.progress.report()
+        if self.cube_path:
+            # appended once all dates are merged, the cube is written by a single process
+            cube.main(self.workdir, self.cube_path, self.epsg)
+        if self.width and self.height and self.shapefile:
+            timelapse.main(self.workdir, self.shapefile, self.width, self.height, cache_db=self.cache_db,
+                           cube_path=self.cube_path)
+        if self.failed:
+            print('{} granules failed:'.format(len(self.failed)))
+            for name, stage, _ in self.failed:
+                print('    {} ({})'.format(name, stage))
+        return self.failed
+
+    def download_worker(self):
+        '''downloads granules over a keep-alive session, passing each to calibration as soon as it completes'''
+        user, password = download.read_authkey(self.authkey_file) if self.authkey_file else (None, None)
+        session = download.new_session(user, password)
+        while True:
+            try:
+                entry = self.download_queue.get_nowait()
+            except queue.Empty:
+                return
+            path, error = download.download_with_retries(entry, self.workdir, session, self.progress)
+            if error is not None:
+                self.granule_done(entry, 'download', error)
+            else:
+                self.calibrate_queue.put((entry, path)) # blocks while calibration is behind
+
+    def calibrate_worker(self):
+        '''calibrates downloaded granules into their date subfolder'''
+        while True:
+            item = self.calibrate_queue.get()
+            if item is None:
+                return
+            entry, path = item
+            outfolder = os.path.join(self.workdir, self.subdirs[entry.name])
+            args = (path, outfolder, self.polarization, False, self.wktstring, self.pixel_spacing, self.db,
+                    self.cleanup, False, self.engine, self.cache_db, True, self.dem)
+            try:
+                _, _, error = self.calibrate_pool.apply(calibrate._calibrate_job, (args,))
+            except Exception as err:
+                error = str(err)
+            if error is None and self.cleanup:
+                calibrate.remove_product(path)
+            self.granule_done(entry, 'calibrate', error)
+
+    def merge_worker(self):
+        '''merges date subfolders once all their granules are calibrated, pre-cropping their frames if cached'''
+        while True:
+            subdir = self.merge_queue.get()
+            if subdir is None:
+                return
+            try:
+                output = self.merge_pool.apply(merge.merge_folder, (self.workdir, subdir, self.epsg, 0., 0.85, self.cache_db))
+                if output and self.cache_db and self.width and self.height and self.shapefile:
+                    self.merge_pool.apply(timelapse.read_frame, (output, self.shapefile, self.width, self.height, self.cache_db))
+            except Exception as err:
+                with self.lock:
+                    self.failed.append((subdir, 'merge', str(err)))
+
+    def granule_done(self, entry, stage, error=None):
+        '''records the granule as finished (or failed), queueing its date group for merging if it was the last one'''
+        subdir = self.subdirs[entry.name]
+        with self.lock:
+            if error is not None:
+                print('{} failed {}:\n{}'.format(entry.name, stage, error))
+                self.failed.append((entry.name, stage, error))
+            self.remaining[subdir] -= 1
+            complete = self.remaining[subdir] == 0
+        if complete:
+            print('date group {} is calibrated, merging.'.format(subdir))
+            self.merge_queue.put(subdir)
+
+def get_subdirs(entries, interval):
+    '''returns a dict of granule name -> date subfolder, grouped the same way as group.py'''
+    gran_list = []
+    for entry in entries:
+        gran = group.granule()
+        gran.path = entry.name
+        gran.datetime = group.get_filename_datetime(entry.name)
+        if gran.datetime is None:
+            raise Exception('unable to parse the acquisition time of {}'.format(entry.name))
+        gran_list.append(gran)
+    group.group_granules(gran_list, interval)
+    return dict([(gran.path, gran.subdir) for gran in gran_list])
+
+def get_calibration_polarization(pol):
+    '''returns the single polarization to calibrate for an ASF polarization query, eg HH for HH+HV'''
+    found = re.findall('|'.join(calibrate.allowed_polarizations), str(pol))
+    if not found:
+        return 'HH'
+    return found[0]
+
+def start_threads(target, count):
+    '''starts count threads running target'''
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+def join_threads(threads):
+    for thread in threads:
+        thread.join()
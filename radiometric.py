@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Radiometric calibration of GRD amplitudes, sigma0 = DN^2 / A^2, from the calibration vectors of the product
+# annotation. Kept apart from the GDAL reads & writes of calibrate_numpy.py, so it can be checked without GDAL.
+
+import numpy as np
+
+def parse_calibration_lut(root, lut_name='sigmaNought'):
+    '''parses the calibration vectors. returns the vector lines, the pixels and a (lines x pixels) array of lut values.
+       vectors are resampled onto the pixels of the first vector if they differ.'''
+    lines = []
+    values = []
+    pixels = None
+    for vector in root.iter('calibrationVector'):
+        vec_pixels = np.array(vector.find('pixel').text.split(), dtype=np.float64)
+        vec_values = np.array(vector.find(lut_name).text.split(), dtype=np.float64)
+        if pixels is None:
+            pixels = vec_pixels
+        elif not np.array_equal(pixels, vec_pixels):
+            vec_values = np.interp(pixels, vec_pixels, vec_values)
+        lines.append(float(vector.find('line').text))
+        values.append(vec_values)
+    if not lines:
+        raise Exception('no calibration vectors found')
+    order = np.argsort(lines)
+    return np.array(lines)[order], pixels, np.array(values)[order]
+
+class LutInterpolator():
+    '''bilinear interpolation of the calibration lut over blocks of the image. each vector is interpolated
+       across the columns of the window once, blocks only interpolate between the two bracketing vectors.'''
+    def __init__(self, lines, pixels, lut, xoff, xsize):
+        columns = np.arange(xoff, xoff + xsize, dtype=np.float64)
+        self.lines = lines
+        self.rows = np.array([np.interp(columns, pixels, vec) for vec in lut], dtype=np.float32)
+
+    def block(self, yoff, ysize):
+        '''returns the (ysize x xsize) lut for image rows yoff:yoff+ysize'''
+        if len(self.lines) == 1:
+            return np.repeat(self.rows, ysize, axis=0)
+        rows = np.arange(yoff, yoff + ysize, dtype=np.float64)
+        idx = np.clip(np.searchsorted(self.lines, rows, side='right') - 1, 0, len(self.lines) - 2)
+        weight = (rows - self.lines[idx]) / (self.lines[idx + 1] - self.lines[idx])
+        weight = np.clip(weight, 0., 1.).astype(np.float32)[:, np.newaxis]
+        return self.rows[idx] * (1. - weight) + self.rows[idx + 1] * weight
+
+def calibrate_block(dn, lut, db, looks=(1, 1)):
+    '''returns sigma0 = DN^2 / A^2 for the block, multilooked by the (azimuth, range) looks and in decibels if db is
+       set. zero DN values are left as nodata (0)'''
+    dn = dn.astype(np.float32)
+    sigma0 = np.zeros(dn.shape, dtype=np.float32)
+    valid = dn > 0
+    sigma0[valid] = np.square(dn[valid]) / np.square(lut[valid])
+    if looks != (1, 1):
+        sigma0, valid = multilook_block(sigma0, valid, looks)
+    if db:
+        sigma0[valid] = 10. * np.log10(np.maximum(sigma0[valid], 1e-10))
+    return sigma0
+
+def multilook_block(power, valid, looks):
+    '''averages the valid linear power over (azimuth, range) looks. returns the averaged power and the mask of
+       output pixels with any valid input'''
+    az, rg = looks
+    rows, cols = power.shape[0] // az, power.shape[1] // rg
+    shape = (rows, az, cols, rg)
+    total = power[:rows * az, :cols * rg].reshape(shape).sum(axis=(1, 3), dtype=np.float64)
+    count = valid[:rows * az, :cols * rg].reshape(shape).sum(axis=(1, 3))
+    out = np.zeros((rows, cols), dtype=np.float32)
+    ok = count > 0
+    out[ok] = total[ok] / count[ok]
+    return out, ok
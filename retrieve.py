@@ -10,14 +10,29 @@ import html
 import json
 import shutil
 import argparse
-import subprocess
 import requests
 import fiona
 import shapely.geometry
-
-
-def main(shapefile=False, workdir=False, pol=False, res='MR', max_results=False, cleanup=False, dry_run=False):
-    '''main wrapper script for generating time series'''
+import download
+import calibrate
+import pipeline
+import footprint
+import tracing
+
+
+def main(shapefile=False, workdir=False, pol=False, res='MR', max_results=False, cleanup=False, dry_run=False, workers=4,
+         download_only=False, pixel_spacing=100, db=False, interval=0, engine='snap', calibrate_workers=2,
+         merge_workers=2, width=False, height=False, cache_db=False, select=False, min_overlap=0.01,
+         cube_path=False, dem=False):
+    '''main wrapper script for generating time series. granules are calibrated as soon as they are downloaded,
+       and each date group is merged once all of its granules are calibrated. if width & height are given the
+       timelapse is rendered at the end. select drops granules covering less than min_overlap of the AOI, or
+       redundant with the other granules of their date group. cube_path appends the merged dates to a time series
+       cube, which the timelapse is then rendered from. dem is used for terrain correction, see calibrate.py. engine
+       is snap as in calibrate.py, numpy is opt-in for when snappy isn't installed alongside gdal. returns a list of
+       failed granules'''
+    if not (dry_run or download_only):
+        calibrate.check_engine(engine) # fail before downloading anything
     script_dir = os.path.dirname(os.path.realpath(__file__))
     if workdir is False:
         workdir = os.getcwd()
@@ -41,17 +56,39 @@ def main(shapefile=False, workdir=False, pol=False, res='MR', max_results=False,
     asf_string = convert_wkt_to_asf(wkt_string)
     print('parsed shapefile.\nQuerying ASF for granules...')
     query_asf(pol, res, max_results, asf_string)
-    drystr = ' (dry-run only)' if dry_run else ''
-    print('--------------------------------\nDownloading files from ASF...{}'.format(drystr))
-    download_asf(pol, res, max_results, asf_string, authkey_file, dry_run, workdir)
-
-    #per zip file:
-        #unzip file
-        #calibrate each file & compress the result
-
-    #merge files into folders by date
-    #merge each folder into a composite
-    #generate the time series
+    query = gen_asf_query(pol, res, max_results, asf_string, retrieve=True)
+    entries = download.parse_metalink(download.fetch_metalink(query))
+    subdirs = False
+    if select:
+        entries, subdirs = select_granules(entries, shapefile, pol, res, max_results, asf_string, min_overlap, interval)
+    if dry_run:
+        print('--------------------------------\n{} files would be downloaded from ASF (dry-run only):'.format(len(entries)))
+        download.print_entries(entries)
+        return []
+    if download_only:
+        print('--------------------------------\nDownloading files from ASF...')
+        user, password = download.read_authkey(authkey_file)
+        return download.download_all(entries, workdir, user, password, workers)
+
+    print('--------------------------------\nDownloading & processing files from ASF...')
+    runner = pipeline.Pipeline(entries, workdir, pipeline.get_calibration_polarization(pol), wkt_string,
+                               pixel_spacing=pixel_spacing, db=db, interval=interval, engine=engine, cleanup=cleanup,
+                               cache_db=cache_db, authkey_file=authkey_file, shapefile=shapefile, width=width,
+                               height=height, download_workers=workers, calibrate_workers=calibrate_workers,
+                               merge_workers=merge_workers, cube_path=cube_path, subdirs=subdirs,
+                               dem=dem)
+    return runner.run()
+
+def select_granules(entries, shapefile, pol, res, max_results, poly_str, min_overlap, interval):
+    '''filters the metalink entries to the granules selected from their ASF footprints. returns the entries and a
+       dict of granule name -> the date subfolder it was selected for'''
+    print('selecting granules by AOI coverage...')
+    query = gen_asf_query(pol, res, max_results, poly_str, retrieve=True, output='geojson')
+    footprints = footprint.fetch_asf_footprints(query)
+    selected, dropped, subdirs = footprint.select(footprints, footprint.get_aoi(shapefile), min_overlap, interval)
+    footprint.report(selected, dropped)
+    names = set([fp.name for fp in selected])
+    return [entry for entry in entries if entry.name in names], subdirs
 
 def convert_kml_to_shapefile(kml_path):
     '''converts the input kml into a shapefile'''
@@ -93,7 +130,7 @@ def query_asf(pol, res, max_results, poly_str):
         maxstr = ', only retrieving {} products'.format(max_results)
     print('ASF has {} results matching input parameters{}...'.format(response.text.strip(), maxstr))
 
-def gen_asf_query(pol, res, max_results, poly_str, retrieve=False):
+def gen_asf_query(pol, res, max_results, poly_str, retrieve=False, output=False):
     # polarization
     polstr = ''
     if not pol is None:
@@ -107,20 +144,11 @@ def gen_asf_query(pol, res, max_results, poly_str, retrieve=False):
         maxstr = '&maxResults={}'.format(max_results)
     retstr = '&output=count'
     if retrieve:
-        retstr = '&output=metalink'
+        retstr = '&output={}'.format(output if output else 'metalink')
     query="https://api.daac.asf.alaska.edu/services/search/param?platform=S1{}{}{}{}{}".format(resstr, polstr, maxstr, '&' + poly_str, retstr)
     qstr = html.escape(query).replace('&amp;', '&')
     return qstr
 
-def download_asf(pol, res, max_results, poly_str, authkey_file, dry_run, workdir):
-    query = gen_asf_query(pol, res, max_results, poly_str, retrieve=True)
-    dry_run_str = ''
-    if dry_run:
-        dry_run_str = '--dry-run '
-    cmd = '. {} && aria2c --continue {}--dir="{}" --http-auth-challenge=true --http-user="$EARTHDATA_USER" --http-passwd="$EARTHDATA_PASSWORD" "{}"'.format(authkey_file, dry_run_str, workdir, query)
-    #print('system command: {}'.format(cmd))
-    subprocess.Popen(cmd, shell=True)
-
 def parser():
     '''
     Construct a parser to parse arguments, returns the parser
@@ -132,10 +160,32 @@ def parser():
     parse.add_argument("--resolution", required=False, default="MR", choices=["FR", "HR", "MR"], help="GRD resolution: FR, HR, or MR (Full, High, or Medium)")
     parse.add_argument("--max_results", required=False, default=False, type=int, help="max number of input files to download")
     parse.add_argument("--dry_run", action="store_true", help="checks file availability but does not download files")
+    parse.add_argument("--workers", required=False, default=4, type=int, help="number of concurrent downloads")
+    parse.add_argument("--download_only", action="store_true", help="only download the granules, without processing them")
+    parse.add_argument("--pixel_spacing", required=False, default=100, type=float, help="Pixel spacing in meters")
+    parse.add_argument("--in_decibels", action="store_true", help="calibrated products are scaled in decibels")
+    parse.add_argument("--interval", required=False, type=float, default=0, help="n day time interval to group granules. 0 will be same day.")
+    parse.add_argument("--engine", required=False, default='snap', choices=['snap', 'numpy'], help="calibration engine. snap (the default) needs snappy installed alongside gdal, numpy is opt-in and needs only gdal")
+    parse.add_argument("--calibrate_workers", required=False, default=2, type=int, help="number of granules to calibrate concurrently")
+    parse.add_argument("--merge_workers", required=False, default=2, type=int, help="number of date groups to merge concurrently")
+    parse.add_argument("--width", required=False, default=False, type=int, help="timelapse frame width, renders the timelapse if set with --height")
+    parse.add_argument("--height", required=False, default=False, type=int, help="timelapse frame height")
+    parse.add_argument("--cache", required=False, default=False, help="cache database (or workdir) used to skip unchanged work")
+    parse.add_argument("--select", action="store_true", help="only download the fewest granules covering the AOI per date group")
+    parse.add_argument("--min_overlap", required=False, type=float, default=0.01, help="min fraction of the AOI a selected granule must cover")
+    parse.add_argument("--dem", required=False, default=False, help="DEM (eg a VRT of local tiles) to terrain correct with")
+    parse.add_argument("--cube", required=False, default=False, help="time series cube (zarr) to append the merged dates to")
+    tracing.add_arguments(parse)
     parse.add_argument("-c", "--cleanup", action="store_true", help="cleanup intermediate files")    
     return parse
 
 
 if __name__ == '__main__':
     args = parser().parse_args()
-    main(shapefile=args.shapefile, workdir=args.path, pol=args.polarization, res=args.resolution, max_results=args.max_results, cleanup=args.cleanup, dry_run=args.dry_run)
+    tracing.configure(args.trace, args.profile)
+    with tracing.profile('retrieve'):
+        main(shapefile=args.shapefile, workdir=args.path, pol=args.polarization, res=args.resolution, max_results=args.max_results, cleanup=args.cleanup, dry_run=args.dry_run, workers=args.workers,
+             download_only=args.download_only, pixel_spacing=args.pixel_spacing, db=args.in_decibels, interval=args.interval,
+             engine=args.engine, calibrate_workers=args.calibrate_workers, merge_workers=args.merge_workers,
+             width=args.width, height=args.height, cache_db=args.cache, select=args.select, min_overlap=args.min_overlap,
+             cube_path=args.cube, dem=args.dem)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+# Helpers for Sentinel-1 GRD products, either .SAFE folders or their zips, shared by the SNAP & numpy calibration
+# engines. Standard library only, so it loads in the SNAP images that have neither numpy nor gdal.
+
+import os
+import zipfile
+
+def is_zip_product(path):
+    '''returns True if the path is a zipped product'''
+    return path.lower().endswith('zip') and zipfile.is_zipfile(path)
+
+def get_product_basename(path):
+    '''returns the product name used for output filenames, identical for a zip and its extracted .SAFE folder'''
+    folder = os.path.basename(path.rstrip('/'))
+    if is_zip_product(path):
+        folder = os.path.splitext(folder)[0] + '.SAFE'
+    if folder.endswith('.SAFE'):
+        folder = folder[:-len('.SAFE')]
+    return folder
+
+def get_looks(azimuth_spacing, range_spacing, pixel_spacing):
+    '''returns the (azimuth, range) multilook factors, the whole number of native pixels within the pixel spacing'''
+    return max(1, int(pixel_spacing // azimuth_spacing)), max(1, int(pixel_spacing // range_spacing))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3.6
+
+# Long lived SNAP calibration service. A supervisor listens on a local socket and hands calibration jobs to a worker
+# process that starts the JVM and loads the SNAP operators once, then calibrates product after product. The worker
+# is replaced after a number of jobs, when its JVM heap passes a threshold or if it dies, so leaks stay bounded.
+# calibrate.py --daemon submits its products here instead of starting SNAP itself. Requests are pickled, so the
+# daemon only accepts clients holding its key: S1GRD_DAEMON_KEY, or a random key written at startup to a file only
+# the user can read. By default it listens on a unix socket in a directory only the user can enter.
+
+import os
+import socket
+import binascii
+import argparse
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+import workers
+
+RUN_DIR = os.path.join(os.path.expanduser('~'), '.s1grd') # holds the socket & key file, mode 0700
+DEFAULT_ADDRESS = os.path.join(RUN_DIR, 'snap_daemon.sock')
+AUTHKEY_ENV = 'S1GRD_DAEMON_KEY' # shared secret for the socket, overrides the key file
+KEY_FILE = os.path.join(RUN_DIR, 'snap_daemon.key')
+MAX_JOBS = 50 # jobs before the worker is replaced
+MAX_HEAP_MB = 0 # used JVM heap after a job above which the worker is replaced, 0 to disable
+
+class Supervisor():
+    '''serves jobs from any number of client connections, one job at a time on the worker'''
+    def __init__(self, address, authkey, max_jobs=MAX_JOBS, max_heap_mb=MAX_HEAP_MB, worker_mem=False):
+        self.listener = Listener(address, authkey=authkey)
+        self.authkey = authkey
+        self.max_jobs = max_jobs
+        self.max_heap_mb = max_heap_mb
+        self.worker_mem = worker_mem
+        self.worker = None
+        self.lock = threading.Lock()
+        self.running = True
+        self.served = 0
+        self.restarts = 0
+
+    def serve(self):
+        print('SNAP daemon listening on {}'.format(format_address(self.listener.address)))
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except Exception as err:
+                if not self.running:
+                    break
+                print('rejected connection: {}'.format(err))
+                continue
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        with self.lock:
+            if self.worker is not None:
+                self.worker.close()
+
+    def handle(self, conn):
+        '''answers the requests of a client until it disconnects'''
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                conn.send(self.dispatch(request))
+                if not self.running:
+                    # replied, now wake the accept loop so it sees the shutdown
+                    try:
+                        Client(self.listener.address, authkey=self.authkey).close()
+                    except Exception:
+                        pass
+                    return
+        finally:
+            conn.close()
+
+    def dispatch(self, request):
+        action = request.get('action')
+        if action == 'calibrate':
+            return self.calibrate(request['job'])
+        elif action == 'status':
+            # no lock, calibrate holds it for the whole job
+            worker = self.worker
+            return {'served': self.served, 'restarts': self.restarts, 'worker_pid': worker.proc.pid if worker else None,
+                    'worker_jobs': worker.jobs if worker else 0, 'busy': self.lock.locked()}
+        elif action == 'shutdown':
+            self.running = False
+            return {'ok': True}
+        return {'error': 'unknown action: {}'.format(action)}
+
+    def calibrate(self, job):
+        with self.lock:
+            if self.worker is None:
+                if self.worker_mem:
+                    os.environ['_JAVA_OPTIONS'] = '-Xmx{}'.format(self.worker_mem) # inherited by the spawned worker
+                self.worker = workers.Worker(initializer=start_snap)
+            try:
+                reply = self.worker.apply(run_snap_job, (job,))
+            except workers.WorkerDied as err:
+                # the job may be what killed the worker, so it isn't retried
+                self.replace_worker('worker died')
+                return {'error': str(err)}
+            except Exception as err:
+                return {'error': str(err)}
+            self.served += 1
+            heap = reply.get('heap_mb')
+            if self.worker.jobs >= self.max_jobs:
+                self.replace_worker('{} jobs served'.format(self.worker.jobs))
+            elif self.max_heap_mb and heap is not None and heap > self.max_heap_mb:
+                self.replace_worker('heap at {:.0f} MB'.format(heap))
+            return reply
+
+    def replace_worker(self, reason):
+        '''stops the worker, a new one is started for the next job'''
+        print('replacing SNAP worker: {}'.format(reason))
+        self.worker.close()
+        self.worker = None
+        self.restarts += 1
+
+def start_snap():
+    '''worker initializer: starts the JVM & loads the SNAP operators once, for every job of the worker'''
+    import calibrate
+    calibrate.check_engine('snap')
+    calibrate.load_operators()
+
+def run_snap_job(job):
+    '''runs in the worker: calibrates the job, returns its reply with the JVM heap used after it'''
+    import calibrate
+    import tracing
+    reply = run_job(calibrate, job)
+    # collect first, so the heap reported is what the worker is actually holding on to
+    calibrate.snappy.jpy.get_type('java.lang.System').gc()
+    reply['heap_mb'] = tracing.jvm_heap_mb()
+    return reply
+
+def run_job(calibrate, job):
+    '''calibrates the job's product (a .SAFE folder or zip), returns {'error': None or traceback}'''
+    try:
+        product = calibrate.unzip_check(job['path'], job['cleanup'], job['polarization'], job['unzip'])
+        if not calibrate.contains_valid_product(product, job['polarization']):
+            return {'error': 'no valid product found in {}'.format(job['path'])}
+        calibrate.calibrate_file(product, job['outfolder'], job['polarization'], job['basename'], job['wktstring'],
+                                 job['pixel_spacing'], job['db'], job['cleanup'], debug=job['debug'],
+                                 engine='snap', cache_db=job['cache_db'], multilook=job.get('multilook', True),
+                                 dem=job.get('dem', False))
+    except Exception:
+        return {'error': traceback.format_exc()}
+    return {'error': None}
+
+def parse_address(text):
+    '''returns a (host, port) tuple for host:port, or the path of a unix socket'''
+    host, _, port = text.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return text
+
+def format_address(address):
+    if isinstance(address, tuple):
+        return '{}:{}'.format(*address)
+    return address
+
+def make_private_dir(path):
+    '''creates the folder readable by the user only, refusing one owned by someone else'''
+    if not os.path.exists(path):
+        os.makedirs(path, mode=0o700)
+    if os.stat(path).st_uid != os.getuid():
+        raise Exception('{} is not owned by the current user'.format(path))
+    os.chmod(path, 0o700)
+
+def create_authkey():
+    '''returns S1GRD_DAEMON_KEY if set, otherwise a new random key written to KEY_FILE (mode 0600) for clients'''
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode('utf-8')
+    make_private_dir(os.path.dirname(KEY_FILE))
+    key = binascii.hexlify(os.urandom(32))
+    if os.path.exists(KEY_FILE):
+        os.remove(KEY_FILE)
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as fout:
+        fout.write(key)
+    return key
+
+def get_authkey():
+    '''returns the key of the running daemon, from S1GRD_DAEMON_KEY or KEY_FILE'''
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode('utf-8')
+    if not os.path.exists(KEY_FILE):
+        raise Exception('no daemon key found, set {} or start snap_daemon.py as this user'.format(AUTHKEY_ENV))
+    with open(KEY_FILE, 'rb') as fin:
+        return fin.read().strip()
+
+def prepare_socket(address):
+    '''makes the folder of a unix socket private and removes a stale socket, raises if a daemon is listening on it'''
+    if isinstance(address, tuple):
+        return
+    make_private_dir(os.path.dirname(os.path.abspath(address)))
+    if os.path.exists(address):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(address)
+        except (OSError, IOError):
+            os.remove(address)
+            return
+        finally:
+            sock.close()
+        raise Exception('a daemon is already listening on {}'.format(address))
+
+def submit(address, request):
+    '''sends a single request to the daemon at the address (host:port or a unix socket path), returns the reply'''
+    conn = Client(parse_address(address), authkey=get_authkey())
+    try:
+        conn.send(request)
+        return conn.recv()
+    finally:
+        conn.close()
+
+def main(address=DEFAULT_ADDRESS, max_jobs=MAX_JOBS, max_heap_mb=MAX_HEAP_MB, worker_mem=False):
+    '''runs the daemon until it is sent a shutdown request'''
+    address = parse_address(address)
+    prepare_socket(address)
+    Supervisor(address, create_authkey(), max_jobs, max_heap_mb, worker_mem).serve()
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Runs a persistent SNAP calibration worker, see calibrate.py --daemon")
+    parse.add_argument("--address", required=False, default=DEFAULT_ADDRESS, help="unix socket path or host:port to listen on. Defaults to {}".format(DEFAULT_ADDRESS))
+    parse.add_argument("--max_jobs", required=False, type=int, default=MAX_JOBS, help="jobs before the SNAP worker is restarted")
+    parse.add_argument("--max_heap", required=False, type=float, default=MAX_HEAP_MB, help="used JVM heap (MB) after a job above which the worker is restarted, 0 to disable")
+    parse.add_argument("--worker_mem", required=False, default=False, help="max JVM heap of the worker, eg 8G. Defaults to the snappy.ini setting")
+    parse.add_argument("--status", action="store_true", help="print the status of a running daemon")
+    parse.add_argument("--shutdown", action="store_true", help="stop a running daemon")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    if args.status:
+        print(submit(args.address, {'action': 'status'}))
+    elif args.shutdown:
+        print(submit(args.address, {'action': 'shutdown'}))
+    else:
+        main(args.address, max_jobs=args.max_jobs, max_heap_mb=args.max_heap, worker_mem=args.worker_mem)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Synthetic Sentinel-1 EW GRDM products for the benchmark & tests. Each product holds a manifest, annotation &
+# calibration xml and a UInt16 measurement tiff with GCPs, the files the numpy engine reads. Scenes are slices along
+# a track over Antarctica, several per date with dates 12 days apart.
+
+import os
+import datetime
+import numpy as np
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+gdal.UseExceptions()
+
+METERS_PER_DEG = 111319.49079327357
+LON0, LAT0 = -100., -75. # north west corner of the first scene
+SPACING = 40. # native (EW GRDM) range & azimuth pixel spacing in meters
+ORBIT0 = 25000 # absolute orbit of the first date, later dates repeat the track every 175 orbits
+GRID_POINTS = 10 # geolocation grid points along each axis
+CAL_LINES = 200 # lines between calibration vectors
+CAL_PIXELS = 40 # pixels between calibration vector samples
+
+def get_scene_corner(index, height):
+    '''returns the lon, lat of the north west corner of the nth scene of a date. consecutive slices of a date overlap
+       by a fifth of their height, further south along the track'''
+    return LON0, LAT0 - index * 0.8 * height * SPACING / METERS_PER_DEG
+
+def pixel_to_lonlat(lon0, lat0, line, pixel):
+    '''returns the lon, lat of the image line & pixel of a scene with its north west corner at lon0, lat0'''
+    lat = lat0 - line * SPACING / METERS_PER_DEG
+    lon = lon0 + pixel * SPACING / (METERS_PER_DEG * np.cos(np.radians(lat)))
+    return lon, lat
+
+def get_aoi_wkt(per_date, width, height):
+    '''returns a wkt box over the middle of the scenes of a date, crossing the slice boundaries'''
+    lon0, lat0 = get_scene_corner(0, height)
+    _, lat1 = get_scene_corner(per_date - 1, height)
+    lat1 -= height * SPACING / METERS_PER_DEG
+    lon_left, _ = pixel_to_lonlat(lon0, lat1, 0, 0.25 * width)
+    lon_right, _ = pixel_to_lonlat(lon0, lat0, 0, 0.75 * width)
+    north = lat0 - 0.25 * (lat0 - lat1)
+    south = lat1 + 0.25 * (lat0 - lat1)
+    return 'POLYGON (({0} {2},{1} {2},{1} {3},{0} {3},{0} {2}))'.format(lon_left, lon_right, north, south)
+
+def write_aoi(path, wkt):
+    '''writes the wkt polygon to an EPSG:4326 shapefile'''
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    ds = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = ds.CreateLayer('aoi', srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+    layer.CreateFeature(feature)
+    ds = None
+
+def generate(folder, scenes, per_date, width, height, seed=0):
+    '''writes the synthetic .SAFE products, per_date slices on each date 12 days apart. returns their paths'''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(scenes):
+        date, index = divmod(i, per_date)
+        start = datetime.datetime(2019, 1, 5, 12, 0, 0) + datetime.timedelta(days=12 * date, seconds=60 * index)
+        paths.append(write_product(folder, start, ORBIT0 + 175 * date, index, width, height, rng))
+    return paths
+
+def get_names(start, orbit):
+    '''returns the product name and the measurement/annotation file stem for the start time & absolute orbit'''
+    stop = start + datetime.timedelta(seconds=60)
+    fmt = '%Y%m%dT%H%M%S'
+    datatake = '{:06X}'.format(0x02C000 + orbit % 0x1000)
+    name = 'S1A_EW_GRDM_1SDH_{}_{}_{:06d}_{}_{:04X}'.format(start.strftime(fmt), stop.strftime(fmt), orbit, datatake, orbit % 0xFFFF)
+    stem = 's1a-ew-grd-hh-{}-{}-{:06d}-{}-001'.format(start.strftime(fmt).lower(), stop.strftime(fmt).lower(), orbit, datatake.lower())
+    return name, stem
+
+def write_product(folder, start, orbit, index, width, height, rng):
+    '''writes a single synthetic product, returns the .SAFE path'''
+    name, stem = get_names(start, orbit)
+    safe = os.path.join(folder, name + '.SAFE')
+    for sub in ['measurement', os.path.join('annotation', 'calibration')]:
+        if not os.path.exists(os.path.join(safe, sub)):
+            os.makedirs(os.path.join(safe, sub))
+    lon0, lat0 = get_scene_corner(index, height)
+    grid = get_geolocation_grid(lon0, lat0, width, height)
+    corners = [pixel_to_lonlat(lon0, lat0, line, pixel) for line, pixel in [(0, 0), (0, width), (height, width), (height, 0)]]
+    with open(os.path.join(safe, 'manifest.safe'), 'w') as fout:
+        fout.write(manifest_xml(corners))
+    with open(os.path.join(safe, 'annotation', stem + '.xml'), 'w') as fout:
+        fout.write(annotation_xml(start, width, height, grid))
+    with open(os.path.join(safe, 'annotation', 'calibration', 'calibration-' + stem + '.xml'), 'w') as fout:
+        fout.write(calibration_xml(width, height))
+    write_measurement(os.path.join(safe, 'measurement', stem + '.tiff'), width, height, grid, rng)
+    return safe
+
+def get_geolocation_grid(lon0, lat0, width, height):
+    '''returns a list of (line, pixel, lon, lat, incidence angle) over the scene'''
+    grid = []
+    for line in np.linspace(0, height - 1, GRID_POINTS):
+        for pixel in np.linspace(0, width - 1, GRID_POINTS):
+            lon, lat = pixel_to_lonlat(lon0, lat0, line, pixel)
+            grid.append((int(line), int(pixel), lon, lat, 19. + 28. * pixel / (width - 1)))
+    return grid
+
+def manifest_xml(corners):
+    coords = ' '.join(['{:.6f},{:.6f}'.format(lat, lon) for lon, lat in corners])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:safe="http://www.esa.int/safe/sentinel-1.0" '
+            'xmlns:gml="http://www.opengis.net/gml"><metadataSection><metadataObject ID="measurementFrameSet">'
+            '<metadataWrap><xmlData><safe:frameSet><safe:frame><safe:footPrint srsName="http://www.opengis.net/gml/srs/epsg.xml#4326">'
+            '<gml:coordinates>{}</gml:coordinates></safe:footPrint></safe:frame></safe:frameSet></xmlData></metadataWrap>'
+            '</metadataObject></metadataSection></xfdu:XFDU>\n').format(coords)
+
+def annotation_xml(start, width, height, grid):
+    points = ''.join(['<geolocationGridPoint><line>{}</line><pixel>{}</pixel><latitude>{:.8f}</latitude>'
+                      '<longitude>{:.8f}</longitude><height>0</height><incidenceAngle>{:.6f}</incidenceAngle>'
+                      '</geolocationGridPoint>'.format(line, pixel, lat, lon, inc) for line, pixel, lon, lat, inc in grid])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<product><adsHeader><missionId>S1A</missionId><productType>GRD</productType>'
+            '<polarisation>HH</polarisation><mode>EW</mode><startTime>{}</startTime></adsHeader><imageAnnotation><imageInformation>'
+            '<rangePixelSpacing>{}</rangePixelSpacing><azimuthPixelSpacing>{}</azimuthPixelSpacing>'
+            '<numberOfSamples>{}</numberOfSamples><numberOfLines>{}</numberOfLines></imageInformation></imageAnnotation>'
+            '<geolocationGrid><geolocationGridPointList count="{}">{}</geolocationGridPointList></geolocationGrid></product>\n').format(
+            start.isoformat(), SPACING, SPACING, width, height, len(grid), points)
+
+def calibration_xml(width, height):
+    pixels = list(range(0, width, CAL_PIXELS)) + [width - 1]
+    vectors = []
+    for line in list(range(0, height, CAL_LINES)) + [height - 1]:
+        # range dependent lut, as in real products
+        values = ['{:.6e}'.format(600. + 100. * pixel / width + 0.01 * line) for pixel in pixels]
+        vectors.append('<calibrationVector><line>{}</line><pixel count="{}">{}</pixel><sigmaNought count="{}">{}</sigmaNought>'
+                       '</calibrationVector>'.format(line, len(pixels), ' '.join(map(str, pixels)), len(values), ' '.join(values)))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<calibration><calibrationVectorList count="{}">{}</calibrationVectorList>'
+            '</calibration>\n').format(len(vectors), ''.join(vectors))
+
+def write_measurement(path, width, height, grid, rng):
+    '''writes the UInt16 amplitude (DN) raster with speckle over a smooth backscatter field, and the GCPs'''
+    ds = gdal.GetDriverByName('GTiff').Create(path, width, height, 1, gdal.GDT_UInt16, ['TILED=NO'])
+    gcps = [gdal.GCP(lon, lat, 0., pixel, line) for line, pixel, lon, lat, _ in grid]
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetGCPs(gcps, srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    cols = np.arange(width)
+    for row in range(0, height, 512):
+        rows = np.arange(row, min(row + 512, height))[:, np.newaxis]
+        field = 120. + 60. * np.sin(rows / 150.) * np.cos(cols / 210.)
+        speckle = rng.rayleigh(1., size=(len(rows), width)) / np.sqrt(np.pi / 2.)
+        band.WriteArray(np.clip(field * speckle, 1, 65535).astype(np.uint16), 0, row)
+    ds = None
@@ -0,0 +1,121 @@
+import os
+import pytest
+import cache
+
+class Clock():
+    '''stands in for time.time, so entries get distinct access times'''
+    def __init__(self):
+        self.now = 1e9
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return clock
+
+@pytest.fixture
+def store(tmpdir, clock):
+    store = cache.Cache(str(tmpdir))
+    yield store
+    store.close()
+
+def write(path, text):
+    with open(path, 'w') as fout:
+        fout.write(text)
+    return path
+
+def touch(path, mtime):
+    os.utime(path, ns=(mtime, mtime))
+
+def get_accessed(store, stage, key):
+    return store.conn.execute('SELECT accessed FROM outputs WHERE stage=? AND key=?', (stage, key)).fetchone()[0]
+
+def test_hit(tmpdir, store):
+    inp = write(str(tmpdir.join('input.tif')), 'input')
+    out = write(str(tmpdir.join('output.tif')), 'output')
+    key = store.key('calibrate', [inp, 'S1A_ID'], {'pixel_spacing': 100})
+    assert store.lookup('calibrate', key) is None
+    store.store('calibrate', key, [out])
+    assert store.lookup('calibrate', key) == [out]
+    assert store.key('calibrate', [inp, 'S1A_ID'], {'pixel_spacing': 100}) == key
+    assert store.key('calibrate', [inp, 'S1A_ID'], {'pixel_spacing': 50}) != key
+    assert store.key('merge', [inp, 'S1A_ID'], {'pixel_spacing': 100}) != key
+
+def test_changed_input_misses(tmpdir, store):
+    inp = write(str(tmpdir.join('input.tif')), 'input')
+    out = write(str(tmpdir.join('output.tif')), 'output')
+    key = store.key('calibrate', [inp], {})
+    store.store('calibrate', key, [out])
+    touch(inp, os.stat(inp).st_mtime_ns + 10 ** 9)
+    changed = store.key('calibrate', [inp], {})
+    assert changed != key
+    assert store.lookup('calibrate', changed) is None
+    write(inp, 'a longer input')
+    assert store.key('calibrate', [inp], {}) not in (key, changed)
+
+@pytest.mark.parametrize('change', ['modify', 'touch', 'remove'])
+def test_changed_output_misses(tmpdir, store, change):
+    out = write(str(tmpdir.join('output.tif')), 'output')
+    key = store.key('merge', ['20190101'], {})
+    store.store('merge', key, [out])
+    if change == 'modify':
+        write(out, 'a different output')
+    elif change == 'touch':
+        touch(out, os.stat(out).st_mtime_ns + 10 ** 9)
+    else:
+        os.remove(out)
+    assert store.lookup('merge', key) is None
+    # the stale entry is dropped
+    assert store.conn.execute('SELECT COUNT(*) FROM outputs').fetchone()[0] == 0
+
+def test_hit_updates_accessed(tmpdir, store, clock):
+    out = write(str(tmpdir.join('output.tif')), 'output')
+    key = store.key('merge', ['20190101'], {})
+    store.store('merge', key, [out])
+    assert get_accessed(store, 'merge', key) == clock.now
+    clock.now += 3600.
+    assert store.lookup('merge', key) == [out]
+    assert get_accessed(store, 'merge', key) == clock.now
+
+def fill(tmpdir, store, clock, count=4, stage='calibrate'):
+    '''stores count entries of 10 bytes each, an hour apart, returns their (key, output)s oldest first'''
+    entries = []
+    for i in range(count):
+        out = write(str(tmpdir.join('{}{}.tif'.format(stage, i))), '0123456789')
+        key = store.key(stage, [str(i)], {})
+        store.store(stage, key, [out])
+        entries.append((key, out))
+        clock.now += 3600.
+    return entries
+
+def test_evict_max_bytes_lru(tmpdir, store, clock):
+    entries = fill(tmpdir, store, clock)
+    # using the oldest makes the second oldest the least recently used
+    assert store.lookup('calibrate', entries[0][0]) == [entries[0][1]]
+    assert store.evict(max_bytes=25) == 2
+    assert [os.path.exists(out) for key, out in entries] == [True, False, False, True]
+    assert store.lookup('calibrate', entries[1][0]) is None
+    assert store.lookup('calibrate', entries[3][0]) == [entries[3][1]]
+
+def test_evict_max_age(tmpdir, store, clock):
+    entries = fill(tmpdir, store, clock)
+    clock.now += 86400. - 2.5 * 3600. # the last two entries were used within a day
+    assert store.evict(max_age=1) == 2
+    assert [os.path.exists(out) for key, out in entries] == [False, False, True, True]
+
+def test_evict_stages(tmpdir, store, clock):
+    calibrated = fill(tmpdir, store, clock, stage='calibrate')
+    merged = fill(tmpdir, store, clock, stage='merge')
+    # only the merge entries count towards max_bytes
+    assert store.evict(max_bytes=10, stages=['merge']) == 3
+    assert [os.path.exists(out) for key, out in calibrated] == [True] * 4
+    assert [os.path.exists(out) for key, out in merged] == [False, False, False, True]
+
+def test_evict_keep_files(tmpdir, store, clock):
+    entries = fill(tmpdir, store, clock, count=2)
+    assert store.evict(max_bytes=0, remove_files=False) == 2
+    assert all([os.path.exists(out) for key, out in entries])
+    assert store.lookup('calibrate', entries[0][0]) is None
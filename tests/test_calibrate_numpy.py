@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+from osgeo import gdal
+import calibrate_numpy
+import synthetic
+
+PRODUCT_ENV = 'S1GRD_TEST_PRODUCT' # a real .SAFE folder or zip, to compare the engines over
+WKT_ENV = 'S1GRD_TEST_WKT' # optional region of the real product to compare over
+
+@pytest.fixture(scope='module')
+def product(tmpdir_factory):
+    '''a single small synthetic .SAFE product'''
+    folder = str(tmpdir_factory.mktemp('products'))
+    return synthetic.generate(folder, 1, 1, 300, 300)[0]
+
+@pytest.mark.parametrize('multilook', [False, True])
+@pytest.mark.parametrize('geocode_cache', [False, True])
+def test_calibrate_product(product, tmpdir, multilook, geocode_cache):
+    wkt = synthetic.get_aoi_wkt(1, 300, 300)
+    cache_dir = str(tmpdir.mkdir('cache')) if geocode_cache else False
+    output = calibrate_numpy.calibrate_product(product, str(tmpdir), 'HH', False, wkt, 100, False,
+                                               geocode_cache=cache_dir, multilook=multilook)
+    ds = gdal.Open(output)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    valid = data > 0
+    assert valid.mean() > 0.5
+    # the synthetic DN field is ~120 over a lut of ~600-700
+    assert 0.005 < np.median(data[valid]) < 0.1
+    assert not tmpdir.join('{}.HH.100.calibrated.tif'.format(calibrate_numpy.safe.get_product_basename(product))).exists()
+
+def test_compare_self(product, tmpdir):
+    wkt = synthetic.get_aoi_wkt(1, 300, 300)
+    output = calibrate_numpy.calibrate_product(product, str(tmpdir), 'HH', False, wkt, 100, False)
+    stats = calibrate_numpy.compare(output, output)
+    assert stats['count'] > 0
+    assert stats['median'] == 0.
+
+def test_matches_snap(tmpdir):
+    '''the numpy engine is within TOLERANCE dB of SNAP over a real product, which the synthetic ones can't stand in
+       for as SNAP's reader needs the full product metadata'''
+    path = os.environ.get(PRODUCT_ENV)
+    if not path:
+        pytest.skip('set {} to a real product to compare against SNAP'.format(PRODUCT_ENV))
+    pytest.importorskip('snappy')
+    import calibrate
+    wkt = os.environ.get(WKT_ENV, False)
+    snap_folder = str(tmpdir.mkdir('snap'))
+    assert calibrate.main(infolder=path, outfolder=snap_folder, polarization='HH', wktstring=wkt, engine='snap') == []
+    reference = [os.path.join(snap_folder, name) for name in os.listdir(snap_folder) if name.endswith('.corrected.tif')]
+    assert len(reference) == 1
+    # raises if the median difference exceeds the tolerance
+    calibrate_numpy.main(path, str(tmpdir.mkdir('numpy')), 'HH', wktstring=wkt, reference=reference[0])
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('zarr')
+pytest.importorskip('osgeo')
+from osgeo import gdal
+from osgeo import osr
+import cube
+
+RES = 100.
+
+def write_merged(folder, subdir, value, x0=0., y0=1000., size=10):
+    '''writes a byte mosaic in EPSG:3031 as merge.py would, with 0 as nodata'''
+    path = os.path.join(folder, '{}.merged.masked.tiff'.format(subdir))
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((x0, RES, 0., y0, 0., -RES))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3031)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(np.full((size, size), value, dtype=np.uint8))
+    ds = None
+    return path
+
+def test_append_replace_series(tmpdir):
+    folder = str(tmpdir)
+    write_merged(folder, '20190101', 10)
+    write_merged(folder, '20190113', 20)
+    path = cube.main(folder)
+    ts = cube.Cube(path)
+    assert ts.shape == (2, 10, 10)
+    assert ts.dates == ['2019-01-01', '2019-01-13']
+    # a new date is appended without touching the others
+    write_merged(folder, '20190125', 30)
+    cube.main(folder)
+    ts = cube.Cube(path)
+    assert ts.shape == (3, 10, 10)
+    dates, data, mask = ts.pixel_series(50., 950.)
+    assert dates == ['2019-01-01', '2019-01-13', '2019-01-25']
+    assert data.tolist() == [10, 20, 30]
+    assert mask.all()
+    # a re-merged date replaces its frame
+    remerged = write_merged(folder, '20190101', 40)
+    stat = os.stat(remerged)
+    os.utime(remerged, (stat.st_atime, stat.st_mtime + 10))
+    cube.main(folder)
+    ts = cube.Cube(path)
+    assert ts.shape == (3, 10, 10)
+    assert ts.pixel_series(50., 950.)[1].tolist() == [40, 20, 30]
+    dates, data, mask = ts.pixel_series(950., 50., start='2019-01-10', end='2019-01-20')
+    assert dates == ['2019-01-13']
+    assert data.tolist() == [20]
+
+def test_window_series(tmpdir):
+    folder = str(tmpdir)
+    write_merged(folder, '20190113', 20)
+    write_merged(folder, '20190101', 10)
+    ts = cube.Cube(cube.main(folder))
+    dates, data, mask = ts.window_series(150., 650., 350., 850.)
+    assert dates == ['2019-01-01', '2019-01-13']
+    assert data.shape == (2, 3, 3)
+    assert data[:, 0, 0].tolist() == [10, 20]
+    assert mask.all()
+    # clipped to the cube
+    assert ts.window_series(-500., -500., 150., 150.)[1].shape == (2, 2, 2)
+    with pytest.raises(Exception):
+        ts.pixel_series(-50., 500.)
+
+def test_outside_grid(tmpdir):
+    folder = str(tmpdir)
+    write_merged(folder, '20190101', 10)
+    path = cube.main(folder)
+    # half of the later date lies east of the grid set by the first run
+    write_merged(folder, '20190113', 20, x0=500.)
+    with pytest.raises(Exception) as err:
+        cube.main(folder)
+    assert 'outside' in str(err.value)
+    assert cube.Cube(path).shape[0] == 1
+    cube.main(folder, clip=True)
+    dates, data, mask = cube.Cube(path).window_series(0., 0., 1000., 1000.)
+    assert dates == ['2019-01-01', '2019-01-13']
+    assert mask[1, :, :5].sum() == 0
+    assert mask[1, :, 5:].all()
@@ -0,0 +1,97 @@
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest
+import download
+
+CONTENT = bytes(range(256)) * 4096 # 1 MB
+
+class Handler(BaseHTTPRequestHandler):
+    '''serves CONTENT, honouring Range requests unless the server ignores them. serves corrupted content for the
+       first server.corrupt requests'''
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        body = CONTENT
+        if self.server.corrupt > 0:
+            self.server.corrupt -= 1
+            body = b'\xff' + CONTENT[1:]
+        start = 0
+        rng = self.headers.get('Range')
+        if rng and self.server.ranges:
+            start = int(rng.split('=')[1].rstrip('-'))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    httpd.ranges = True
+    httpd.corrupt = 0
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+def get_entry(server):
+    url = 'http://127.0.0.1:{}/granule.zip'.format(server.server_address[1])
+    return download.Entry('granule.zip', url, len(CONTENT), hashlib.md5(CONTENT).hexdigest())
+
+def run(server, tmpdir):
+    progress = download.Progress(len(CONTENT))
+    path, error = download.download_with_retries(get_entry(server), str(tmpdir), download.new_session(None, None), progress)
+    return path, error, progress
+
+def test_resume(server, tmpdir):
+    tmpdir.join('granule.zip.part').write_binary(CONTENT[:1000])
+    path, error, progress = run(server, tmpdir)
+    assert error is None
+    assert open(path, 'rb').read() == CONTENT
+    assert server.requests == ['bytes=1000-']
+    assert progress.done == len(CONTENT)
+
+def test_range_ignored_restarts(server, tmpdir):
+    server.ranges = False
+    tmpdir.join('granule.zip.part').write_binary(CONTENT[:1000])
+    path, error, progress = run(server, tmpdir)
+    assert error is None
+    assert open(path, 'rb').read() == CONTENT
+    assert progress.done == len(CONTENT)
+
+def test_complete_part_416(server, tmpdir):
+    tmpdir.join('granule.zip.part').write_binary(CONTENT)
+    path, error, progress = run(server, tmpdir)
+    assert error is None
+    assert server.requests == ['bytes={}-'.format(len(CONTENT))]
+    assert not tmpdir.join('granule.zip.part').exists()
+    assert progress.done == len(CONTENT)
+
+def test_checksum_failure_retried(server, tmpdir):
+    server.corrupt = 1
+    path, error, progress = run(server, tmpdir)
+    assert error is None
+    assert len(server.requests) == 2
+    assert open(path, 'rb').read() == CONTENT
+    assert progress.done == len(CONTENT) # the corrupt attempt is no longer counted
+
+def test_checksum_failure(server, tmpdir):
+    server.corrupt = download.RETRIES
+    path, error, progress = run(server, tmpdir)
+    assert path is None
+    assert 'md5 mismatch' in error
+    assert not tmpdir.join('granule.zip.part').exists()
+    assert progress.done == 0
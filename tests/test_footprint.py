@@ -0,0 +1,48 @@
+import math
+import datetime
+import pytest
+import shapely.geometry
+import footprint
+
+DAY = datetime.datetime(2019, 1, 5, 12)
+
+def box(minx, miny, maxx, maxy, name, dt=DAY):
+    return footprint.Footprint(name, shapely.geometry.box(minx, miny, maxx, maxy), dt, 100)
+
+def reasons(dropped):
+    return dict([(fp.name, reason) for fp, reason in dropped])
+
+def test_greedy_cover():
+    aoi = shapely.geometry.box(0, 0, 10, 10)
+    footprints = [box(0, -1, 6, 11, 'a'), box(4, -1, 10, 11, 'b'), box(2, -1, 8, 11, 'c'),
+                  box(20, 0, 30, 10, 'outside'), box(9.95, 0, 12, 10, 'sliver')]
+    selected, dropped, subdirs = footprint.select(footprints, aoi, min_overlap=0.01)
+    # a & b cover the aoi between them, so c adds nothing once they're picked
+    assert sorted([fp.name for fp in selected]) == ['a', 'b']
+    assert reasons(dropped) == {'outside': 'outside aoi', 'sliver': 'covers 0.50% of aoi',
+                                'c': 'redundant in 20190105'}
+    assert subdirs == {'a': '20190105', 'b': '20190105'}
+
+def test_cover_per_date():
+    aoi = shapely.geometry.box(0, 0, 10, 10)
+    later = DAY + datetime.timedelta(days=12)
+    footprints = [box(0, 0, 10, 10, 'full'), box(0, 0, 5, 10, 'half'), box(0, 0, 5, 10, 'later', later),
+                  box(0, 0, 10, 10, 'undated', None)]
+    selected, dropped, subdirs = footprint.select(footprints, aoi)
+    # a granule is only redundant with others of its date group, and undated ones are always kept
+    assert sorted([fp.name for fp in selected]) == ['full', 'later', 'undated']
+    assert reasons(dropped) == {'half': 'redundant in 20190105'}
+    assert subdirs == {'full': '20190105', 'later': '20190117'}
+
+def test_min_overlap_equal_area():
+    # 2 of the 20 degrees of latitude of the aoi, but as the area shrinks towards the pole only ~5.6% of its area
+    aoi = shapely.geometry.box(0, 60, 10, 80)
+    footprints = [box(0, 78, 10, 80, 'polar'), box(0, 60, 10, 62, 'equatorward')]
+    selected, dropped, _ = footprint.select(footprints, aoi, min_overlap=0.08)
+    assert [fp.name for fp in selected] == ['equatorward']
+    assert reasons(dropped) == {'polar': 'covers 5.61% of aoi'}
+
+def test_to_equal_area():
+    cap = footprint.to_equal_area(shapely.geometry.box(0, 0, 360, 90))
+    # a hemisphere of the unit sphere
+    assert cap.area == pytest.approx(2 * math.pi)
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+from osgeo import gdal
+from osgeo import osr
+import geocode
+import synthetic
+
+GT = (-100., 0.001, 0., -75., 0., -0.001)
+SIZE = 1024
+
+class FakeBand():
+    '''stands in for a GDAL band, recording the windows read'''
+    def __init__(self, data):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+        self.reads = []
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        self.reads.append((xoff, yoff, xsize, ysize))
+        return self.data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+def identity_lookup(height, width):
+    '''a lookup mapping output pixel (row, col) to radar (line, pixel) = (row, col)'''
+    rows, cols = geocode.get_nodes(height, geocode.STEP), geocode.get_nodes(width, geocode.STEP)
+    line, pixel = np.meshgrid(rows.astype(np.float32), cols.astype(np.float32), indexing='ij')
+    return {'line': line, 'pixel': pixel, 'rows': rows, 'cols': cols}
+
+def test_resample_tile():
+    data = np.arange(1., 1. + 100 * 120, dtype=np.float32).reshape(100, 120)
+    band = FakeBand(data)
+    lookup = identity_lookup(100, 120)
+    assert geocode.resample_tile(band, lookup, 8, 16, 40, 50).tolist() == data[8:48, 16:66].tolist()
+    # only the window the tile maps to is read
+    assert band.reads == [(16, 8, 50, 40)]
+
+def test_resample_tile_outside():
+    band = FakeBand(np.ones((50, 50), dtype=np.float32))
+    lookup = identity_lookup(100, 100)
+    lookup['line'][:2] = np.nan # failed transform
+    tile = geocode.resample_tile(band, lookup, 0, 0, 100, 100)
+    assert not tile[:8].any()
+    assert tile[16:50, :50].all()
+    # past the radar raster
+    assert not tile[50:].any() and not tile[:, 50:].any()
+    band.reads = []
+    assert not geocode.resample_tile(band, lookup, 60, 60, 40, 40).any()
+    assert band.reads == []
+
+def test_resample_tile_split(monkeypatch):
+    data = np.arange(1., 1. + 64 * 64, dtype=np.float32).reshape(64, 64)
+    band = FakeBand(data)
+    lookup = identity_lookup(64, 64)
+    monkeypatch.setattr(geocode, 'MAX_WINDOW', 32 * 32)
+    assert geocode.resample_tile(band, lookup, 0, 0, 64, 64).tolist() == data.tolist()
+    assert len(band.reads) == 4
+    assert max([xsize * ysize for _, _, xsize, ysize in band.reads]) <= 32 * 32
+
+def affine_transform(line_of, pixel_of):
+    '''returns an inverse_transform standing in for the GCP transformer of an acquisition, from functions of the
+       output (row, col)'''
+    def inverse_transform(src, lons, lats):
+        cols = (lons - GT[0]) / GT[1] - 0.5
+        rows = (lats - GT[3]) / GT[5] - 0.5
+        return line_of(rows, cols), pixel_of(rows, cols)
+    return inverse_transform
+
+def cached_lookup(monkeypatch):
+    monkeypatch.setattr(geocode, 'inverse_transform', affine_transform(lambda r, c: 2. * r + 5., lambda r, c: 3. * c + 1.))
+    rows, cols = geocode.get_nodes(SIZE, geocode.STEP), geocode.get_nodes(SIZE, geocode.STEP)
+    lons, lats = geocode.node_coords(GT, rows, cols)
+    line, pixel = geocode.inverse_transform(None, lons, lats)
+    return {'line': line.astype(np.float32), 'pixel': pixel.astype(np.float32), 'rows': rows, 'cols': cols,
+            'anchor_line': line[::geocode.ANCHOR_STEP, ::geocode.ANCHOR_STEP],
+            'anchor_pixel': pixel[::geocode.ANCHOR_STEP, ::geocode.ANCHOR_STEP]}
+
+def test_fit_lookup(monkeypatch):
+    cached = cached_lookup(monkeypatch)
+    # a later pass on the track, shifted & slightly stretched
+    monkeypatch.setattr(geocode, 'inverse_transform', affine_transform(lambda r, c: 2. * r + 15.,
+                                                                       lambda r, c: 1.01 * (3. * c + 1.) - 3.))
+    fitted = geocode.fit_lookup(cached, None, GT)
+    assert fitted is not None
+    assert fitted['line'] == pytest.approx(cached['line'] + 10., abs=1e-2)
+    assert fitted['pixel'] == pytest.approx(1.01 * cached['pixel'] - 3., abs=1e-2)
+    # the cached lookup is left as it was
+    assert cached['line'][0, 0] == 5.
+
+def test_fit_lookup_rejects(monkeypatch):
+    cached = cached_lookup(monkeypatch)
+    # a different geometry, not an affine change of the cached one
+    monkeypatch.setattr(geocode, 'inverse_transform', affine_transform(lambda r, c: 2. * r + 0.001 * r * c,
+                                                                       lambda r, c: 3. * c + 1.))
+    assert geocode.fit_lookup(cached, None, GT) is None
+    # too few anchors located
+    monkeypatch.setattr(geocode, 'inverse_transform', affine_transform(lambda r, c: r * np.nan, lambda r, c: c))
+    assert geocode.fit_lookup(cached, None, GT) is None
+
+def test_save_load_lookup(tmpdir, monkeypatch):
+    cached = cached_lookup(monkeypatch)
+    path = str(tmpdir.join('geocode', 'lookup.npz'))
+    geocode.save_lookup(path, cached)
+    loaded = geocode.load_lookup(path)
+    assert sorted(loaded) == sorted(cached)
+    assert (loaded['line'] == cached['line']).all()
+
+def write_dem(path, wkt, height):
+    '''writes a flat EPSG:4326 dem over the wkt bounds with a margin'''
+    ds = gdal.GetDriverByName('GTiff').Create(path, 100, 100, 1, gdal.GDT_Float32)
+    minx, maxx, miny, maxy = geocode.ogr.CreateGeometryFromWkt(wkt).GetEnvelope()
+    ds.SetGeoTransform((minx - 1., (maxx - minx + 2.) / 100, 0., maxy + 1., 0., -(maxy - miny + 2.) / 100))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).Fill(height)
+    ds = None
+    return path
+
+def test_dem_without_cache(tmpdir):
+    '''terrain correction with a dem computes the lookup each time when there's no cache'''
+    import calibrate_numpy
+    product = synthetic.generate(str(tmpdir.mkdir('products')), 1, 1, 300, 300)[0]
+    wkt = synthetic.get_aoi_wkt(1, 300, 300)
+    dem = write_dem(str(tmpdir.join('dem.tif')), wkt, 0.)
+    output = calibrate_numpy.calibrate_product(product, str(tmpdir.mkdir('out')), 'HH', False, wkt, 100, False, dem=dem)
+    data = gdal.Open(output).GetRasterBand(1).ReadAsArray()
+    assert (data > 0).mean() > 0.5
+    assert not tmpdir.join('out', 'geocode').exists()
@@ -0,0 +1,78 @@
+import os
+import random
+import datetime
+import pytest
+import group
+
+def make_granules(datetimes, folder=''):
+    grans = []
+    for dt in datetimes:
+        gran = group.granule()
+        gran.path = os.path.join(folder, 'S1A_EW_GRDM_1SDH_{}.tif'.format(dt.strftime('%Y%m%dT%H%M%S')))
+        gran.datetime = dt
+        grans.append(gran)
+    return grans
+
+def pairwise_groups(gran_list, interval):
+    '''the original grouping: repeatedly starts a group at the earliest ungrouped granule'''
+    dt_interval = datetime.timedelta(days=interval)
+    subdirs = dict([(id(gran), None) for gran in gran_list])
+    while True:
+        ungrouped = [gran for gran in gran_list if subdirs[id(gran)] is None]
+        if not ungrouped:
+            return [subdirs[id(gran)] for gran in gran_list]
+        start_time = min([gran.datetime for gran in ungrouped])
+        for gran in ungrouped:
+            if gran.datetime < start_time + dt_interval:
+                subdirs[id(gran)] = start_time.strftime('%Y%m%d')
+
+@pytest.mark.parametrize('interval', [0.5, 1, 3, 6, 12.5])
+def test_sweep_matches_pairwise(interval):
+    rand = random.Random(interval)
+    start = datetime.datetime(2019, 1, 1, 12)
+    datetimes = [start + datetime.timedelta(seconds=rand.randint(0, 60 * 86400)) for _ in range(200)]
+    # granules exactly an interval after a group start begin the next group, those a second before don't
+    datetimes += [start - datetime.timedelta(days=interval), start, start + datetime.timedelta(days=interval),
+                  start + datetime.timedelta(days=2 * interval, seconds=-1), start]
+    rand.shuffle(datetimes)
+    expected = pairwise_groups(make_granules(datetimes), interval)
+    assert [gran.subdir for gran in group.group_granules(make_granules(datetimes), interval)] == expected
+
+def test_boundary_gaps():
+    start = datetime.datetime(2019, 1, 1, 12)
+    datetimes = [start, start + datetime.timedelta(days=2, seconds=-1), start + datetime.timedelta(days=2),
+                 start + datetime.timedelta(days=3, hours=23)]
+    subdirs = [gran.subdir for gran in group.group_granules(make_granules(datetimes), 2)]
+    assert subdirs == ['20190101', '20190101', '20190103', '20190103']
+
+def test_group_by_date():
+    datetimes = [datetime.datetime(2019, 1, 1, 23, 59), datetime.datetime(2019, 1, 2, 0, 1)]
+    assert [gran.subdir for gran in group.group_granules(make_granules(datetimes), 0)] == ['20190101', '20190102']
+
+def listing(folder):
+    return dict([(subdir, sorted(os.listdir(os.path.join(folder, subdir)))) for subdir in sorted(os.listdir(folder))
+                 if os.path.isdir(os.path.join(folder, subdir))])
+
+@pytest.mark.parametrize('link', group.LINK_MODES)
+def test_relink(tmpdir, link):
+    folder = str(tmpdir)
+    start = datetime.datetime(2019, 1, 1, 12)
+    datetimes = [start + datetime.timedelta(days=day) for day in (0, 1, 2, 3)]
+    names = []
+    for gran in make_granules(datetimes, folder):
+        with open(gran.path, 'w') as fout:
+            fout.write(gran.path)
+        names.append(os.path.basename(gran.path))
+    group.main(folder, 0, '*.tif', link=link)
+    assert listing(folder) == {'20190101': names[:1], '20190102': names[1:2], '20190103': names[2:3],
+                               '20190104': names[3:]}
+    # regrouped at another interval, the links of the daily groups are replaced & the emptied folders removed
+    group.main(folder, 2, '*.tif', link=link)
+    assert listing(folder) == {'20190101': names[:2], '20190103': names[2:]}
+    for subdir, files in listing(folder).items():
+        for name in files:
+            path = os.path.join(folder, subdir, name)
+            assert os.path.islink(path) == (link == 'sym')
+            assert os.path.samefile(path, os.path.join(folder, name))
+    # the originals are left in place
+    assert sorted([name for name in os.listdir(folder) if name.endswith('.tif')]) == names
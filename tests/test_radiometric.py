@@ -0,0 +1,71 @@
+import xml.etree.ElementTree as ET
+import numpy as np
+import pytest
+import radiometric
+
+CALIBRATION = '''<calibration><calibrationVectorList count="2">
+<calibrationVector><line>100</line><pixel count="3">0 50 100</pixel><sigmaNought count="3">300 400 500</sigmaNought></calibrationVector>
+<calibrationVector><line>0</line><pixel count="2">0 100</pixel><sigmaNought count="2">100 200</sigmaNought></calibrationVector>
+</calibrationVectorList></calibration>'''
+
+def parse():
+    return radiometric.parse_calibration_lut(ET.fromstring(CALIBRATION))
+
+def test_parse_calibration_lut():
+    lines, pixels, lut = parse()
+    assert lines.tolist() == [0., 100.]
+    # vectors are resampled onto the pixels of the first vector in the file
+    assert pixels.tolist() == [0., 50., 100.]
+    assert lut.tolist() == [[100., 150., 200.], [300., 400., 500.]]
+
+def test_lut_interpolator():
+    lines, pixels, lut = parse()
+    interp = radiometric.LutInterpolator(lines, pixels, lut, 50, 51)
+    block = interp.block(50, 2)
+    assert block.shape == (2, 51)
+    # line 50, pixel 50: halfway between 150 & 400
+    assert block[0, 0] == pytest.approx(275.)
+    # line 51, pixel 100: 0.49 * 200 + 0.51 * 500
+    assert block[1, 50] == pytest.approx(353.)
+    # past the last vector the lut is held
+    assert interp.block(150, 1)[0, 0] == pytest.approx(400.)
+
+def test_calibrate_block():
+    dn = np.array([[3, 4], [0, 12]], dtype=np.uint16)
+    lut = np.array([[1., 2.], [5., 6.]], dtype=np.float32)
+    # 3^2 / 1^2, 4^2 / 2^2, nodata, 12^2 / 6^2
+    assert radiometric.calibrate_block(dn, lut, False).tolist() == [[9., 4.], [0., 4.]]
+    db = radiometric.calibrate_block(dn, lut, True)
+    assert db[1, 0] == 0. # nodata stays 0
+    assert db[0, 0] == pytest.approx(10. * np.log10(9.))
+    assert db[1, 1] == pytest.approx(10. * np.log10(4.))
+
+def test_calibrate_with_lut():
+    lines, pixels, lut = parse()
+    interp = radiometric.LutInterpolator(lines, pixels, lut, 0, 101)
+    dn = np.zeros((1, 101), dtype=np.uint16)
+    dn[0, 0], dn[0, 50], dn[0, 100] = 50, 300, 400
+    sigma0 = radiometric.calibrate_block(dn, interp.block(0, 1), False)
+    # A = 100, 150 & 200 along line 0
+    assert sigma0[0, [0, 50, 100]].tolist() == pytest.approx([50. ** 2 / 100. ** 2, 300. ** 2 / 150. ** 2, 400. ** 2 / 200. ** 2])
+    assert sigma0[0, 1] == 0.
+
+def test_calibrate_block_multilook():
+    dn = np.array([[0, 10], [20, 30]], dtype=np.uint16)
+    lut = np.full(dn.shape, 10., dtype=np.float32)
+    # the valid powers 1, 4 & 9 are averaged in linear power, then scaled to dB
+    multilooked = radiometric.calibrate_block(dn, lut, False, (2, 2))
+    assert multilooked.shape == (1, 1)
+    assert multilooked[0, 0] == pytest.approx(14. / 3.)
+    assert radiometric.calibrate_block(dn, lut, True, (2, 2))[0, 0] == pytest.approx(10. * np.log10(14. / 3.))
+
+def test_multilook_partial_looks():
+    power = np.arange(1., 16.).reshape(3, 5)
+    valid = np.ones(power.shape, dtype=bool)
+    valid[0, 0] = False
+    power[0, 0] = 0. # as calibrate_block leaves nodata
+    out, ok = radiometric.multilook_block(power, valid, (2, 2))
+    # the third row & fifth column don't make whole looks, the invalid pixel is left out of the mean
+    assert out.shape == (1, 2)
+    assert out[0].tolist() == pytest.approx([(2. + 6. + 7.) / 3., (3. + 4. + 8. + 9.) / 4.])
+    assert ok.tolist() == [[True, True]]
@@ -0,0 +1,20 @@
+import zipfile
+import safe
+
+NAME = 'S1A_EW_GRDM_1SDH_20190105T120000_20190105T120100_025280_02CC80_3FAE'
+
+def test_basename_folder():
+    assert safe.get_product_basename('/data/{}.SAFE'.format(NAME)) == NAME
+    assert safe.get_product_basename('/data/{}.SAFE/'.format(NAME)) == NAME
+
+def test_basename_zip(tmpdir):
+    path = str(tmpdir.join(NAME + '.zip'))
+    with zipfile.ZipFile(path, 'w') as zip_ref:
+        zip_ref.writestr(NAME + '.SAFE/manifest.safe', '')
+    assert safe.is_zip_product(path)
+    assert safe.get_product_basename(path) == NAME
+
+def test_looks():
+    assert safe.get_looks(40., 40., 100) == (2, 2)
+    assert safe.get_looks(14., 10., 100) == (7, 10)
+    assert safe.get_looks(40., 40., 10) == (1, 1)
@@ -0,0 +1,22 @@
+import os
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('PIL')
+import timelapse
+
+def test_crop_path_per_cutline(tmpdir):
+    merged = str(tmpdir.join('20190105.merged.masked.tiff'))
+    shapefiles = [str(tmpdir.join(name)) for name in ('aoi.shp', 'other.shp')]
+    for path in shapefiles:
+        tmpdir.join(os.path.basename(path)).write('')
+    first = timelapse.get_crop_path(merged, shapefiles[0], 1024, 768)
+    assert first.startswith(str(tmpdir.join('20190105.1024x768.')))
+    assert first.endswith('.crop.npz')
+    assert timelapse.get_crop_path(merged, shapefiles[0], 1024, 768) == first
+    assert timelapse.get_crop_path(merged, shapefiles[1], 1024, 768) != first
+    assert timelapse.get_crop_path(merged, shapefiles[0], 512, 384) != first
+    # an edited cutline gets a new crop
+    stat = os.stat(shapefiles[0])
+    os.utime(shapefiles[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert timelapse.get_crop_path(merged, shapefiles[0], 1024, 768) != first
@@ -0,0 +1,35 @@
+import time
+import resource
+import pytest
+import tracing
+
+@pytest.fixture
+def trace(tmpdir, monkeypatch):
+    path = str(tmpdir.join('trace.jsonl'))
+    monkeypatch.setattr(tracing, '_trace_path', path)
+    return path
+
+def test_span_peak_leaves_rusage(trace):
+    if tracing.rss_mb() is None or tracing.read_proc_io() is None:
+        pytest.skip('needs /proc')
+    with tracing.span('outer'):
+        with tracing.span('inner'):
+            block = bytearray(200 * 1024 * 1024)
+            time.sleep(4 * tracing.SAMPLE_INTERVAL)
+            del block
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    inner, outer = tracing.read_trace(trace)
+    assert inner['peak_rss_mb'] > inner['rss_mb'] + 150
+    assert outer['peak_rss_mb'] >= inner['peak_rss_mb']
+    assert maxrss >= inner['peak_rss_mb'] - 1
+
+def test_write_bytes_exclude_trace(trace):
+    if tracing.read_proc_io() is None:
+        pytest.skip('needs /proc')
+    with tracing.span('outer'):
+        for _ in range(10):
+            with tracing.span('inner', padding='x' * 1000):
+                pass
+    outer = tracing.read_trace(trace)[-1]
+    assert outer['name'] == 'outer'
+    assert outer['write_bytes'] < 1000
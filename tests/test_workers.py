@@ -0,0 +1,78 @@
+import os
+import hashlib
+import pytest
+import workers
+
+def square(value):
+    return value * value
+
+def crash(value):
+    if value == 3:
+        os._exit(1) # as if the JVM crashed or the job was OOM killed
+    return square(value)
+
+def fail(value):
+    raise ValueError('bad value {}'.format(value))
+
+def digest(value):
+    '''a job producing bytes, compared between the pool & a serial run'''
+    return hashlib.sha256(repr([value * i for i in range(1000)]).encode('utf-8')).hexdigest()
+
+def load():
+    global loaded
+    loaded = os.getpid()
+
+def initialized(value):
+    return loaded
+
+def test_dead_worker_fails_only_its_job():
+    with workers.Pool(2) as pool:
+        results = list(pool.imap_unordered(crash, range(8)))
+    assert len(results) == 8
+    errors = dict([(job, error) for job, result, error in results if error is not None])
+    assert list(errors) == [3]
+    assert isinstance(errors[3], workers.WorkerDied)
+    assert sorted([result for job, result, error in results if error is None]) == [square(i) for i in range(8) if i != 3]
+
+def test_job_exception():
+    with workers.Pool(1) as pool:
+        with pytest.raises(Exception) as err:
+            pool.apply(fail, (2,))
+        assert 'bad value 2' in str(err.value)
+        # the worker survives a job raising
+        assert pool.apply(square, (4,)) == 16
+
+def test_matches_serial():
+    with workers.Pool(3) as pool:
+        results = dict([(job, result) for job, result, error in pool.imap_unordered(digest, range(20))])
+    assert results == dict([(job, digest(job)) for job in range(20)])
+
+def test_initializer():
+    worker = workers.Worker(initializer=load)
+    try:
+        pid = worker.apply(initialized, (0,))
+        assert pid == worker.proc.pid
+        assert worker.jobs == 1
+    finally:
+        worker.close()
+
+def test_calibrate_parallel_matches_serial(tmpdir):
+    '''products calibrated over a pool of workers are byte for byte those calibrated one after another'''
+    pytest.importorskip('osgeo')
+    pytest.importorskip('fiona')
+    import calibrate
+    import synthetic
+    infolder = str(tmpdir.mkdir('products'))
+    synthetic.generate(infolder, 3, 1, 300, 300)
+    wkt = synthetic.get_aoi_wkt(1, 300, 300)
+    outputs = {}
+    for count in (1, 2):
+        outfolder = str(tmpdir.join('workers{}'.format(count)))
+        assert calibrate.main(infolder=infolder, outfolder=outfolder, polarization='HH', wktstring=wkt,
+                              workers=count, engine='numpy') == []
+        outputs[count] = {}
+        for name in sorted(os.listdir(outfolder)):
+            with open(os.path.join(outfolder, name), 'rb') as fin:
+                outputs[count][name] = hashlib.sha256(fin.read()).hexdigest()
+    assert outputs[1]
+    assert outputs[1] == outputs[2]
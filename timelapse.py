@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Renders the merged date mosaics into a timelapse. Frames are cropped to the shapefile in parallel, composited in
+# memory over the last valid pixel of the prior frames, labelled with their date and piped straight into ffmpeg.
+
+import os
+import re
+import glob
+import random
+import string
+import argparse
+import itertools
+import subprocess
+import collections
+import concurrent.futures
+import numpy as np
+from osgeo import gdal
+from PIL import Image, ImageDraw, ImageFont
+import cache
+import cube
+import tracing
+
+gdal.UseExceptions()
+
+FONT = 'DejaVuSans.ttf'
+
+def main(folder, shapefile, width, height, num_procs=32, fps=15, output=False, font_size=100, cache_db=False,
+         cube_path=False):
+    '''renders the *.merged.masked.tiff files in folder (or the frames of the cube) into a timelapse, returns the
+       output path'''
+    if cube_path:
+        return render_cube(cube_path, shapefile, width, height, fps, output, font_size)
+    files = sorted(glob.glob(os.path.join(folder, '*.merged.masked.tiff')))
+    if not files:
+        raise Exception('no merged files found in {}'.format(folder))
+    print('generating animation using {} frames...'.format(len(files)))
+    if output is False:
+        output = os.path.join(folder, 'timelapse_{}.265'.format(random_suffix()))
+    store = None
+    if cache_db:
+        store = cache.Cache(cache_db)
+        key = store.key('timelapse', [shapefile] + files, {'outsize': '{},{}'.format(width, height), 'fps': fps})
+        found = store.lookup('timelapse', key)
+        if found is not None:
+            print('timelapse is unchanged: {}'.format(found[0]))
+            store.close()
+            return found[0]
+    frames = read_ahead(files, shapefile, width, height, num_procs, cache_db)
+    with tracing.span('render', frames=len(files)):
+        render(frames, [get_date(path) for path in files], output, width, height, fps, font_size)
+    if store is not None:
+        store.store('timelapse', key, [output])
+        store.close()
+    return output
+
+def render_cube(cube_path, shapefile, width, height, fps=15, output=False, font_size=100):
+    '''renders the frames of the time series cube in date order, returns the output path'''
+    ts = cube.Cube(cube_path)
+    indices = ts.order()
+    if not indices:
+        raise Exception('no frames in {}'.format(cube_path))
+    print('generating animation using {} frames from {}...'.format(len(indices), cube_path))
+    if output is False:
+        output = os.path.join(os.path.dirname(os.path.abspath(cube_path)), 'timelapse_{}.265'.format(random_suffix()))
+    frames = (crop(ts.frame_dataset(i), shapefile, width, height) for i in indices)
+    with tracing.span('render', frames=len(indices), cube=cube_path):
+        render(frames, ts.dates, output, width, height, fps, font_size)
+    return output
+
+def random_suffix():
+    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(6))
+
+def get_date(path):
+    '''returns the YYYY-MM-DD date label from the filename of a merged file'''
+    res = re.match('([0-9]{4})([0-9]{2})([0-9]{2})', os.path.basename(path))
+    if res is None:
+        return os.path.basename(path).split('.')[0]
+    return '{}-{}-{}'.format(res.group(1), res.group(2), res.group(3))
+
+def read_ahead(files, shapefile, width, height, num_procs, cache_db=False):
+    '''yields the (data, mask) of each cropped frame in order, cropping up to num_procs frames ahead in parallel'''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs) as executor:
+        files = iter(files)
+        pending = collections.deque()
+        for path in itertools.islice(files, num_procs * 2):
+            pending.append(executor.submit(read_frame, path, shapefile, width, height, cache_db))
+        while pending:
+            future = pending.popleft()
+            path = next(files, None)
+            if path is not None:
+                pending.append(executor.submit(read_frame, path, shapefile, width, height, cache_db))
+            yield future.result()
+
+def read_frame(path, shapefile, width, height, cache_db=False):
+    '''crops the merged file to the shapefile at the output size, returns the data and the mask of valid pixels.
+       crops are saved alongside the merged file and reused if cache_db is set.'''
+    store = None
+    if cache_db:
+        store = cache.Cache(cache_db)
+        key = store.key('crop', [path, shapefile], {'outsize': '{},{}'.format(width, height)})
+        found = store.lookup('crop', key)
+        if found is not None:
+            store.close()
+            with np.load(found[0]) as cached:
+                return cached['data'], cached['mask']
+    with tracing.span('frame', frame=os.path.basename(path)):
+        data, mask = crop(path, shapefile, width, height)
+    if store is not None:
+        crop_path = get_crop_path(path, shapefile, width, height)
+        np.savez_compressed(crop_path, data=data, mask=mask)
+        store.store('crop', key, [crop_path])
+        store.close()
+    return data, mask
+
+def get_crop_path(path, shapefile, width, height):
+    '''returns the path of the saved crop of the merged file, named by the output size and a hash of the shapefile
+       path & mtime so crops to other cutlines don't overwrite it'''
+    cutline = cache.text_hash([os.path.abspath(shapefile), os.stat(shapefile).st_mtime_ns])[:12]
+    return path.replace('.merged.masked.tiff', '.{}x{}.{}.crop.npz'.format(width, height, cutline))
+
+def crop(src, shapefile, width, height):
+    '''crops the raster (a path or dataset) to the shapefile at the output size, returns the data & validity mask.
+       reads from the overview matching the output size, and skips the chunks outside the source footprint'''
+    options = gdal.WarpOptions(format='MEM', cutlineDSName=shapefile, cropToCutline=True, dstAlpha=True,
+                               width=width, height=height, resampleAlg='near', overviewLevel='AUTO',
+                               warpOptions=['SKIP_NOSOURCE=YES'])
+    ds = gdal.Warp('', src, options=options)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    mask = ds.GetRasterBand(ds.RasterCount).ReadAsArray() > 0
+    return data, mask
+
+def start_encoder(output, width, height, fps):
+    '''starts ffmpeg reading raw 8 bit grayscale frames from stdin'''
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', '{}x{}'.format(width, height),
+           '-r', str(fps), '-i', '-', '-vf', 'scale=3200:-2', '-c:v', 'libx265', '-crf', '3', '-preset', 'slow', output]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+def load_font(font_size):
+    '''returns the label font, falling back on the PIL default'''
+    try:
+        return ImageFont.truetype(FONT, font_size)
+    except IOError:
+        return ImageFont.load_default()
+
+def annotate(frame, date, font):
+    '''returns a copy of the frame with the date drawn in the lower left corner'''
+    image = Image.fromarray(frame)
+    draw = ImageDraw.Draw(image)
+    bbox = draw.textbbox((0, 0), date, font=font, stroke_width=2)
+    draw.text((100, image.height - 100 - bbox[3]), date, font=font, fill=255, stroke_width=2, stroke_fill=0)
+    return np.asarray(image)
+
+def render(frames, dates, output, width, height, fps=15, font_size=100):
+    '''composites each frame over the last valid pixels of the prior frames, and encodes the labelled frames'''
+    font = load_font(font_size)
+    encoder = start_encoder(output, width, height, fps)
+    composite = np.zeros((height, width), dtype=np.uint8)
+    try:
+        for (data, mask), date in zip(frames, dates):
+            composite[mask] = data[mask]
+            encoder.stdin.write(annotate(composite, date, font).tobytes())
+            print('rendered frame {}'.format(date))
+    finally:
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise Exception('ffmpeg failed encoding {}'.format(output))
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Renders the merged date mosaics into a timelapse")
+    parse.add_argument("--folder", required=False, default=False, help="folder containing the *.merged.masked.tiff files")
+    parse.add_argument("--shapefile", required=True, help="shapefile to crop the frames to")
+    parse.add_argument("--width", required=True, type=int, help="frame width in pixels")
+    parse.add_argument("--height", required=True, type=int, help="frame height in pixels")
+    parse.add_argument("--num_procs", required=False, type=int, default=32, help="number of frames to crop in parallel")
+    parse.add_argument("--fps", required=False, type=int, default=15, help="frames per second")
+    parse.add_argument("--output", required=False, default=False, help="output video path")
+    parse.add_argument("--cache", required=False, default=False, help="cache database (or workdir) used to reuse cropped frames")
+    parse.add_argument("--cube", required=False, default=False, help="read the frames from this time series cube (see cube.py) instead of the folder")
+    tracing.add_arguments(parse)
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    tracing.configure(args.trace, args.profile)
+    with tracing.profile('timelapse'):
+        main(args.folder, args.shapefile, args.width, args.height, num_procs=args.num_procs, fps=args.fps,
+             output=args.output, cache_db=args.cache, cube_path=args.cube)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# Per stage tracing shared by the scripts. Spans record their start & duration, cpu time, memory, bytes read/written
+# and the JVM heap (when SNAP is loaded) as JSON lines, appended by every process of a run to the file named by
+# S1GRD_TRACE, so spawned workers inherit it. Spans are free when tracing is off. The trace can be converted to the
+# Chrome trace format (chrome://tracing, perfetto) or summarised per step.
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import cProfile
+import threading
+import contextlib
+import collections
+
+TRACE_ENV = 'S1GRD_TRACE' # path of the JSON lines trace
+PROFILE_ENV = 'S1GRD_PROFILE' # folder for the cProfile output of each process
+
+_trace_path = os.environ.get(TRACE_ENV) or None
+_profile_dir = os.environ.get(PROFILE_ENV) or None
+SAMPLE_INTERVAL = 0.05 # seconds between the resident memory samples taken while spans are open
+
+_open_spans = [] # spans of this process in progress, whose peaks the sampler updates
+_open_lock = threading.Lock()
+_sampler_pid = None # pid of the process the sampler thread was started in
+_trace_bytes = 0 # bytes of trace lines written by this process, not counted as the written bytes of the spans
+
+class _NoSpan():
+    '''returned by span when tracing is off'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class _Span():
+    '''records a span on exit. cpu, memory & io counters are process wide. peak_rss_mb is the peak resident memory
+       during the span, sampled every SAMPLE_INTERVAL (so a shorter spike can be missed) where /proc is available
+       (linux), otherwise the span records process_max_rss_mb, the peak over the life of the process. the kernel's
+       own high-water mark is left alone, as resetting it would also reset ru_maxrss'''
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.peak = None
+
+    def __enter__(self):
+        with _open_lock:
+            self.peak = rss_mb()
+            if self.peak is not None:
+                _open_spans.append(self)
+                start_sampler()
+            self.trace_bytes = _trace_bytes
+        self.io = read_proc_io()
+        self.cpu = time.process_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        with _open_lock:
+            if self.peak is not None:
+                _open_spans.remove(self)
+                self.peak = max_none(self.peak, rss_mb())
+            trace_bytes = _trace_bytes - self.trace_bytes
+        record = {'name': self.name, 'pid': os.getpid(), 'tid': threading.get_ident(), 'ts': self.start,
+                  'dur': end - self.start, 'cpu': time.process_time() - self.cpu, 'rss_mb': rss_mb()}
+        if self.peak is not None:
+            record['peak_rss_mb'] = self.peak
+        else:
+            record['process_max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        io = read_proc_io()
+        if self.io and io:
+            record['read_bytes'] = io['rchar'] - self.io['rchar']
+            # less the trace lines of the spans nested in this one
+            record['write_bytes'] = io['wchar'] - self.io['wchar'] - trace_bytes
+        heap = jvm_heap_mb()
+        if heap is not None:
+            record['jvm_heap_mb'] = heap
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.attrs)
+        write_record(record)
+        return False
+
+    def set(self, **attrs):
+        '''adds attributes known only once the span has started, eg an output size'''
+        self.attrs.update(attrs)
+
+def configure(trace=False, profile=False):
+    '''turns tracing (and cProfile) on for this process and the processes it starts'''
+    global _trace_path, _profile_dir
+    if trace:
+        _trace_path = os.path.abspath(trace)
+        os.environ[TRACE_ENV] = _trace_path
+    if profile:
+        _profile_dir = os.path.abspath(profile)
+        os.environ[PROFILE_ENV] = _profile_dir
+        if not os.path.exists(_profile_dir):
+            os.makedirs(_profile_dir)
+
+def enabled():
+    return _trace_path is not None
+
+def span(name, **attrs):
+    '''context manager tracing the enclosed step, eg with span('Calibration', granule=name, pol='HH'): ...'''
+    if _trace_path is None:
+        return _NO_SPAN
+    return _Span(name, attrs)
+
+@contextlib.contextmanager
+def profile(name):
+    '''runs the enclosed code under cProfile if profiling is on, writing {name}.{pid}.prof to the profile folder'''
+    if _profile_dir is None:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(os.path.join(_profile_dir, '{}.{}.prof'.format(name, os.getpid())))
+
+def write_record(record):
+    '''appends the record as a single write, so lines from concurrent processes don't interleave'''
+    global _trace_bytes
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    fd = os.open(_trace_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        written = os.write(fd, line)
+    finally:
+        os.close(fd)
+    with _open_lock:
+        _trace_bytes += written
+
+def start_sampler():
+    '''starts the thread sampling the resident memory of the open spans, once per process. call holding _open_lock'''
+    global _sampler_pid
+    if _sampler_pid == os.getpid():
+        return
+    _sampler_pid = os.getpid()
+    thread = threading.Thread(target=_sample_loop, name='tracing-sampler')
+    thread.daemon = True
+    thread.start()
+
+def _sample_loop():
+    '''sampler thread: folds the current resident memory into the peak of every open span'''
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        with _open_lock:
+            if not _open_spans:
+                continue
+            rss = rss_mb()
+            for span in _open_spans:
+                span.peak = max_none(span.peak, rss)
+
+def read_proc_io():
+    '''returns the /proc/self/io counters, or None where unavailable'''
+    try:
+        with open('/proc/self/io', 'r') as fin:
+            return dict([(key, int(value)) for key, value in [line.split(':') for line in fin if ':' in line]])
+    except (IOError, OSError):
+        return None
+
+def rss_mb():
+    '''returns the current resident memory in MB, or None where unavailable'''
+    try:
+        with open('/proc/self/statm', 'r') as fin:
+            return int(fin.read().split()[1]) * resource.getpagesize() / 1024. / 1024.
+    except (IOError, OSError):
+        return None
+
+def max_none(a, b):
+    '''max of two values, either of which may be None'''
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+def jvm_heap_mb():
+    '''returns the used JVM heap in MB if SNAP has been loaded in this process'''
+    snappy = sys.modules.get('snappy')
+    if snappy is None:
+        return None
+    try:
+        runtime = snappy.jpy.get_type('java.lang.Runtime').getRuntime()
+        return (runtime.totalMemory() - runtime.freeMemory()) / 1024. / 1024.
+    except Exception:
+        return None
+
+def add_arguments(parse):
+    '''adds the --trace & --profile options to a script's parser'''
+    parse.add_argument("--trace", required=False, default=False, help="append per step timings & resource use to this JSON lines file")
+    parse.add_argument("--profile", required=False, default=False, help="write cProfile output of each process to this folder")
+    return parse
+
+def read_trace(path):
+    with open(path, 'r') as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+def to_chrome(records, output):
+    '''writes the records as Chrome trace complete events'''
+    events = []
+    for record in records:
+        args = dict([(key, value) for key, value in record.items() if not key in ('name', 'pid', 'tid', 'ts', 'dur')])
+        events.append({'name': record['name'], 'ph': 'X', 'pid': record['pid'], 'tid': record['tid'],
+                       'ts': record['ts'] * 1e6, 'dur': record['dur'] * 1e6, 'args': args})
+    with open(output, 'w') as fout:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fout)
+
+def summarise(records):
+    '''prints the count, total & max duration, cpu time and peak memory of each step'''
+    steps = collections.OrderedDict()
+    for record in sorted(records, key=lambda rec: rec['ts']):
+        steps.setdefault(record['name'], []).append(record)
+    print('{:>20} {:>6} {:>10} {:>10} {:>10} {:>12}'.format('step', 'count', 'total s', 'max s', 'cpu s', 'peak rss MB'))
+    for name, items in steps.items():
+        # older traces, & platforms without /proc, only hold the process lifetime peak
+        peaks = [i.get('peak_rss_mb', i.get('process_max_rss_mb', i.get('max_rss_mb'))) for i in items]
+        print('{:>20} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}'.format(name, len(items), sum([i['dur'] for i in items]),
+              max([i['dur'] for i in items]), sum([i['cpu'] for i in items]), max([p or 0. for p in peaks])))
+
+def parser():
+    '''
+    Construct a parser to parse arguments, returns the parser
+    '''
+    parse = argparse.ArgumentParser(description="Summarises a trace, or converts it to the Chrome trace format")
+    parse.add_argument("--trace", required=True, help="JSON lines trace of a run")
+    parse.add_argument("--chrome", required=False, default=False, help="output Chrome trace (json) file")
+    return parse
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    records = read_trace(args.trace)
+    summarise(records)
+    if args.chrome:
+        to_chrome(records, args.chrome)
+        print('chrome trace written to {}'.format(args.chrome))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Pools of spawned worker processes that, unlike multiprocessing.Pool, fail the job of a worker that dies (a JVM
+# crash or an OOM kill) instead of waiting on it forever. Each worker runs one job at a time over a pipe, so the job
+# that killed it is known, and it is replaced by a fresh process for the next job.
+
+import queue
+import threading
+import traceback
+import multiprocessing
+
+class WorkerDied(Exception):
+    '''raised for a job whose worker process exited before returning a result'''
+
+class Worker():
+    '''a spawned process running the functions sent to it one at a time. initializer is called once when the process
+       starts, eg to load SNAP. jobs counts the jobs run to completion'''
+    def __init__(self, initializer=None):
+        ctx = multiprocessing.get_context('spawn') # forking a process with a running JVM is unsafe
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_loop, args=(child_conn, initializer))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def apply(self, func, args=()):
+        '''returns func(*args) run in the worker. raises WorkerDied if the worker exits, or an exception holding the
+           traceback of an exception raised by func'''
+        try:
+            self.conn.send((func, args))
+            error, result = self.conn.recv()
+        except (EOFError, OSError, IOError):
+            self.proc.join(5)
+            raise WorkerDied('worker process {} died (exit code {})'.format(self.proc.pid, self.proc.exitcode))
+        self.jobs += 1
+        if error is not None:
+            raise Exception(error)
+        return result
+
+    def close(self, timeout=30):
+        try:
+            self.conn.send(None)
+        except (OSError, IOError):
+            pass
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+        self.conn.close()
+
+class Pool():
+    '''a fixed number of workers, started when first needed and replaced when they die. apply can be called from
+       several threads at once, each call waits for an idle worker'''
+    def __init__(self, workers):
+        self.idle = queue.Queue()
+        for _ in range(workers):
+            self.idle.put(None)
+        self.size = workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def apply(self, func, args=()):
+        '''runs func(*args) on an idle worker, see Worker.apply'''
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                worker = Worker()
+            return worker.apply(func, args)
+        except WorkerDied:
+            worker.close(0)
+            worker = None
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def imap_unordered(self, func, jobs):
+        '''yields (job, result, error) as the jobs finish, running func(job) on the workers. error is None, or the
+           WorkerDied or exception raised for the job'''
+        jobs = list(jobs)
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        results = queue.Queue()
+        def run():
+            while True:
+                try:
+                    job = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results.put((job, self.apply(func, (job,)), None))
+                except Exception as err:
+                    results.put((job, None, err))
+        for _ in range(min(self.size, len(jobs))):
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+        for _ in jobs:
+            yield results.get()
+
+    def close(self):
+        '''stops the workers, waiting for running jobs'''
+        for _ in range(self.size):
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+
+def _worker_loop(conn, initializer=None):
+    '''worker process: runs the functions it's sent until told to stop. if the initializer raises, the process exits
+       and the first job fails with WorkerDied'''
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        func, args = item
+        try:
+            reply = (None, func(*args))
+        except Exception:
+            reply = (traceback.format_exc(), None)
+        conn.send(reply)